@@ -4,7 +4,7 @@ Módulo para gestión de días festivos y anomalías de calendario
 from datetime import datetime, date, timedelta
 import calendar
 import pandas as pd
-from database import get_db_connection
+from database import get_read_connection, date_day_number
 
 # Configuración de días festivos por año
 HOLIDAYS = {
@@ -138,7 +138,7 @@ def get_comprehensive_anomalies(year=None, month=None, country_filter=None):
     if month is None:
         month = datetime.now().month
     
-    conn = get_db_connection()
+    conn = get_read_connection()
     
     # 1. Anomalías tradicionales (albaranado > entrega)
     delivery_anomalies = get_delivery_anomalies_detailed(conn, year, month, country_filter)
@@ -174,7 +174,11 @@ def get_delivery_anomalies_detailed(conn, year, month, country_filter=None):
     
     # Construir la query con filtro de país opcional
     country_condition = ""
-    params = [first_day, last_day, first_day, last_day]
+    # Albaranado o entrega dentro del mes; con alb > ent equivale a alb >= inicio,
+    # ent <= fin y (alb <= fin o ent >= inicio), comparaciones que usan índice
+    first_day_number = date_day_number(first_day)
+    last_day_number = date_day_number(last_day)
+    params = [first_day_number, last_day_number, last_day_number, first_day_number]
     
     if country_filter:
         country_condition = "AND c.pais = ?"
@@ -208,11 +212,9 @@ def get_delivery_anomalies_detailed(conn, year, month, country_filter=None):
                                 AND alb.date_position = ent.date_position
     LEFT JOIN client_activities ca_alb ON c.id = ca_alb.client_id AND ca_alb.activity_id = 2
     LEFT JOIN frequency_templates ft_alb ON ca_alb.frequency_template_id = ft_alb.id
-    WHERE date(alb.date) > date(ent.date)
-    AND (
-        (date(alb.date) >= ? AND date(alb.date) <= ?) OR
-        (date(ent.date) >= ? AND date(ent.date) <= ?)
-    )
+    WHERE alb.date_day > ent.date_day
+    AND alb.date_day >= ? AND ent.date_day <= ?
+    AND (alb.date_day <= ? OR ent.date_day >= ?)
     {country_condition}
     ORDER BY c.name, alb.date_position
     """
@@ -256,7 +258,7 @@ def get_incomplete_week_anomalies(conn, year, month, country_filter=None):
     country_condition = ""
     first_day = date(year, month, 1)
     last_day = date(year, month, calendar.monthrange(year, month)[1])
-    params = [first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')]
+    params = [date_day_number(first_day), date_day_number(last_day)]
     
     if country_filter:
         country_condition = "AND c.pais = ?"
@@ -286,7 +288,7 @@ def get_incomplete_week_anomalies(conn, year, month, country_filter=None):
     JOIN client_activities ca ON c.id = ca.client_id AND ca.activity_id = 2
     JOIN frequency_templates ft ON ca.frequency_template_id = ft.id
     JOIN calculated_dates cd ON c.id = cd.client_id AND cd.activity_id = 2
-    WHERE date(cd.date) >= ? AND date(cd.date) <= ?
+    WHERE cd.date_day BETWEEN ? AND ?
     {country_condition}
     ORDER BY c.name, cd.date_position
     """
@@ -339,7 +341,7 @@ def get_holiday_anomalies(conn, year, month, country_filter=None):
     
     # Construir filtro de país opcional
     country_condition = ""
-    params = holiday_dates.copy()
+    params = [date_day_number(holiday[0]) for holiday in holidays]
     
     if country_filter:
         country_condition = "AND c.pais = ?"
@@ -369,7 +371,7 @@ def get_holiday_anomalies(conn, year, month, country_filter=None):
     JOIN client_activities ca ON c.id = ca.client_id AND ca.activity_id = 2
     JOIN frequency_templates ft ON ca.frequency_template_id = ft.id
     JOIN calculated_dates cd ON c.id = cd.client_id AND cd.activity_id = 2
-    WHERE date(cd.date) IN ({placeholders})
+    WHERE cd.date_day IN ({placeholders})
     {country_condition}
     ORDER BY c.name, cd.date_position
     """
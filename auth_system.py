@@ -194,7 +194,11 @@ class AuthSystem:
                 return False, "Cuenta bloqueada temporalmente por múltiples intentos fallidos."
             return False, "Usuario o contraseña incorrectos"
 
-        record_login_success(username)
+        # Sin intentos fallidos ni bloqueo pendientes, last_login va a la escritura diferida
+        record_login_success(
+            username,
+            clear_lockout=bool(user.get("failed_attempts") or user.get("locked_until"))
+        )
         record_login_event(username)
         return True, user
 
@@ -0,0 +1,96 @@
+"""
+Benchmark del transporte Arrow (GL_ARROW_TRANSPORT / GL_ARROW_CACHE).
+
+Compara pd.read_sql_query contra la lectura vía Arrow y la entrega desde cache
+sobre un calculated_dates sintético en memoria; no toca la BD real.
+
+Uso:
+    python benchmark_arrow_transport.py [filas]
+"""
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+from database import (pa, apply_schema, CALCULATED_DATES_SCHEMA, _arrow_from_cursor, _arrow_to_df,
+                      _df_to_arrow)
+
+
+def benchmark_arrow_transport(rows=500000, batch_rows=None, repeat=3):
+    """Compara read_sql_query contra el transporte Arrow sobre un calculated_dates sintético.
+
+    Usa una BD SQLite en memoria con el mismo esquema (no toca la BD real) y mide,
+    con CALCULATED_DATES_SCHEMA aplicado en ambos casos: lectura a DataFrame, lectura
+    a tabla Arrow, entrega desde cache (copia del DataFrame frente a to_pandas de la
+    tabla) y memoria de lo que se guardaría en cache. Devuelve los tiempos en ms
+    (mejor de `repeat` corridas).
+    """
+    if pa is None:
+        print("=== BENCHMARK ARROW: pyarrow no está instalado ===")
+        return None
+    
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''
+        CREATE TABLE calculated_dates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            activity_id INTEGER,
+            activity_name TEXT NOT NULL,
+            date_position INTEGER NOT NULL DEFAULT 1,
+            date DATE NOT NULL,
+            is_custom BOOLEAN DEFAULT 0
+        )
+    ''')
+    activities = [(1, 'Fecha Envío OC'), (2, 'Albaranado'), (3, 'Fecha Entrega')]
+    start = date(2024, 1, 1)
+    conn.executemany(
+        "INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date, is_custom) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (i // 72 + 1, activities[i % 3][0], activities[i % 3][1], (i // 3) % 24 + 1,
+             (start + timedelta(days=i % 730)).strftime('%Y-%m-%d'), int(i % 50 == 0))
+            for i in range(rows)
+        )
+    )
+    conn.commit()
+    query = "SELECT id, client_id, activity_id, activity_name, date_position, date, is_custom FROM calculated_dates"
+    
+    def best_ms(func):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return round(min(timings), 1), result
+    
+    def read_arrow():
+        cursor = conn.cursor()
+        cursor.execute(query)
+        return _arrow_from_cursor(cursor, batch_rows)
+    
+    results = {'rows': rows}
+    results['read_sql_query_ms'], df = best_ms(
+        lambda: apply_schema(pd.read_sql_query(query, conn), CALCULATED_DATES_SCHEMA))
+    results['arrow_fetch_ms'], table = best_ms(read_arrow)
+    results['arrow_transport_ms'], _ = best_ms(
+        lambda: apply_schema(_arrow_to_df(read_arrow()), CALCULATED_DATES_SCHEMA))
+    
+    cached_table = _df_to_arrow(df)
+    results['cache_hit_dataframe_copy_ms'], _ = best_ms(lambda: df.copy())
+    results['cache_hit_arrow_to_pandas_ms'], _ = best_ms(lambda: _arrow_to_df(cached_table))
+    results['dataframe_bytes'] = int(df.memory_usage(index=False, deep=True).sum())
+    results['arrow_bytes'] = int(cached_table.nbytes)
+    results['raw_arrow_bytes'] = int(table.nbytes)
+    conn.close()
+    
+    print(f"=== BENCHMARK ARROW ({rows} filas) ===")
+    for name, value in results.items():
+        print(f"   {name}: {value}")
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark_arrow_transport(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
+    sys.exit(0 if results is not None else 1)
@@ -0,0 +1,110 @@
+"""
+Benchmark de escritura de calculated_dates.
+
+Compara la ruta anterior (una transacción por actividad, DELETE con LIKE e INSERT
+fila a fila) contra save_calculated_dates_bulk (_write_calculated_dates) sobre un
+archivo SQLite temporal con el esquema y los índices reales; no toca la BD real.
+
+Uso:
+    python benchmark_calculated_dates_writes.py [clientes]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from database import _create_schema, _migrate_date_keys, _DATABASE_INDEXES, _write_calculated_dates
+
+
+def benchmark_calculated_dates_writes(clients=200, dates_per_activity=24, year=2025):
+    """Compara la escritura anterior de calculated_dates contra save_calculated_dates_bulk.
+
+    Usa un archivo SQLite temporal con el esquema, las claves de fecha y los índices
+    reales (no toca la BD real), con fechas previas del año anterior y de `year`. La
+    ruta anterior abre una transacción por actividad (DELETE con LIKE, MAX de
+    posición e INSERT fila a fila sin activity_id); la nueva reemplaza todo en una
+    transacción con _write_calculated_dates. Devuelve filas/segundo de cada una.
+    """
+    activities = [(1, 'Fecha Envío OC'), (2, 'Albaranado'), (3, 'Fecha Entrega')]
+    start = date(year, 1, 1)
+    entries = [
+        (client_id, activity_id, year,
+         [start + timedelta(days=(client_id + position * 14 + activity_id) % 365)
+          for position in range(dates_per_activity)])
+        for client_id in range(1, clients + 1)
+        for activity_id, _ in activities
+    ]
+    activity_names = dict(activities)
+    total_rows = sum(len(entry[3]) for entry in entries)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark_calculated_dates.db')
+    conn = sqlite3.connect(path, isolation_level=None)
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    _create_schema(cursor)
+    _migrate_date_keys(cursor)
+    for index_sql in _DATABASE_INDEXES:
+        try:
+            cursor.execute(index_sql)
+        except sqlite3.Error:
+            pass  # tablas de otros módulos que no existen en esta BD de prueba
+    previous_year = [
+        (client_id, activity_id, year - 1, [d.replace(year=year - 1) for d in dates_list])
+        for client_id, activity_id, _, dates_list in entries
+    ]
+    _write_calculated_dates(cursor, previous_year + entries, activity_names)
+    cursor.execute("COMMIT")
+
+    def legacy_write():
+        for client_id, activity_id, entry_year, dates_list in entries:
+            activity_name = activity_names[activity_id]
+            cursor.execute("BEGIN")
+            cursor.execute(
+                "DELETE FROM calculated_dates WHERE client_id = ? AND activity_name = ? AND date LIKE ?",
+                (client_id, activity_name, f"{entry_year}-%")
+            )
+            cursor.execute(
+                "SELECT COALESCE(MAX(date_position), 0) FROM calculated_dates WHERE client_id = ? AND activity_name = ?",
+                (client_id, activity_name)
+            )
+            max_position = cursor.fetchone()[0]
+            for i, date_item in enumerate(dates_list):
+                cursor.execute(
+                    "INSERT INTO calculated_dates (client_id, activity_name, date_position, date) VALUES (?, ?, ?, ?)",
+                    (client_id, activity_name, max_position + i + 1, date_item.strftime('%Y-%m-%d'))
+                )
+            cursor.execute("COMMIT")
+
+    def bulk_write():
+        cursor.execute("BEGIN")
+        _write_calculated_dates(cursor, entries, activity_names)
+        cursor.execute("COMMIT")
+
+    results = {'rows': total_rows, 'transactions_before': len(entries), 'transactions_after': 1}
+    try:
+        for name, func in (('before', legacy_write), ('after', bulk_write)):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            results[f'{name}_ms'] = round(elapsed * 1000, 1)
+            results[f'{name}_rows_per_second'] = int(total_rows / elapsed) if elapsed else None
+        cursor.execute("SELECT COUNT(*) FROM calculated_dates WHERE activity_id IS NULL")
+        results['rows_without_activity_id'] = cursor.fetchone()[0]
+    finally:
+        conn.close()
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+
+    print(f"=== BENCHMARK ESCRITURA calculated_dates ({total_rows} filas, {len(entries)} actividades) ===")
+    for name, value in results.items():
+        print(f"   {name}: {value}")
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark_calculated_dates_writes(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
+    sys.exit(0 if results['rows_without_activity_id'] == 0 else 1)
@@ -0,0 +1,173 @@
+"""
+Benchmark del motor vectorizado de frecuencias (date_calculator).
+
+Compara el cálculo anterior mes a mes, incluido aquí como referencia, contra
+compute_frequency_dates_batch y verifica que ambos den las mismas fechas; luego
+mide el cache de calendarios compilados en una generación tipo generador anual.
+
+Uso:
+    python benchmark_frequency_engine.py
+"""
+import calendar
+import io
+import json
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+from date_calculator import (get_nth_weekday_of_month, compute_frequency_dates_batch, calculate_dates_for_frequency,
+                             clear_frequency_schedules, get_schedule_cache_stats)
+
+
+def _calculate_dates_month_loop(frequency_type, frequency_config, start_date=None, full_year=True):
+    """Cálculo anterior mes a mes (date_calculator antes del motor vectorizado), como referencia"""
+    dates = []
+    
+    # Si no se especifica fecha de inicio, usar enero del año actual
+    if start_date is None:
+        current_year = datetime.now().year
+        start_date = datetime(current_year, 1, 1).date()
+    else:
+        current_year = start_date.year
+    
+    print(f"Calculando fechas para todo el año {current_year}: tipo={frequency_type}, config={frequency_config}")
+    
+    # Calcular para todos los meses del año (enero a diciembre)
+    for month in range(1, 13):  # Meses 1-12
+        try:
+            if frequency_type == "nth_weekday":
+                config = json.loads(frequency_config)
+                weekday = config["weekday"]  # 0=lunes, 1=martes, etc.
+                weeks = config["weeks"]
+                
+                print(f"Calculando nth_weekday para {current_year}-{month:02d}: weekday={weekday}, weeks={weeks}")
+                
+                for week in weeks:
+                    date = get_nth_weekday_of_month(current_year, month, weekday, week)
+                    if date:
+                        dates.append(date)
+                        print(f"Fecha agregada: {date}")
+            
+            elif frequency_type == "specific_days":
+                config = json.loads(frequency_config)
+                days = config["days"]
+                
+                print(f"Calculando specific_days para {current_year}-{month:02d}: days={days}")
+                
+                for day in days:
+                    try:
+                        date = datetime(current_year, month, day).date()
+                        dates.append(date)
+                        print(f"Fecha agregada: {date}")
+                    except ValueError:
+                        # Si el día no existe en este mes, tomar el último día del mes
+                        if day > 28:
+                            last_day = calendar.monthrange(current_year, month)[1]
+                            date = datetime(current_year, month, last_day).date()
+                            dates.append(date)
+                            print(f"Fecha ajustada agregada: {date}")
+            
+        except Exception as e:
+            print(f"Error procesando mes {current_year}-{month:02d}: {e}")
+            continue
+    
+    sorted_dates = sorted(dates)
+    print(f"Total de fechas calculadas para el año {current_year}: {len(sorted_dates)}")
+    print(f"Primeras 5 fechas: {sorted_dates[:5] if sorted_dates else 'Ninguna'}")
+    print(f"Últimas 5 fechas: {sorted_dates[-5:] if len(sorted_dates) >= 5 else sorted_dates}")
+    
+    return sorted_dates
+
+
+def benchmark_frequency_engine(templates=1000, years=10, first_year=2020, repeat=3):
+    """Compara el cálculo mes a mes contra compute_frequency_dates_batch.
+
+    Genera `templates` plantillas sintéticas (nth_weekday y specific_days, con días
+    29-31 para cubrir el ajuste a fin de mes) y calcula `years` años de cada una:
+    una llamada por plantilla y año con el cálculo anterior (su salida por consola
+    se descarta) contra una sola llamada al motor vectorizado, sin el cache de
+    calendarios. Verifica que ambos
+    den las mismas fechas y devuelve los tiempos en ms (mejor de `repeat` corridas).
+    """
+    frequencies = []
+    for i in range(templates):
+        if i % 2:
+            weeks = sorted({i % 4 + 1, (i // 4) % 5 + 1})
+            frequencies.append(("nth_weekday", json.dumps({"weekday": i % 7, "weeks": weeks})))
+        else:
+            days = sorted({i % 28 + 1, (i // 2) % 31 + 1, 29 + i % 3})
+            frequencies.append(("specific_days", json.dumps({"days": days})))
+    year_range = range(first_year, first_year + years)
+    requests = [(frequency_type, config, year) for frequency_type, config in frequencies for year in year_range]
+
+    def month_loop():
+        with redirect_stdout(io.StringIO()):
+            return [_calculate_dates_month_loop(frequency_type, config, datetime(year, 1, 1).date())
+                    for frequency_type, config, year in requests]
+
+    def best_ms(func):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return round(min(timings), 1), result
+
+    results = {'templates': templates, 'years': years, 'schedules': len(requests)}
+    results['month_loop_ms'], expected = best_ms(month_loop)
+    results['vectorized_batch_ms'], computed = best_ms(lambda: compute_frequency_dates_batch(requests, use_cache=False))
+    results['dates'] = sum(len(dates) for dates in computed)
+    results['speedup'] = round(results['month_loop_ms'] / results['vectorized_batch_ms'], 1) if results['vectorized_batch_ms'] else None
+    results['matches'] = all(dates.tolist() == reference for dates, reference in zip(computed, expected))
+
+    print(f"=== BENCHMARK MOTOR DE FRECUENCIAS ({templates} plantillas x {years} años) ===")
+    for name, value in results.items():
+        print(f"   {name}: {value}")
+    return results
+
+
+def benchmark_schedule_cache(clients=2000, activities=3, years=3, templates=30, first_year=2025):
+    """Mide el cache de calendarios en una generación como la del generador anual.
+
+    Cada cliente tiene `activities` actividades asignadas a `templates` plantillas
+    sintéticas y se pide calculate_dates_for_frequency por cliente x actividad x año,
+    primero sin cache y luego con el cache vacío al empezar. Devuelve los tiempos en
+    ms y cuántos calendarios se calcularon realmente.
+    """
+    frequencies = [
+        ("nth_weekday", json.dumps({"weekday": i % 5, "weeks": [i % 4 + 1]})) if i % 2 else
+        ("specific_days", json.dumps({"days": [i % 28 + 1, 29 + i % 3]}))
+        for i in range(templates)
+    ]
+    requests = [
+        frequencies[(client_id * activities + activity) % templates] + (year,)
+        for year in range(first_year, first_year + years)
+        for client_id in range(clients)
+        for activity in range(activities)
+    ]
+
+    results = {'schedules_requested': len(requests), 'templates': templates, 'years': years}
+    started = time.perf_counter()
+    for request in requests:
+        compute_frequency_dates_batch([request], use_cache=False)[0].tolist()
+    results['uncached_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    clear_frequency_schedules()
+    computed_before = get_schedule_cache_stats()['computed']
+    started = time.perf_counter()
+    for frequency_type, frequency_config, year in requests:
+        calculate_dates_for_frequency(frequency_type, frequency_config, datetime(year, 1, 1).date())
+    results['cached_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    results['schedules_computed'] = get_schedule_cache_stats()['computed'] - computed_before
+
+    print(f"=== BENCHMARK CACHE DE CALENDARIOS ({clients} clientes x {activities} actividades x {years} años) ===")
+    for name, value in results.items():
+        print(f"   {name}: {value}")
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark_frequency_engine()
+    benchmark_schedule_cache()
+    sys.exit(0 if results['matches'] else 1)
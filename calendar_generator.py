@@ -331,8 +331,7 @@ class CalendarGenerator:
                 print(f"No hay fechas en la BD para el cliente {client_id}")
                 return []
             
-            # Filtrar fechas para el año específico
-            calculated_dates_df['date'] = pd.to_datetime(calculated_dates_df['date'])
+            # Filtrar fechas para el año específico (la columna date ya viene como datetime64)
             year_dates = calculated_dates_df[calculated_dates_df['date'].dt.year == year]
             
             if year_dates.empty:
@@ -615,11 +614,11 @@ def get_clients_by_type(tipo_cliente=None, country_filter=None):
             client['pais'] = client['country']
         
         # Asegurar que siempre tengamos pais (fallback)
-        if 'pais' not in client or not client['pais']:
+        if 'pais' not in client or pd.isna(client['pais']) or not client['pais']:
             client['pais'] = 'N/A'
         
         # Asegurar que siempre tengamos tipo_cliente (fallback)
-        if 'tipo_cliente' not in client or not client['tipo_cliente']:
+        if 'tipo_cliente' not in client or pd.isna(client['tipo_cliente']) or not client['tipo_cliente']:
             client['tipo_cliente'] = 'N/A'
         
         # Inferir frecuencia del calendario_sap si no existe (solo como fallback)
@@ -741,11 +740,11 @@ def get_clients_by_sap_calendar(sap_calendar_code=None, country_filter=None):
             client['pais'] = client['country']
         
         # Asegurar que siempre tengamos pais (fallback)
-        if 'pais' not in client or not client['pais']:
+        if 'pais' not in client or pd.isna(client['pais']) or not client['pais']:
             client['pais'] = 'N/A'
         
         # Asegurar que siempre tengamos tipo_cliente (fallback)
-        if 'tipo_cliente' not in client or not client['tipo_cliente']:
+        if 'tipo_cliente' not in client or pd.isna(client['tipo_cliente']) or not client['tipo_cliente']:
             client['tipo_cliente'] = 'N/A'
         
         # Asegurar que calendario_sap esté normalizado
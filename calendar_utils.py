@@ -38,8 +38,8 @@ def create_full_year_calendar_table(dates_df, activities):
     # Agrupar fechas por actividad y mes
     table_data = []
     
-    # Obtener todos los meses con fechas
-    dates_df['month'] = pd.to_datetime(dates_df['date']).dt.to_period('M')
+    # Obtener todos los meses con fechas (la columna date ya viene como datetime64)
+    dates_df['month'] = dates_df['date'].dt.to_period('M')
     months = sorted(dates_df['month'].unique())
     
     for activity in activities:
@@ -60,8 +60,7 @@ def create_full_year_calendar_table(dates_df, activities):
                 formatted_dates = []
                 for _, date_row in month_dates.iterrows():
                     try:
-                        date_obj = datetime.strptime(date_row['date'], '%Y-%m-%d')
-                        formatted_dates.append(date_obj.strftime('%d'))
+                        formatted_dates.append(date_row['date'].strftime('%d'))
                     except:
                         continue
                 
@@ -96,9 +95,7 @@ def create_compact_calendar_table(dates_df, activities):
             
             if not matching_row.empty:
                 try:
-                    date_str = matching_row.iloc[0]['date']
-                    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                    formatted_date = date_obj.strftime('%d-%b')
+                    formatted_date = matching_row.iloc[0]['date'].strftime('%d-%b')
                     row[f"Fecha {i}"] = formatted_date
                 except:
                     row[f"Fecha {i}"] = ""
@@ -127,8 +124,7 @@ def create_monthly_calendar_view(client_id, selected_month=None):
         selected_month = datetime.now().strftime('%Y-%m')
     
     # Filtrar fechas del mes seleccionado
-    dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-    dates_df['month_key'] = dates_df['date_obj'].dt.strftime('%Y-%m')
+    dates_df['month_key'] = dates_df['date'].dt.strftime('%Y-%m')
     month_dates = dates_df[dates_df['month_key'] == selected_month]
     
     if month_dates.empty:
@@ -144,8 +140,7 @@ def create_monthly_calendar_view(client_id, selected_month=None):
         dates_list = []
         for _, date_row in activity_dates.iterrows():
             try:
-                date_obj = datetime.strptime(date_row['date'], '%Y-%m-%d')
-                dates_list.append(date_obj.strftime('%d-%b'))
+                dates_list.append(date_row['date'].strftime('%d-%b'))
             except:
                 continue
         
@@ -174,18 +169,18 @@ def get_client_year_summary(client_id):
     actividades = len(dates_df['activity_name'].unique())
     
     # Contar meses con actividad
-    dates_df['month'] = pd.to_datetime(dates_df['date']).dt.to_period('M')
+    dates_df['month'] = dates_df['date'].dt.to_period('M')
     meses_con_actividad = len(dates_df['month'].unique())
     
     # Encontrar próxima fecha
     today = datetime.now().date()
-    future_dates = dates_df[pd.to_datetime(dates_df['date']).dt.date >= today]
+    future_dates = dates_df[dates_df['date'].dt.date >= today]
     
     proxima_fecha = None
     if not future_dates.empty:
         next_date = future_dates.sort_values('date').iloc[0]
         proxima_fecha = {
-            "fecha": next_date['date'],
+            "fecha": next_date['date'].strftime('%Y-%m-%d'),
             "actividad": next_date['activity_name']
         }
     
@@ -228,9 +223,8 @@ def get_available_months(client_id):
         return []
     
     try:
-        dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-        dates_df['month_key'] = dates_df['date_obj'].dt.strftime('%Y-%m')
-        dates_df['month_name'] = dates_df['date_obj'].dt.strftime('%B %Y')
+        dates_df['month_key'] = dates_df['date'].dt.strftime('%Y-%m')
+        dates_df['month_name'] = dates_df['date'].dt.strftime('%B %Y')
         
         months = dates_df[['month_key', 'month_name']].drop_duplicates().sort_values('month_key')
         return months.to_dict('records')
@@ -245,8 +239,7 @@ def get_available_years(client_id):
         return []
     
     try:
-        dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-        years = sorted(dates_df['date_obj'].dt.year.unique())
+        years = sorted(dates_df['date'].dt.year.dropna().unique())
         return years
     except:
         return []
@@ -264,8 +257,7 @@ def create_client_calendar_table_by_year(client_id, year):
     
     # Filtrar por año
     try:
-        dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-        dates_df = dates_df[dates_df['date_obj'].dt.year == year]
+        dates_df = dates_df[dates_df['date'].dt.year == year]
         
         if dates_df.empty:
             return pd.DataFrame()
@@ -298,8 +290,7 @@ def get_client_year_summary_by_year(client_id, year):
     
     # Filtrar por año
     try:
-        dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-        dates_df = dates_df[dates_df['date_obj'].dt.year == year]
+        dates_df = dates_df[dates_df['date'].dt.year == year]
         
         if dates_df.empty:
             return {
@@ -314,18 +305,18 @@ def get_client_year_summary_by_year(client_id, year):
         actividades = len(dates_df['activity_name'].unique())
         
         # Contar meses con actividad
-        dates_df['month'] = dates_df['date_obj'].dt.to_period('M')
+        dates_df['month'] = dates_df['date'].dt.to_period('M')
         meses_con_actividad = len(dates_df['month'].unique())
         
         # Encontrar próxima fecha del año especificado
         today = datetime.now().date()
-        future_dates = dates_df[dates_df['date_obj'].dt.date >= today]
+        future_dates = dates_df[dates_df['date'].dt.date >= today]
         
         proxima_fecha = None
         if not future_dates.empty:
             next_date = future_dates.sort_values('date').iloc[0]
             proxima_fecha = {
-                "fecha": next_date['date'],
+                "fecha": next_date['date'].strftime('%Y-%m-%d'),
                 "actividad": next_date['activity_name']
             }
         
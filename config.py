@@ -310,7 +310,19 @@ class DatabaseConfig:
             # Conexión SQLite local para testing
             import sqlite3
             db_path = self.get_database_path()
-            return sqlite3.connect(db_path)
+            # El pool entrega cada conexión a un solo hilo a la vez, pero no siempre al mismo
+            return sqlite3.connect(db_path, check_same_thread=False)
+    
+    def is_replica_enabled(self):
+        """Modo réplica: las lecturas se sirven desde una copia SQLite local (GL_REPLICA_ENABLED)"""
+        return get_replica_settings()['enabled']
+    
+    def get_replica_path(self):
+        """Ruta del archivo SQLite local que actúa como réplica de lectura"""
+        replica_path = Path(get_replica_settings()['path'])
+        if not replica_path.is_absolute():
+            replica_path = Path(__file__).parent.absolute() / replica_path
+        return str(replica_path)
     
     def get_environment(self):
         """Retorna el entorno actual"""
@@ -432,5 +444,100 @@ def is_production():
     """Función helper para verificar si estamos en producción"""
     return db_config.is_production()
 
+def _get_int_env(name, default):
+    """Lee una variable de entorno entera, usando el valor por defecto si es inválida"""
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"[GREEN LOGISTICS] Advertencia: {name}={value} no es un entero válido, usando {default}")
+        return default
+
+def get_cache_settings():
+    """Límites del cache de consultas (0 desactiva el límite correspondiente)"""
+    return {
+        'max_entries': _get_int_env('GL_CACHE_MAX_ENTRIES', 500),
+        'max_bytes': _get_int_env('GL_CACHE_MAX_MB', 128) * 1024 * 1024,
+        # Opt-in: entregar DataFrames inmutables sin copiar (ver DatabaseCache._freeze)
+        'read_only': os.getenv('GL_CACHE_READ_ONLY', 'false').strip().lower() == 'true',
+        # Segundo nivel compartido entre procesos del host (vacío = deshabilitado)
+        'shared_path': os.getenv('GL_SHARED_CACHE_PATH', '').strip(),
+        'shared_max_bytes': _get_int_env('GL_SHARED_CACHE_MAX_MB', 512) * 1024 * 1024,
+        # Calendarios compilados (frecuencia, configuración, año) en memoria del proceso
+        'schedule_max_entries': _get_int_env('GL_SCHEDULE_CACHE_MAX_ENTRIES', 1024)
+    }
+
+def get_pool_settings():
+    """Parámetros del pool de conexiones a la base de datos"""
+    return {
+        # Solo se hace ping (SELECT 1) a conexiones inactivas más de estos segundos
+        'ping_idle_seconds': _get_int_env('GL_POOL_PING_IDLE_SECONDS', 30),
+        # Límite duro de conexiones abiertas (en uso + inactivas) y conexiones inactivas conservadas
+        'max_open': _get_int_env('GL_POOL_MAX_OPEN', 10),
+        'max_idle': _get_int_env('GL_POOL_MAX_IDLE', 5),
+        # Segundos que una petición espera por una conexión libre antes de fallar
+        'checkout_timeout': _get_int_env('GL_POOL_CHECKOUT_TIMEOUT', 10),
+        # Reciclar conexiones por antigüedad e inactividad (0 = sin límite)
+        'max_age': _get_int_env('GL_POOL_MAX_AGE_SECONDS', 1800),
+        'idle_timeout': _get_int_env('GL_POOL_IDLE_TIMEOUT', 300),
+        # Conexiones que se abren al iniciar el proceso y se mantienen vivas (0 = no precalentar)
+        'prewarm': _get_int_env('GL_POOL_PREWARM', 2),
+        # Hilo de keep-alive: ping periódico a las conexiones inactivas (kill switch: GL_POOL_KEEPALIVE=false)
+        'keepalive': os.getenv('GL_POOL_KEEPALIVE', 'true').strip().lower() != 'false',
+        'heartbeat_seconds': _get_int_env('GL_POOL_HEARTBEAT_SECONDS', 20)
+    }
+
+def get_replica_settings():
+    """Parámetros de la réplica local de lectura (ver local_replica.LocalReplica)"""
+    return {
+        'enabled': os.getenv('GL_REPLICA_ENABLED', 'false').strip().lower() == 'true',
+        'path': os.getenv('GL_REPLICA_PATH', 'client_calendar_replica.db').strip() or 'client_calendar_replica.db',
+        # Intervalo de la sincronización incremental con la BD principal
+        'sync_seconds': _get_int_env('GL_REPLICA_SYNC_SECONDS', 30),
+        # Si la última sincronización correcta es más antigua, las lecturas vuelven a la BD principal
+        'max_lag_seconds': _get_int_env('GL_REPLICA_MAX_LAG_SECONDS', 300),
+        # Cambios conservados en replica_changelog; una réplica más atrasada hace copia completa
+        'changelog_keep': _get_int_env('GL_REPLICA_CHANGELOG_KEEP', 50000)
+    }
+
+def get_write_behind_settings():
+    """Cola de escrituras diferidas no críticas (eventos de login, last_login)"""
+    return {
+        # Kill switch: GL_WRITE_BEHIND_ENABLED=false vuelve a escribir de forma síncrona
+        'enabled': os.getenv('GL_WRITE_BEHIND_ENABLED', 'true').strip().lower() != 'false',
+        # Un lote se confirma cada estos milisegundos o al juntar estas filas, lo que ocurra antes
+        'flush_ms': _get_int_env('GL_WRITE_BEHIND_FLUSH_MS', 500),
+        'batch_rows': _get_int_env('GL_WRITE_BEHIND_BATCH_ROWS', 100),
+        # Filas pendientes máximas; por encima se escribe de forma síncrona
+        'max_queue': _get_int_env('GL_WRITE_BEHIND_MAX_QUEUE', 10000)
+    }
+
+def get_query_profiling_settings():
+    """Medición por consulta: tiempo, filas, bytes, llamador y log de consultas lentas"""
+    return {
+        # Kill switch: GL_QUERY_PROFILING=false deja de medir
+        'enabled': os.getenv('GL_QUERY_PROFILING', 'true').strip().lower() != 'false',
+        # Consultas por encima de este tiempo van al log de lentas (con EXPLAIN QUERY PLAN)
+        'slow_ms': _get_int_env('GL_SLOW_QUERY_MS', 250),
+        'explain': os.getenv('GL_SLOW_QUERY_EXPLAIN', 'true').strip().lower() != 'false',
+        'slow_log_size': _get_int_env('GL_SLOW_QUERY_LOG_SIZE', 100),
+        # Filas de la tabla de consultas más costosas y sentencias distintas que se siguen
+        'top_n': _get_int_env('GL_QUERY_STATS_TOP_N', 20),
+        'max_statements': _get_int_env('GL_QUERY_STATS_MAX_STATEMENTS', 500)
+    }
+
+def get_arrow_settings():
+    """Transporte Apache Arrow para resultados de consultas (requiere pyarrow)"""
+    return {
+        # Construir los DataFrames desde tablas Arrow armadas por columnas en lugar de read_sql_query
+        'transport': os.getenv('GL_ARROW_TRANSPORT', 'false').strip().lower() == 'true',
+        # Guardar en cache los resultados de execute_query_df como tablas Arrow
+        'cache': os.getenv('GL_ARROW_CACHE', 'false').strip().lower() == 'true',
+        # Filas por lote leídas del cursor (fetchmany) al armar la tabla
+        'batch_rows': _get_int_env('GL_ARROW_BATCH_ROWS', 10000)
+    }
+
 # Nota: is_read_only_mode() ahora se maneja a través del sistema de autenticación
 # Ver auth_system.py para el control de permisos basado en roles
@@ -4,9 +4,10 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta, date
 from database import (
-    get_db_connection, get_clients, get_calculated_dates,
-    get_cache_stats, get_database_statistics, optimize_database,
-    clear_cache, get_clients_summary
+    execute_query_df, get_clients, get_calculated_dates,
+    get_cache_stats, get_cache_family_stats, get_database_statistics, optimize_database,
+    clear_cache, get_clients_summary, get_query_stats, get_slow_queries, reset_query_stats,
+    date_day_number
 )
 from werfen_styles import get_metric_card_html
 import calendar
@@ -34,11 +35,8 @@ def format_country_filter(country_filter):
 @st.cache_data(ttl=90, show_spinner=False)
 def _cached_query_df(query: str, params: tuple):
     """Cache ligero para DataFrames del dashboard (reduce roundtrips a BDD en reruns)."""
-    conn = get_db_connection()
-    try:
-        return pd.read_sql_query(query, conn, params=params)
-    finally:
-        conn.close()
+    # execute_query_df usa la réplica local si está disponible y registra la consulta en el profiler
+    return execute_query_df(query, params=params)
 
 def get_tomorrow_oc_clients(country_filter=None):
     """Obtiene clientes con fecha OC para mañana (o lunes si hoy es viernes) - Versión optimizada con filtro por país"""
@@ -57,21 +55,21 @@ def get_tomorrow_oc_clients(country_filter=None):
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 1
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         AND c.pais = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'), country_filter))
+        df = _cached_query_df(query, (date_day_number(target_date), country_filter))
     else:
         query = """
         SELECT c.name, c.codigo_ag, c.codigo_we, c.csr, c.vendedor, cd.date, c.tipo_cliente, c.region, c.calendario_sap, c.pais
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 1
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'),))
+        df = _cached_query_df(query, (date_day_number(target_date),))
     
     return df
 
@@ -83,21 +81,21 @@ def get_oc_clients_by_day(target_date, country_filter=None):
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 1
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         AND c.pais = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'), country_filter))
+        df = _cached_query_df(query, (date_day_number(target_date), country_filter))
     else:
         query = """
         SELECT c.name, c.codigo_ag, c.codigo_we, c.csr, c.vendedor, cd.date, c.tipo_cliente, c.region, c.calendario_sap, c.pais
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 1
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'),))
+        df = _cached_query_df(query, (date_day_number(target_date),))
     return df
 
 def get_albaranado_clients_by_day(target_date, country_filter=None):
@@ -109,21 +107,21 @@ def get_albaranado_clients_by_day(target_date, country_filter=None):
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 2
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         AND c.pais = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'), country_filter))
+        df = _cached_query_df(query, (date_day_number(target_date), country_filter))
     else:
         query = """
         SELECT c.name, c.codigo_ag, c.codigo_we, c.csr, c.vendedor, cd.date, c.tipo_cliente, c.region, c.calendario_sap, c.pais
         FROM clients c
         JOIN calculated_dates cd ON c.id = cd.client_id
         WHERE cd.activity_id = 2
-        AND date(cd.date) = ?
+        AND cd.date_day = ?
         ORDER BY c.name
         """
-        df = _cached_query_df(query, (target_date.strftime('%Y-%m-%d'),))
+        df = _cached_query_df(query, (date_day_number(target_date),))
     return df
 
 def get_delivery_anomalies(country_filter=None):
@@ -137,6 +135,11 @@ def get_delivery_anomalies(country_filter=None):
     else:
         last_day = today.replace(month=today.month + 1, day=1) - timedelta(days=1)
     
+    # Albaranado o entrega dentro del mes: con alb > ent equivale a alb >= inicio,
+    # ent <= fin y (alb <= fin o ent >= inicio), comparaciones que usan índice
+    first_day_number = date_day_number(first_day)
+    last_day_number = date_day_number(last_day)
+    
     # Construir query con filtro de país opcional e incluir información de calendario SAP
     if country_filter:
         query = """
@@ -165,19 +168,13 @@ def get_delivery_anomalies(country_filter=None):
                                     AND alb.date_position = ent.date_position
         LEFT JOIN client_activities ca_alb ON c.id = ca_alb.client_id AND ca_alb.activity_id = 2
         LEFT JOIN frequency_templates ft_alb ON ca_alb.frequency_template_id = ft_alb.id
-        WHERE date(alb.date) > date(ent.date)
+        WHERE alb.date_day > ent.date_day
         AND c.pais = ?
-        AND (
-            (date(alb.date) >= ? AND date(alb.date) <= ?) OR
-            (date(ent.date) >= ? AND date(ent.date) <= ?)
-        )
+        AND alb.date_day >= ? AND ent.date_day <= ?
+        AND (alb.date_day <= ? OR ent.date_day >= ?)
         ORDER BY c.name, alb.date_position
         """
-        df = _cached_query_df(query, (
-            country_filter,
-            first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'),
-            first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')
-        ))
+        df = _cached_query_df(query, (country_filter, first_day_number, last_day_number, last_day_number, first_day_number))
     else:
         query = """
         SELECT 
@@ -205,17 +202,12 @@ def get_delivery_anomalies(country_filter=None):
                                     AND alb.date_position = ent.date_position
         LEFT JOIN client_activities ca_alb ON c.id = ca_alb.client_id AND ca_alb.activity_id = 2
         LEFT JOIN frequency_templates ft_alb ON ca_alb.frequency_template_id = ft_alb.id
-        WHERE date(alb.date) > date(ent.date)
-        AND (
-            (date(alb.date) >= ? AND date(alb.date) <= ?) OR
-            (date(ent.date) >= ? AND date(ent.date) <= ?)
-        )
+        WHERE alb.date_day > ent.date_day
+        AND alb.date_day >= ? AND ent.date_day <= ?
+        AND (alb.date_day <= ? OR ent.date_day >= ?)
         ORDER BY c.name, alb.date_position
         """
-        df = _cached_query_df(query, (
-            first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d'),
-            first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')
-        ))
+        df = _cached_query_df(query, (first_day_number, last_day_number, last_day_number, first_day_number))
     
     # Agregar información formateada de calendario SAP para anomalías de entrega
     if not df.empty:
@@ -243,12 +235,9 @@ def get_delivery_anomalies(country_filter=None):
 def get_monthly_activity_data(year, month, activity_id, country_filter=None):
     """Obtiene los datos de fechas por actividad para un mes específico con filtro por país"""
     
-    # Crear las fechas de inicio y fin del mes
-    start_date = date(year, month, 1)
-    if month == 12:
-        end_date = date(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = date(year, month + 1, 1) - timedelta(days=1)
+    # Rango de días del mes (date_day) para filtrar sobre el índice (activity_id, date_day)
+    first_day_number = date_day_number(date(year, month, 1))
+    last_day_number = date_day_number(date(year, month, calendar.monthrange(year, month)[1]))
     
     # Construir query con filtro de país opcional
     if country_filter:
@@ -259,12 +248,12 @@ def get_monthly_activity_data(year, month, activity_id, country_filter=None):
         FROM calculated_dates cd
         JOIN clients c ON c.id = cd.client_id
         WHERE cd.activity_id = ?
-        AND date(cd.date) >= ? AND date(cd.date) <= ?
+        AND cd.date_day BETWEEN ? AND ?
         AND c.pais = ?
-        GROUP BY date(cd.date)
-        ORDER BY date(cd.date)
+        GROUP BY cd.date_day
+        ORDER BY cd.date_day
         """
-        df = _cached_query_df(query, (activity_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), country_filter))
+        df = _cached_query_df(query, (activity_id, first_day_number, last_day_number, country_filter))
     else:
         query = """
         SELECT 
@@ -273,11 +262,11 @@ def get_monthly_activity_data(year, month, activity_id, country_filter=None):
         FROM calculated_dates cd
         JOIN clients c ON c.id = cd.client_id
         WHERE cd.activity_id = ?
-        AND date(cd.date) >= ? AND date(cd.date) <= ?
-        GROUP BY date(cd.date)
-        ORDER BY date(cd.date)
+        AND cd.date_day BETWEEN ? AND ?
+        GROUP BY cd.date_day
+        ORDER BY cd.date_day
         """
-        df = _cached_query_df(query, (activity_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
+        df = _cached_query_df(query, (activity_id, first_day_number, last_day_number))
     
     # Convertir fecha a datetime para mejor manejo
     if not df.empty:
@@ -789,6 +778,47 @@ def show_performance_dashboard():
             value=cache_stats.get('cached_items', 0)
         )
     
+    # Estadísticas por familia de claves: permite ver qué familia está expulsando o fallando
+    family_stats = get_cache_family_stats()
+    if family_stats:
+        st.markdown("**Cache por familia de claves**")
+        family_df = pd.DataFrame(family_stats)
+        family_df['hit_rate'] = family_df['hit_rate'].round(1)
+        family_df['cached_bytes'] = (family_df['cached_bytes'] / 1024).round(1)
+        family_df['avg_load_ms'] = family_df['avg_load_ms'].round(1)
+        family_df = family_df[['family', 'hits', 'misses', 'hit_rate', 'evictions',
+                               'cached_items', 'cached_bytes', 'loads', 'avg_load_ms']]
+        family_df.columns = ['Familia', 'Hits', 'Misses', 'Hit Rate (%)', 'Expulsiones',
+                             'Items', 'Memoria (KB)', 'Cargas', 'Carga Promedio (ms)']
+        st.dataframe(family_df, use_container_width=True, hide_index=True)
+    
+    # Consultas más costosas (tiempo acumulado) y log de consultas lentas con su plan
+    query_stats = get_query_stats()
+    if query_stats:
+        st.markdown("**Consultas más costosas**")
+        query_df = pd.DataFrame(query_stats)
+        query_df['sql'] = query_df['sql'].str.slice(0, 120)
+        for column in ['total_ms', 'avg_ms', 'max_ms', 'avg_rows']:
+            query_df[column] = query_df[column].round(1)
+        query_df['avg_bytes'] = (query_df['avg_bytes'] / 1024).round(1)
+        query_df = query_df[['sql', 'count', 'total_ms', 'avg_ms', 'max_ms', 'avg_rows',
+                             'avg_bytes', 'slow_count', 'last_caller']]
+        query_df.columns = ['Consulta', 'Ejecuciones', 'Total (ms)', 'Promedio (ms)', 'Máximo (ms)',
+                            'Filas Promedio', 'KB Promedio', 'Lentas', 'Último Llamador']
+        st.dataframe(query_df, use_container_width=True, hide_index=True)
+    
+    slow_queries = get_slow_queries()
+    if slow_queries:
+        with st.expander(f"Consultas lentas recientes ({len(slow_queries)})", expanded=False):
+            for entry in slow_queries[:20]:
+                st.markdown(
+                    f"**{entry['elapsed_ms']:.0f} ms** · {entry['rows']} filas · {entry['source']} · "
+                    f"{entry['caller']} · {entry['at']}"
+                )
+                st.code(entry['sql'], language="sql")
+                if entry['plan']:
+                    st.code(entry['plan'], language="text")
+    
     # Controles de administración
     st.subheader("Administración del Sistema")
     
@@ -799,6 +829,9 @@ def show_performance_dashboard():
             clear_cache()
             st.success("Cache limpiado exitosamente")
             st.rerun()
+        if st.button("Reiniciar Métricas de Consultas", type="secondary"):
+            reset_query_stats()
+            st.rerun()
     
     with col2:
         if st.button("Optimizar Base de Datos", type="secondary"):
@@ -814,9 +847,14 @@ def show_performance_dashboard():
     # Información adicional
     st.subheader("Información del Sistema")
     
+    pool_stats = db_stats.get('connection_pool', {})
+    write_behind_stats = db_stats.get('write_behind') or {}
     info_text = f"""
     **Estado del Cache:**
     - El cache está funcionando con un hit rate del {cache_stats.get('hit_rate', 0):.1f}%
+    - Memoria usada: {cache_stats.get('cached_bytes', 0) / (1024 * 1024):.1f} MB de {cache_stats.get('max_bytes', 0) / (1024 * 1024):.0f} MB ({cache_stats.get('evictions', 0)} expulsiones LRU)
+    - Conexiones: {pool_stats.get('in_use_connections', 0)} en uso / {pool_stats.get('open_connections', 0)} abiertas (máximo {pool_stats.get('max_open', 0)}), espera promedio {pool_stats.get('avg_checkout_wait_ms', 0):.1f} ms
+    - Escritura diferida: {write_behind_stats.get('queue_depth', 0)} pendientes, {write_behind_stats.get('written', 0)} escritas en {write_behind_stats.get('batches', 0)} lotes, latencia promedio {write_behind_stats.get('avg_latency_ms', 0):.0f} ms
     - {'Rendimiento excelente' if cache_stats.get('hit_rate', 0) >= 80 else 'Rendimiento normal' if cache_stats.get('hit_rate', 0) >= 60 else 'Rendimiento bajo - considere limpiar cache'}
     
     **Recomendaciones:**
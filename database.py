@@ -1,26 +1,160 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 import json
 import warnings
 import threading
 import time
 import hashlib
+import re
+import sys
+import os
+import atexit
+from collections import OrderedDict, deque
+from itertools import groupby
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from config import get_database_path, get_db_config
+from config import (get_database_path, get_db_config, get_cache_settings, get_pool_settings,
+                    get_replica_settings, get_write_behind_settings,
+                    get_query_profiling_settings, get_arrow_settings)
+
+try:
+    import pyarrow as pa
+except ImportError:  # opcional: sin pyarrow se usa pd.read_sql_query
+    pa = None
 
 # Suprimir warnings específicos de pandas sobre SQLAlchemy
 warnings.filterwarnings('ignore', message='.*SQLAlchemy.*', category=UserWarning)
 warnings.filterwarnings('ignore', message='.*pandas only supports SQLAlchemy.*', category=UserWarning)
 
-# Sistema de cache mejorado con TTL y invalidación inteligente
+class _InflightLoad:
+    """Carga en curso de una clave: los llamadores concurrentes esperan su resultado"""
+    def __init__(self, epoch):
+        self.event = threading.Event()
+        self.epoch = epoch
+        self.value = None
+        self.error = None
+
+# Familias de claves del cache para las estadísticas: (prefijo, familia). El orden importa:
+# los prefijos más largos van primero ("clients_" antes que "client_").
+_CACHE_KEY_FAMILIES = (
+    ('matching_frequencies_', 'matching_frequencies'),
+    ('activities_', 'activities'),
+    ('dates_', 'dates'),
+    ('clients_', 'clients'),
+    ('client_', 'client'),
+    ('frequency_', 'frequency'),
+)
+_QUERY_HASH_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def cache_key_family(key):
+    """Devuelve la familia de una clave del cache (p. ej. `dates_15` -> `dates`)"""
+    for prefix, family in _CACHE_KEY_FAMILIES:
+        if key.startswith(prefix):
+            return family
+    if _QUERY_HASH_KEY_RE.match(key):
+        return 'query-hash'
+    # Otras claves `<nombre>_<id>` (activity_summary_3, default_activities_only_7...)
+    return key.rsplit('_', 1)[0] if '_' in key else key
+
+class _FamilyStats:
+    """Contadores de una familia de claves del cache"""
+    __slots__ = ('hits', 'misses', 'evictions', 'cached_items', 'cached_bytes', 'loads', 'load_time')
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cached_items = 0
+        self.cached_bytes = 0
+        self.loads = 0
+        self.load_time = 0.0
+
+# Sistema de cache mejorado con TTL, invalidación inteligente y límites de tamaño (LRU)
 class DatabaseCache:
-    def __init__(self, default_ttl=60):
-        self._cache = {}
+    def __init__(self, default_ttl=60, max_entries=500, max_bytes=128 * 1024 * 1024, read_only=False,
+                 shared_tier=None):
+        # OrderedDict mantiene el orden de uso: el primer elemento es el menos reciente
+        self._cache = OrderedDict()
         self._timestamps = {}
+        self._sizes = {}
+        self._total_bytes = 0
+        # Índice de etiquetas: tag -> claves, y clave -> tags (invalidación O(claves afectadas))
+        self._tag_index = {}
+        self._key_tags = {}
         self._lock = threading.RLock()
         self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Modo solo lectura: los DataFrames se guardan con buffers NumPy no escribibles y
+        # cada hit entrega una copia superficial (sin costo proporcional a las filas)
+        self.read_only = read_only
         self.hit_count = 0
         self.miss_count = 0
+        self.eviction_count = 0
+        self.evicted_bytes = 0
+        self.expired_count = 0
+        self.rejected_count = 0
+        # Single-flight: clave -> carga en curso. El epoch cambia con cada invalidación
+        # para no guardar resultados leídos antes de una escritura concurrente.
+        self._inflight = {}
+        self._epoch = 0
+        self.coalesced_count = 0
+        self.stale_hit_count = 0
+        self.refresh_count = 0
+        self.refresh_error_count = 0
+        # Segundo nivel opcional compartido entre procesos (ver shared_cache.SharedCacheTier)
+        self._shared = shared_tier
+        self.shared_hit_count = 0
+        # Estadísticas por familia de claves (ver cache_key_family). Para las claves
+        # que usan get()/set() el tiempo de carga va del miss hasta el set posterior.
+        self._family_stats = {}
+        self._miss_started = {}
+    
+    def _family(self, key):
+        """Contadores de la familia de `key` (requiere el lock)"""
+        family = cache_key_family(key)
+        stats = self._family_stats.get(family)
+        if stats is None:
+            stats = self._family_stats[family] = _FamilyStats()
+        return stats
+    
+    def _record_load(self, key, elapsed):
+        """Registra la duración de una carga desde la base de datos (requiere el lock)"""
+        stats = self._family(key)
+        stats.loads += 1
+        stats.load_time += elapsed
+    
+    @staticmethod
+    def _estimate_size(value):
+        """Estima el tamaño en memoria (bytes) de un valor del cache"""
+        try:
+            if isinstance(value, pd.DataFrame):
+                return int(value.memory_usage(deep=True).sum())
+            if isinstance(value, pd.Series):
+                return int(value.memory_usage(deep=True))
+            if pa is not None and isinstance(value, pa.Table):
+                return int(value.nbytes)
+        except Exception:
+            pass
+        return sys.getsizeof(value)
+    
+    @staticmethod
+    def _freeze(value):
+        """Copia un DataFrame/Series una sola vez y marca sus buffers como no escribibles.
+
+        Cualquier intento de modificar en sitio una vista entregada por el cache
+        falla con ValueError (con pandas Copy-on-Write la escritura copia primero),
+        de modo que el valor almacenado nunca se corrompe.
+        """
+        frozen = value.copy()
+        manager = getattr(frozen, '_mgr', None)
+        for array in getattr(manager, 'arrays', None) or []:
+            # Algunos ExtensionArray (p. ej. StringArray) envuelven un ndarray
+            array = getattr(array, '_ndarray', array)
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        return frozen
     
     def _is_expired(self, key, custom_ttl=None):
         """Verifica si una entrada del cache ha expirado"""
@@ -32,65 +166,594 @@ class DatabaseCache:
         # print(f"[CACHE DEBUG] Clave {key[:20]}... - Edad: {age:.1f}s, TTL: {ttl}s, Expirado: {age > ttl}")
         return age > ttl
     
+    def _remove(self, key):
+        """Elimina una entrada y actualiza el contador de memoria (requiere el lock)"""
+        if key in self._cache:
+            stats = self._family(key)
+            stats.cached_items -= 1
+            stats.cached_bytes -= self._sizes.get(key, 0)
+        self._cache.pop(key, None)
+        self._timestamps.pop(key, None)
+        self._total_bytes -= self._sizes.pop(key, 0)
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+    
+    def _evict_if_needed(self):
+        """Expulsa las entradas menos usadas hasta respetar los límites (requiere el lock)"""
+        while self._cache and (
+            (self.max_entries and len(self._cache) > self.max_entries) or
+            (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            oldest_key = next(iter(self._cache))
+            self.evicted_bytes += self._sizes.get(oldest_key, 0)
+            self.eviction_count += 1
+            self._family(oldest_key).evictions += 1
+            self._remove(oldest_key)
+    
+    def _copy_out(self, cached_value):
+        """Entrega un valor del cache sin exponer el objeto almacenado"""
+        # Hacer copia segura dependiendo del tipo
+        if self.read_only and isinstance(cached_value, (pd.DataFrame, pd.Series)):
+            # Vista superficial sobre buffers inmutables: O(columnas), no O(filas)
+            return cached_value.copy(deep=False)
+        if isinstance(cached_value, pd.DataFrame):
+            return cached_value.copy()
+        elif isinstance(cached_value, pd.Series):
+            return cached_value.copy()
+        else:
+            return cached_value
+    
     def get(self, key, custom_ttl=None):
         with self._lock:
-            if key in self._cache and not self._is_expired(key, custom_ttl):
-                self.hit_count += 1
-                cached_value = self._cache[key]
-                # Hacer copia segura dependiendo del tipo
-                if isinstance(cached_value, pd.DataFrame):
-                    return cached_value.copy()
-                elif isinstance(cached_value, pd.Series):
-                    return cached_value.copy()
-                else:
-                    return cached_value
+            if key in self._cache:
+                if not self._is_expired(key, custom_ttl):
+                    self.hit_count += 1
+                    self._family(key).hits += 1
+                    self._cache.move_to_end(key)
+                    return self._copy_out(self._cache[key])
+                # Entrada expirada: liberar memoria de inmediato
+                self.expired_count += 1
+                self._remove(key)
+        
+        shared_value = self._load_shared(key, custom_ttl or self.default_ttl)
+        if shared_value is not None:
+            return self._copy_out(shared_value)
+        with self._lock:
             self.miss_count += 1
+            self._family(key).misses += 1
+            # El llamador normalmente consulta la BD y hace set(): medir esa carga
+            if len(self._miss_started) > 1000:
+                self._miss_started.clear()
+            self._miss_started[key] = time.perf_counter()
+        return None
+    
+    def _load_shared(self, key, ttl):
+        """Busca la clave en el nivel compartido y, si existe, la promueve al cache en memoria"""
+        if self._shared is None:
             return None
+        result = self._shared.get(key, ttl)
+        if result is None:
+            return None
+        value, created_at, tags = result
+        with self._lock:
+            self.shared_hit_count += 1
+            self._family(key).hits += 1
+            # Conservar la antigüedad original para respetar el TTL
+            if self._store_local(key, value, created_at, tags):
+                return self._cache.get(key, value)
+        return value
     
-    def set(self, key, value, custom_ttl=None):
+    def set(self, key, value, custom_ttl=None, tags=None):
+        """Guarda un valor; `tags` registra la entrada para invalidación por etiqueta"""
+        created_at = time.time()
         with self._lock:
-            # Hacer copia segura dependiendo del tipo antes de almacenar
-            if isinstance(value, pd.DataFrame):
-                self._cache[key] = value.copy()
-            elif isinstance(value, pd.Series):
-                self._cache[key] = value.copy()
+            miss_started = self._miss_started.pop(key, None)
+            if miss_started is not None:
+                self._record_load(key, time.perf_counter() - miss_started)
+            stored = self._store_local(key, value, created_at, tags)
+        if stored and self._shared is not None:
+            self._shared.set(key, value, created_at, tags)
+    
+    def _store_local(self, key, value, created_at, tags):
+        """Guarda en memoria aplicando copia/congelado y límites LRU (requiere el lock)"""
+        # Hacer copia segura dependiendo del tipo antes de almacenar
+        if self.read_only and isinstance(value, (pd.DataFrame, pd.Series)):
+            value = self._freeze(value)
+        elif isinstance(value, pd.DataFrame):
+            value = value.copy()
+        elif isinstance(value, pd.Series):
+            value = value.copy()
+        
+        size = self._estimate_size(value)
+        self._remove(key)
+        
+        # Un valor más grande que todo el presupuesto no se cachea
+        if self.max_bytes and size > self.max_bytes:
+            self.rejected_count += 1
+            return False
+        
+        self._cache[key] = value
+        self._timestamps[key] = created_at
+        self._sizes[key] = size
+        self._total_bytes += size
+        stats = self._family(key)
+        stats.cached_items += 1
+        stats.cached_bytes += size
+        if tags:
+            key_tags = frozenset(tags)
+            self._key_tags[key] = key_tags
+            for tag in key_tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+        self._evict_if_needed()
+        return True
+    
+    def get_or_load(self, key, loader, custom_ttl=None, tags=None, stale_while_revalidate=True,
+                    wait_timeout=30):
+        """Obtiene `key` del cache o la carga con `loader()` una sola vez (single-flight).
+
+        - Si otra sesión ya está cargando la misma clave, se espera su resultado en
+          lugar de repetir la consulta.
+        - Con `stale_while_revalidate`, una entrada expirada hace menos de un TTL se
+          sirve tal cual mientras un hilo en segundo plano la refresca.
+        """
+        ttl = custom_ttl or self.default_ttl
+        with self._lock:
+            if key in self._cache:
+                age = time.time() - self._timestamps[key]
+                if age <= ttl:
+                    self.hit_count += 1
+                    self._family(key).hits += 1
+                    self._cache.move_to_end(key)
+                    return self._copy_out(self._cache[key])
+                if stale_while_revalidate and age <= ttl * 2:
+                    self.stale_hit_count += 1
+                    self._family(key).hits += 1
+                    self._cache.move_to_end(key)
+                    if key not in self._inflight:
+                        flight = _InflightLoad(self._epoch)
+                        self._inflight[key] = flight
+                        threading.Thread(
+                            target=self._run_load,
+                            args=(key, loader, ttl, tags, flight, True),
+                            name=f"cache-refresh-{key[:24]}",
+                            daemon=True
+                        ).start()
+                    return self._copy_out(self._cache[key])
+            
+            flight = self._inflight.get(key)
+            if flight is None:
+                self.miss_count += 1
+                self._family(key).misses += 1
+                flight = _InflightLoad(self._epoch)
+                self._inflight[key] = flight
+                is_owner = True
             else:
-                self._cache[key] = value
-            self._timestamps[key] = time.time()
+                self.coalesced_count += 1
+                is_owner = False
+        
+        if is_owner:
+            return self._run_load(key, loader, ttl, tags, flight, False)
+        
+        if not flight.event.wait(wait_timeout):
+            # La carga original tarda demasiado: consultar directamente
+            return loader()
+        if flight.error is not None:
+            raise flight.error
+        return self._copy_out(flight.value)
+    
+    def _run_load(self, key, loader, ttl, tags, flight, background):
+        """Ejecuta el loader, publica el resultado a los que esperan y lo guarda en cache"""
+        try:
+            # Otro proceso pudo haber cargado ya la clave en el nivel compartido
+            shared_value = self._load_shared(key, ttl)
+            if shared_value is not None:
+                flight.value = shared_value
+                return None if background else self._copy_out(shared_value)
+            
+            load_started = time.perf_counter()
+            value = loader()
+            created_at = time.time()
+            with self._lock:
+                self._record_load(key, time.perf_counter() - load_started)
+                stored = None
+                # Si hubo invalidaciones durante la carga, el resultado puede estar obsoleto
+                if flight.epoch == self._epoch and self._store_local(key, value, created_at, tags):
+                    stored = self._cache.get(key)
+                share = stored is not None
+                if stored is None and isinstance(value, (pd.DataFrame, pd.Series)):
+                    stored = self._freeze(value)
+                # Los que esperan reciben copias del valor almacenado; el dueño conserva el original
+                flight.value = stored if stored is not None else value
+                if background:
+                    self.refresh_count += 1
+            if share and self._shared is not None:
+                self._shared.set(key, value, created_at, tags)
+            return value
+        except Exception as e:
+            flight.error = e
+            if background:
+                with self._lock:
+                    self.refresh_error_count += 1
+                print(f"[CACHE] Error refrescando clave {key[:24]}: {e}")
+                return None
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+            flight.event.set()
+    
+    def configure(self, max_entries=None, max_bytes=None):
+        """Ajusta los límites del cache en caliente y expulsa lo que sobre"""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict_if_needed()
+    
+    def invalidate_tags(self, *tags):
+        """Elimina todas las entradas registradas bajo cualquiera de las etiquetas"""
+        with self._lock:
+            keys_to_remove = set()
+            for tag in tags:
+                keys_to_remove.update(self._tag_index.get(tag, ()))
+            for key in keys_to_remove:
+                self._remove(key)
+            self._epoch += 1
+        if self._shared is not None:
+            self._shared.invalidate_tags(*tags)
+        return len(keys_to_remove)
     
     def invalidate_pattern(self, pattern):
+        """Invalidación por subcadena (O(n)); preferir invalidate_tags"""
         with self._lock:
             keys_to_remove = [key for key in self._cache.keys() if pattern in key]
             for key in keys_to_remove:
-                del self._cache[key]
-                del self._timestamps[key]
+                self._remove(key)
+            self._epoch += 1
+        if self._shared is not None:
+            self._shared.invalidate_pattern(pattern)
+    
+    def reset_stats(self):
+        with self._lock:
+            self.hit_count = 0
+            self.miss_count = 0
+            self.eviction_count = 0
+            self.evicted_bytes = 0
+            self.expired_count = 0
+            self.rejected_count = 0
+            self.coalesced_count = 0
+            self.stale_hit_count = 0
+            self.refresh_count = 0
+            self.refresh_error_count = 0
+            self.shared_hit_count = 0
+            self._miss_started.clear()
+            # Conservar los contadores de ocupación (items/bytes) de lo que sigue en cache
+            for stats in self._family_stats.values():
+                stats.hits = stats.misses = stats.evictions = stats.loads = 0
+                stats.load_time = 0.0
     
     def clear_all(self):
         with self._lock:
             self._cache.clear()
             self._timestamps.clear()
-            self.hit_count = 0
-            self.miss_count = 0
+            self._sizes.clear()
+            self._total_bytes = 0
+            self._tag_index.clear()
+            self._key_tags.clear()
+            self._family_stats.clear()
+            self._epoch += 1
+            self.reset_stats()
+        if self._shared is not None:
+            self._shared.clear()
     
     def get_stats(self):
-        total = self.hit_count + self.miss_count
-        hit_rate = (self.hit_count / total * 100) if total > 0 else 0
-        return {
-            'hits': self.hit_count,
-            'misses': self.miss_count,
-            'hit_rate': hit_rate,
-            'cached_items': len(self._cache)
-        }
+        with self._lock:
+            total = self.hit_count + self.miss_count
+            hit_rate = (self.hit_count / total * 100) if total > 0 else 0
+            return {
+                'hits': self.hit_count,
+                'misses': self.miss_count,
+                'hit_rate': hit_rate,
+                'cached_items': len(self._cache),
+                'cached_bytes': self._total_bytes,
+                'cached_tags': len(self._tag_index),
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'read_only': self.read_only,
+                'evictions': self.eviction_count,
+                'evicted_bytes': self.evicted_bytes,
+                'expirations': self.expired_count,
+                'rejected': self.rejected_count,
+                'coalesced': self.coalesced_count,
+                'stale_hits': self.stale_hit_count,
+                'refreshes': self.refresh_count,
+                'refresh_errors': self.refresh_error_count,
+                'inflight': len(self._inflight),
+                'shared_hits': self.shared_hit_count,
+                'shared': self._shared.get_stats() if self._shared is not None else None,
+                'families': self._family_snapshot()
+            }
+    
+    def get_family_stats(self):
+        """Instantánea de las estadísticas por familia de claves"""
+        with self._lock:
+            return self._family_snapshot()
+    
+    def _family_snapshot(self):
+        """Lista de dicts por familia ordenada por nombre (requiere el lock)"""
+        snapshot = []
+        for family in sorted(self._family_stats):
+            stats = self._family_stats[family]
+            total = stats.hits + stats.misses
+            snapshot.append({
+                'family': family,
+                'hits': stats.hits,
+                'misses': stats.misses,
+                'hit_rate': (stats.hits / total * 100) if total > 0 else 0,
+                'evictions': stats.evictions,
+                'cached_items': stats.cached_items,
+                'cached_bytes': stats.cached_bytes,
+                'loads': stats.loads,
+                'avg_load_ms': (stats.load_time / stats.loads * 1000) if stats.loads else 0
+            })
+        return snapshot
+
+# Versiones por tabla: cada escritura incrementa la versión de las tablas modificadas.
+# Las consultas cacheadas incluyen en su clave la versión de las tablas que leen, de modo
+# que un resultado es válido exactamente hasta que alguna de esas tablas cambia; el TTL
+# queda como red de seguridad (p. ej. escrituras hechas por otro proceso).
+class TableVersionRegistry:
+    def __init__(self, shared_tier=None):
+        self._versions = {}
+        self._lock = threading.Lock()
+        # Con nivel compartido, las versiones viven en el archivo común para que una
+        # escritura en un proceso invalide las claves de todos los demás
+        self._shared = shared_tier
+    
+    def get(self, table):
+        return dict(self.snapshot([table])).get(table, 0)
+    
+    def snapshot(self, tables):
+        """Devuelve una tupla (tabla, versión) estable para construir claves de cache"""
+        tables = sorted(tables)
+        if self._shared is not None:
+            try:
+                versions = self._shared.get_versions(tables)
+                return tuple((table, versions.get(table, 0)) for table in tables)
+            except Exception as e:
+                print(f"[CACHE L2] Error leyendo versiones de tablas: {e}")
+        with self._lock:
+            return tuple((table, self._versions.get(table, 0)) for table in tables)
+    
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+        if self._shared is not None and tables:
+            try:
+                self._shared.bump_versions(tables)
+            except Exception as e:
+                print(f"[CACHE L2] Error incrementando versiones de tablas: {e}")
+    
+    def as_dict(self):
+        if self._shared is not None:
+            try:
+                return self._shared.get_all_versions()
+            except Exception:
+                pass
+        with self._lock:
+            return dict(self._versions)
 
-# Instancia global del cache
-_db_cache = DatabaseCache(default_ttl=60)
+def _create_shared_cache_tier(settings):
+    """Crea el nivel de cache compartido si está configurado (GL_SHARED_CACHE_PATH)"""
+    if not settings.get('shared_path'):
+        return None
+    try:
+        from shared_cache import SharedCacheTier
+        tier = SharedCacheTier(settings['shared_path'], max_bytes=settings['shared_max_bytes'])
+        print(f"[GREEN LOGISTICS] Cache compartido habilitado en {settings['shared_path']}")
+        return tier
+    except Exception as e:
+        print(f"[GREEN LOGISTICS] Advertencia: cache compartido deshabilitado: {e}")
+        return None
 
-# Connection pool simple
+_cache_settings = get_cache_settings()
+_shared_cache_tier = _create_shared_cache_tier(_cache_settings)
+_table_versions = TableVersionRegistry(shared_tier=_shared_cache_tier)
+
+# TTL para tablas de lectura predominante: largo solo si las versiones de tabla se comparten
+# entre procesos (cache compartido); si no, otros procesos no ven los cambios y se usa el TTL base
+READ_MOSTLY_CACHE_TTL = 6 * 60 * 60 if _shared_cache_tier is not None else 300
+
+# Instancia global del cache (límites configurables vía config.get_cache_settings)
+_db_cache = DatabaseCache(
+    default_ttl=60,
+    max_entries=_cache_settings['max_entries'],
+    max_bytes=_cache_settings['max_bytes'],
+    read_only=_cache_settings['read_only'],
+    shared_tier=_shared_cache_tier
+)
+
+# Mensajes que delatan un socket/conexión caídos (sqlitecloud no expone un tipo común)
+_CONNECTION_ERROR_MARKERS = ('connection', 'socket', 'broken pipe', 'closed', 'reset by peer', 'timed out', 'eof')
+_READ_STATEMENT_PREFIXES = ('SELECT', 'WITH', 'PRAGMA', 'EXPLAIN')
+
+def _is_connection_error(exc):
+    """Indica si una excepción corresponde a una conexión perdida y no a un error SQL"""
+    if isinstance(exc, (ConnectionError, TimeoutError, OSError)):
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in _CONNECTION_ERROR_MARKERS)
+
+class _PooledCursor:
+    """Cursor que reintenta en una conexión nueva si el socket se cayó"""
+    def __init__(self, owner, cursor, args, kwargs):
+        self._owner = owner
+        self._cursor = cursor
+        self._args = args
+        self._kwargs = kwargs
+    
+    def execute(self, query, *params):
+        try:
+            result = self._cursor.execute(query, *params)
+        except Exception as e:
+            if not self._owner._should_reconnect(e):
+                raise
+            self._cursor = self._owner._raw.cursor(*self._args, **self._kwargs)
+            result = self._cursor.execute(query, *params)
+        self._owner._track_statement(query)
+        return self if result is self._cursor else result
+    
+    def executemany(self, query, seq_of_params):
+        result = self._cursor.executemany(query, seq_of_params)
+        self._owner._track_statement(query)
+        return self if result is self._cursor else result
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class _PooledConnection:
+    """Conexión física del pool con seguimiento de uso y reconexión transparente.
+
+    Guarda cuándo se usó por última vez (para decidir si hace falta un ping) y,
+    si el socket se cae durante una consulta, reconecta y reintenta una vez
+    siempre que no haya escrituras pendientes de commit en esa conexión.
+    """
+    def __init__(self, pool, raw_conn):
+        self._pool = pool
+        self._raw = raw_conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.broken = False
+        self._dirty = False
+    
+    def _track_statement(self, query):
+        if not query.lstrip().upper().startswith(_READ_STATEMENT_PREFIXES):
+            self._dirty = True
+    
+    def _should_reconnect(self, exc):
+        """Marca la conexión como rota y reconecta si es seguro reintentar"""
+        if not _is_connection_error(exc):
+            return False
+        self.broken = True
+        if self._dirty:
+            # Había escrituras sin commit: reintentar las perdería en silencio
+            return False
+        try:
+            self._raw.close()
+        except Exception:
+            pass
+        self._raw = get_raw_db_connection()
+        self.created_at = time.monotonic()
+        self.broken = False
+        self._pool._count_reconnect()
+        return True
+    
+    def execute(self, query, *params):
+        try:
+            result = self._raw.execute(query, *params)
+        except Exception as e:
+            if not self._should_reconnect(e):
+                raise
+            result = self._raw.execute(query, *params)
+        self._track_statement(query)
+        return result
+    
+    def executemany(self, query, seq_of_params):
+        result = self._raw.executemany(query, seq_of_params)
+        self._track_statement(query)
+        return result
+    
+    def cursor(self, *args, **kwargs):
+        try:
+            cursor = self._raw.cursor(*args, **kwargs)
+        except Exception as e:
+            if not self._should_reconnect(e):
+                raise
+            cursor = self._raw.cursor(*args, **kwargs)
+        return _PooledCursor(self, cursor, args, kwargs)
+    
+    def commit(self):
+        try:
+            return self._raw.commit()
+        except Exception as e:
+            if _is_connection_error(e):
+                self.broken = True
+            raise
+        finally:
+            self._dirty = False
+    
+    def rollback(self):
+        try:
+            return self._raw.rollback()
+        except Exception as e:
+            if _is_connection_error(e):
+                self.broken = True
+            raise
+        finally:
+            self._dirty = False
+    
+    def close_physical(self):
+        try:
+            self._raw.close()
+        except Exception:
+            pass
+    
+    def close(self):
+        """Compatibilidad: cerrar una conexión del pool la devuelve al pool"""
+        self._pool.return_connection(self)
+    
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class PoolTimeoutError(TimeoutError):
+    """No se liberó ninguna conexión del pool dentro del tiempo de espera"""
+    pass
+
+# Connection pool acotado: como máximo `max_open` conexiones abiertas (en uso + inactivas)
 class ConnectionPool:
-    def __init__(self, max_connections=5):
+    def __init__(self, max_connections=5, ping_idle_seconds=30, max_open=10, checkout_timeout=10,
+                 max_age=1800, idle_timeout=300, min_idle=0):
         self._connections = []
+        # Máximo de conexiones inactivas que se conservan para reutilizar
         self._max_connections = max_connections
+        # Las conexiones usadas hace menos de este tiempo se entregan sin ping
+        self._ping_idle_seconds = ping_idle_seconds
+        self._max_open = max_open
+        self._checkout_timeout = checkout_timeout
+        # Conexiones más viejas que max_age o inactivas más de idle_timeout se cierran (0 = sin límite)
+        self._max_age = max_age
+        self._idle_timeout = idle_timeout
+        # Conexiones inactivas que el reaping respeta (las precalentadas por el keep-alive)
+        self._min_idle = min(min_idle, max_connections, max_open)
         self._lock = threading.RLock()
+        self._available = threading.Condition(self._lock)
+        self._open_count = 0
+        self.pings_performed = 0
+        self.pings_skipped = 0
+        self.ping_failures = 0
+        self.reconnects = 0
+        self.discarded = 0
+        self.created = 0
+        self.destroyed = 0
+        self.reaped = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.prewarmed = 0
+        self.heartbeats = 0
+        self.heartbeat_failures = 0
 
     def _is_connection_usable(self, conn) -> bool:
         """Verifica si una conexión sigue viva.
@@ -102,7 +765,7 @@ class ConnectionPool:
             return False
         try:
             # DB-API: Connection.execute existe en sqlite3 y sqlitecloud.
-            cur = conn.execute("SELECT 1")
+            cur = conn._raw.execute("SELECT 1")
             try:
                 cur.fetchone()
             except Exception:
@@ -113,31 +776,254 @@ class ConnectionPool:
         except Exception:
             return False
     
+    def _count_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+            self.created += 1
+            self.destroyed += 1
+    
+    def _is_too_old(self, conn, now):
+        return bool(self._max_age) and now - conn.created_at > self._max_age
+    
+    def _release_slot(self, conn):
+        """Cierra una conexión y libera su lugar en el pool (requiere el lock)"""
+        self._open_count -= 1
+        self.destroyed += 1
+        conn.close_physical()
+        self._available.notify()
+    
+    def _reap_idle(self, now):
+        """Cierra conexiones inactivas demasiado tiempo o demasiado viejas (requiere el lock)"""
+        for conn in list(self._connections):
+            idle_expired = (self._idle_timeout and now - conn.last_used > self._idle_timeout
+                            and len(self._connections) > self._min_idle)
+            if idle_expired or self._is_too_old(conn, now):
+                self._connections.remove(conn)
+                self.reaped += 1
+                self._release_slot(conn)
+    
     def get_connection(self):
+        started = time.monotonic()
+        waited = False
+        with self._available:
+            while True:
+                now = time.monotonic()
+                self._reap_idle(now)
+                if self._connections:
+                    conn = self._connections.pop()
+                    # Conexión usada recientemente: el socket sigue vivo, evitar el round-trip
+                    if now - conn.last_used <= self._ping_idle_seconds:
+                        self.pings_skipped += 1
+                        self._record_checkout(started, waited)
+                        return conn
+                    self.pings_performed += 1
+                    if self._is_connection_usable(conn):
+                        self._record_checkout(started, waited)
+                        return conn
+                    self.ping_failures += 1
+                    self._release_slot(conn)
+                    continue
+                if self._open_count < self._max_open:
+                    # Reservar el lugar y conectar fuera del lock
+                    self._open_count += 1
+                    break
+                remaining = self._checkout_timeout - (now - started)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(
+                        f"No hay conexiones disponibles ({self._max_open} en uso) tras {self._checkout_timeout}s"
+                    )
+                waited = True
+                self._available.wait(remaining)
+        
+        try:
+            conn = _PooledConnection(self, get_raw_db_connection())
+        except Exception:
+            with self._available:
+                self._open_count -= 1
+                self._available.notify()
+            raise
         with self._lock:
-            while self._connections:
-                conn = self._connections.pop()
-                if self._is_connection_usable(conn):
-                    return conn
+            self.created += 1
+            self._record_checkout(started, waited)
+        return conn
+    
+    def _record_checkout(self, started, waited):
+        """Registra la espera de una entrega de conexión (requiere el lock)"""
+        elapsed = time.monotonic() - started
+        self.checkouts += 1
+        if waited:
+            self.waits += 1
+        self.total_wait_time += elapsed
+        self.max_wait_time = max(self.max_wait_time, elapsed)
+    
+    def return_connection(self, conn):
+        with self._available:
+            if not isinstance(conn, _PooledConnection):
+                # Conexión creada fuera del pool: adoptarla sin exceder el máximo
+                if self._open_count >= self._max_open:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    return
+                self._open_count += 1
+                self.created += 1
+                conn = _PooledConnection(self, conn)
+            if conn in self._connections:
+                return
+            if conn.broken:
+                # Error de socket durante una consulta: no reutilizar
+                self.discarded += 1
+                self._release_slot(conn)
+                return
+            if conn._dirty:
+                # Escrituras sin commit: no heredarlas al siguiente usuario
                 try:
-                    conn.close()
+                    conn.rollback()
                 except Exception:
-                    pass
-
-            # No hay conexiones o todas estaban muertas
-            return get_raw_db_connection()
+                    self._release_slot(conn)
+                    return
+            now = time.monotonic()
+            if self._is_too_old(conn, now) or len(self._connections) >= self._max_connections:
+                self._release_slot(conn)
+                return
+            conn.last_used = now
+            self._connections.append(conn)
+            self._available.notify()
     
-    def return_connection(self, conn):
-        with self._lock:
-            if len(self._connections) < self._max_connections:
+    def prewarm(self, count=None):
+        """Abre conexiones hasta tener `count` inactivas (por defecto min_idle), sin bloquear checkouts"""
+        target = self._min_idle if count is None else min(count, self._max_connections)
+        opened = 0
+        while True:
+            with self._lock:
+                if len(self._connections) >= target or self._open_count >= self._max_open:
+                    return opened
+                self._open_count += 1
+            try:
+                conn = _PooledConnection(self, get_raw_db_connection())
+            except Exception as e:
+                with self._available:
+                    self._open_count -= 1
+                    self._available.notify()
+                print(f"[GREEN LOGISTICS] Error precalentando conexión: {e}")
+                return opened
+            with self._available:
+                self.created += 1
+                self.prewarmed += 1
                 self._connections.append(conn)
-            else:
-                try:
-                    conn.close()
-                except:
-                    pass
+                self._available.notify()
+            opened += 1
+    
+    def heartbeat(self, interval):
+        """Hace ping a las conexiones inactivas más de `interval` segundos para mantener vivo el socket.
 
-_connection_pool = ConnectionPool()
+        Las conexiones se sacan de la lista mientras se verifican, de modo que el
+        ping (un round-trip remoto) ocurre fuera del lock y no retrasa checkouts.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._reap_idle(now)
+            stale = [conn for conn in self._connections if now - conn.last_used >= interval]
+            for conn in stale:
+                self._connections.remove(conn)
+        
+        for conn in stale:
+            alive = self._is_connection_usable(conn)
+            with self._available:
+                self.heartbeats += 1
+                if alive:
+                    conn.last_used = time.monotonic()
+                    self._connections.append(conn)
+                    self._available.notify()
+                else:
+                    self.heartbeat_failures += 1
+                    self._release_slot(conn)
+        
+        # Reponer las conexiones cerradas por antigüedad o por fallar el heartbeat
+        self.prewarm()
+        return len(stale)
+    
+    def get_stats(self):
+        with self._lock:
+            checkouts = self.pings_performed + self.pings_skipped
+            return {
+                'open_connections': self._open_count,
+                'in_use_connections': self._open_count - len(self._connections),
+                'idle_connections': len(self._connections),
+                'max_open': self._max_open,
+                'max_connections': self._max_connections,
+                'checkout_timeout': self._checkout_timeout,
+                'max_age': self._max_age,
+                'idle_timeout': self._idle_timeout,
+                'checkouts': self.checkouts,
+                'checkout_waits': self.waits,
+                'checkout_timeouts': self.timeouts,
+                'avg_checkout_wait_ms': (self.total_wait_time / self.checkouts * 1000) if self.checkouts else 0,
+                'max_checkout_wait_ms': self.max_wait_time * 1000,
+                'created': self.created,
+                'destroyed': self.destroyed,
+                'reaped': self.reaped,
+                'min_idle': self._min_idle,
+                'prewarmed': self.prewarmed,
+                'heartbeats': self.heartbeats,
+                'heartbeat_failures': self.heartbeat_failures,
+                'ping_idle_seconds': self._ping_idle_seconds,
+                'pings_performed': self.pings_performed,
+                'pings_skipped': self.pings_skipped,
+                'ping_skip_rate': (self.pings_skipped / checkouts * 100) if checkouts else 0,
+                'ping_failures': self.ping_failures,
+                'reconnects': self.reconnects,
+                'discarded': self.discarded
+            }
+
+_pool_settings = get_pool_settings()
+_connection_pool = ConnectionPool(
+    max_connections=_pool_settings['max_idle'],
+    ping_idle_seconds=_pool_settings['ping_idle_seconds'],
+    max_open=_pool_settings['max_open'],
+    checkout_timeout=_pool_settings['checkout_timeout'],
+    max_age=_pool_settings['max_age'],
+    idle_timeout=_pool_settings['idle_timeout'],
+    min_idle=_pool_settings['prewarm']
+)
+_keepalive_lock = threading.Lock()
+_keepalive_started = False
+
+def _connection_keepalive_loop(heartbeat_seconds, keepalive):
+    """Precalienta el pool y, si está habilitado, mantiene vivas las conexiones inactivas"""
+    try:
+        opened = _connection_pool.prewarm()
+        if opened:
+            print(f"[GREEN LOGISTICS] Pool precalentado con {opened} conexiones")
+    except Exception as e:
+        print(f"[GREEN LOGISTICS] Error precalentando el pool: {e}")
+    
+    while keepalive:
+        time.sleep(heartbeat_seconds)
+        try:
+            _connection_pool.heartbeat(heartbeat_seconds)
+        except Exception as e:
+            print(f"[GREEN LOGISTICS] Error en keep-alive del pool: {e}")
+
+def start_connection_keepalive():
+    """Inicia (una vez por proceso) el precalentamiento del pool y el hilo de keep-alive"""
+    global _keepalive_started
+    if not _pool_settings['prewarm'] and not _pool_settings['keepalive']:
+        return False
+    with _keepalive_lock:
+        if _keepalive_started:
+            return False
+        _keepalive_started = True
+    heartbeat_seconds = max(1, _pool_settings['heartbeat_seconds'])
+    threading.Thread(
+        target=_connection_keepalive_loop,
+        args=(heartbeat_seconds, _pool_settings['keepalive']),
+        name="db-pool-keepalive",
+        daemon=True
+    ).start()
+    return True
 
 
 class PooledConnectionProxy:
@@ -160,6 +1046,13 @@ class PooledConnectionProxy:
             self._returned = True
             self._conn = None
 
+    def __del__(self):
+        # Un proxy descartado sin close() no debe ocupar un lugar del pool para siempre
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def __enter__(self):
         return self
 
@@ -190,10 +1083,113 @@ def clear_cache_pattern(pattern):
     """Limpia entradas específicas del cache que contengan el patrón"""
     _db_cache.invalidate_pattern(pattern)
 
+def client_tag(client_id):
+    """Etiqueta de cache para entradas acotadas a un cliente"""
+    return f"client:{int(client_id)}"
+
+def table_tag(table):
+    """Etiqueta de cache para lecturas no acotadas de una tabla"""
+    return f"table:{table}"
+
+def month_tag(year, month):
+    """Etiqueta de cache para lecturas de calculated_dates acotadas a un mes"""
+    return f"month:{int(year)}-{int(month):02d}"
+
+_TABLE_REFERENCE_RE = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+def get_query_tables(query):
+    """Extrae las tablas referenciadas en FROM/JOIN de una consulta"""
+    return sorted({name.lower() for name in _TABLE_REFERENCE_RE.findall(query)})
+
+def invalidate_cache_tags(*tags):
+    """Invalida las entradas del cache registradas bajo las etiquetas indicadas"""
+    return _db_cache.invalidate_tags(*tags)
+
+def mark_tables_changed(*tables):
+    """Registra una escritura: incrementa la versión de las tablas e invalida sus lecturas completas.
+
+    Dentro de transaction() se aplica tras el COMMIT (y devuelve 0).
+    """
+    removed = []
+    
+    def apply():
+        _sync_replica_after_write(tables)
+        removed.append(_bump_tables(tables))
+    
+    _run_after_commit(apply)
+    return sum(removed)
+
+# Funciones llamadas con las tablas modificadas tras cada escritura confirmada (ver add_table_change_listener)
+_table_change_listeners = []
+
+def add_table_change_listener(callback):
+    """Registra `callback(tables)` para caches fuera de este módulo que dependen de tablas"""
+    if callback not in _table_change_listeners:
+        _table_change_listeners.append(callback)
+
+def _bump_tables(tables):
+    """Incrementa la versión de las tablas e invalida sus lecturas completas"""
+    _table_versions.bump(*tables)
+    for listener in list(_table_change_listeners):
+        try:
+            listener(tables)
+        except Exception as e:
+            print(f"[CACHE] Error notificando cambio de tablas {tables}: {e}")
+    return _db_cache.invalidate_tags(*[table_tag(table) for table in tables])
+
+def invalidate_client_cache(client_ids, tables=()):
+    """Invalida el cache de uno o varios clientes tras una escritura.
+
+    Elimina las entradas acotadas a esos clientes (`client:<id>`) y marca como
+    modificadas las tablas indicadas (ver mark_tables_changed). Dentro de
+    transaction() se aplica tras el COMMIT.
+    """
+    if not isinstance(client_ids, (list, tuple, set)):
+        client_ids = [client_ids]
+    removed = []
+    
+    def apply():
+        # La réplica local se actualiza antes de invalidar, para que las recargas no lean datos viejos
+        _sync_replica_after_write(tables)
+        removed.append(_db_cache.invalidate_tags(*[client_tag(client_id) for client_id in client_ids]))
+        removed.append(_bump_tables(tables))
+    
+    _run_after_commit(apply)
+    return sum(removed)
+
+def invalidate_calendar_cache(client_id, months):
+    """Invalida el cache tras editar fechas puntuales de un cliente.
+
+    A diferencia de invalidate_client_cache no incrementa la versión de
+    calculated_dates: solo elimina las entradas del cliente y las lecturas de los
+    meses `months` ((año, mes)) tocados. Dentro de transaction() se aplica tras el COMMIT.
+    """
+    removed = []
+    
+    def apply():
+        _sync_replica_after_write(['calculated_dates'])
+        tags = [client_tag(client_id)] + [month_tag(year, month) for year, month in sorted(set(months))]
+        removed.append(_db_cache.invalidate_tags(*tags))
+    
+    _run_after_commit(apply)
+    return sum(removed)
+
+def get_table_versions():
+    """Versiones actuales por tabla (para debugging/monitoreo)"""
+    return _table_versions.as_dict()
+
 def get_cache_stats():
     """Obtiene estadísticas del cache para monitoreo"""
     return _db_cache.get_stats()
 
+def get_cache_family_stats():
+    """Estadísticas del cache por familia de claves (clients, client, dates, query-hash...)"""
+    return _db_cache.get_family_stats()
+
+def get_connection_pool_stats():
+    """Estadísticas del pool: pings realizados vs. omitidos, reconexiones y descartes"""
+    return _connection_pool.get_stats()
+
 def debug_cache_keys():
     """Lista todas las claves del cache para debugging"""
     with _db_cache._lock:
@@ -201,9 +1197,7 @@ def debug_cache_keys():
 
 def reset_cache_stats():
     """Reinicia las estadísticas del cache"""
-    with _db_cache._lock:
-        _db_cache.hit_count = 0
-        _db_cache.miss_count = 0
+    _db_cache.reset_stats()
 
 def get_raw_db_connection():
     """Obtiene una conexión *real* a la base de datos según el entorno."""
@@ -226,155 +1220,1091 @@ def return_pooled_connection(conn):
     """Retorna una conexión al pool"""
     _connection_pool.return_connection(conn)
 
-def execute_query(query, params=None, use_pool=True):
-    """Ejecuta una consulta de manera compatible con ambos tipos de BD con pooling opcional"""
-    if use_pool:
-        conn = get_pooled_connection()
-    else:
-        conn = get_db_connection()
+# === UNIDAD DE TRABAJO: transaction() / read() ===
+#
+#     with transaction() as tx:       # BEGIN ... COMMIT (ROLLBACK si hay excepción)
+#         tx.execute(...)
+#         crear_otra_cosa()           # helper con su propio transaction(): SAVEPOINT
+#
+#     with read() as cursor:          # solo lectura, sin transacción
+#         cursor.execute(...)
+#
+# Dentro de un mismo hilo, los bloques anidados (y execute_query_df) reutilizan la
+# misma conexión: una operación lógica hace un solo checkout del pool y un commit.
+
+class _UnitOfWork:
+    """Conexión compartida por las operaciones anidadas de un hilo"""
+    def __init__(self, conn):
+        self.conn = conn
+        # Transacciones abiertas: la primera es BEGIN, las anidadas son SAVEPOINT
+        self.depth = 0
+        self.savepoint_seq = 0
+        # Invalidaciones de cache diferidas hasta el COMMIT externo
+        self.after_commit = []
+
+_unit_of_work = threading.local()
+
+class TransactionCursor:
+    """Cursor entregado por transaction(); `rollback()` descarta el bloque sin lanzar excepción"""
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.rollback_only = False
+    
+    def rollback(self):
+        self.rollback_only = True
     
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def _current_unit():
+    return getattr(_unit_of_work, 'current', None)
+
+@contextmanager
+def _unit_scope():
+    """Entrega la unidad de trabajo del hilo, creándola (un checkout) si no existe"""
+    unit = _current_unit()
+    if unit is not None:
+        yield unit
+        return
+    unit = _UnitOfWork(get_pooled_connection())
+    _unit_of_work.current = unit
     try:
-        if params:
-            result = conn.execute(query, params)
-        else:
-            result = conn.execute(query)
-        
-        # Para queries que devuelven datos
-        if query.strip().upper().startswith('SELECT'):
-            return result.fetchall()
-        else:
-            conn.commit()
-            return result
+        yield unit
     finally:
-        if use_pool:
-            return_pooled_connection(conn)
+        _unit_of_work.current = None
+        return_pooled_connection(unit.conn)
+
+@contextmanager
+def read():
+    """Cursor de solo lectura sobre la conexión de la unidad de trabajo actual"""
+    with _unit_scope() as unit:
+        yield unit.conn.cursor()
+
+@contextmanager
+def transaction(immediate=False):
+    """Bloque transaccional: COMMIT al salir, ROLLBACK si hay excepción o tx.rollback().
+
+    Anidado dentro de otro transaction() usa un SAVEPOINT, de modo que el bloque
+    interno se puede deshacer sin afectar al externo. Las invalidaciones de cache
+    hechas dentro se aplican tras el COMMIT externo. `immediate` toma el candado de
+    escritura al empezar (BEGIN IMMEDIATE), para que lo leído al inicio no cambie
+    antes del COMMIT; se ignora en bloques anidados.
+    """
+    with _unit_scope() as unit:
+        cursor = unit.conn.cursor()
+        if unit.depth == 0:
+            savepoint = None
+            cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
         else:
-            conn.close()
+            unit.savepoint_seq += 1
+            savepoint = f"sp_{unit.savepoint_seq}"
+            cursor.execute(f"SAVEPOINT {savepoint}")
+        unit.depth += 1
+        tx = TransactionCursor(cursor)
+        try:
+            yield tx
+        except BaseException:
+            unit.depth -= 1
+            _end_transaction(unit, cursor, savepoint, commit=False)
+            raise
+        unit.depth -= 1
+        _end_transaction(unit, cursor, savepoint, commit=not tx.rollback_only)
+
+def _end_transaction(unit, cursor, savepoint, commit):
+    """Cierra un bloque de transaction(): COMMIT/RELEASE o ROLLBACK/ROLLBACK TO"""
+    if savepoint is not None:
+        if not commit:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+        return
+    
+    callbacks, unit.after_commit = unit.after_commit, []
+    if not commit:
+        try:
+            unit.conn.rollback()
+        except Exception as e:
+            print(f"Error en rollback: {e}")
+        return
+    try:
+        unit.conn.commit()
+    except Exception:
+        try:
+            unit.conn.rollback()
+        except Exception:
+            pass
+        raise
+    for callback in callbacks:
+        callback()
+
+def _run_after_commit(callback):
+    """Ejecuta `callback` ahora o, dentro de transaction(), después del COMMIT externo"""
+    unit = _current_unit()
+    if unit is not None and unit.depth > 0:
+        unit.after_commit.append(callback)
+        return False
+    callback()
+    return True
+
+def _cacheable(use_cache):
+    """Dentro de una transacción abierta no se cachean lecturas aún no confirmadas"""
+    unit = _current_unit()
+    return use_cache and not (unit is not None and unit.depth > 0)
+
+# === MEDICIÓN DE CONSULTAS Y LOG DE CONSULTAS LENTAS ===
+
+# Listas de parámetros de longitud variable: "IN (?, ?, ?)" cuenta como la misma sentencia
+_PLACEHOLDER_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_EXPLAINABLE_PREFIXES = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')
+# Un plan ya capturado no se vuelve a pedir antes de estos segundos
+_EXPLAIN_REFRESH_SECONDS = 600
+# Filas muestreadas para estimar bytes sin recorrer todo el resultado
+_SIZE_SAMPLE_ROWS = 200
+
+def normalize_query(query):
+    """Texto canónico de una sentencia para agrupar sus métricas"""
+    return _PLACEHOLDER_LIST_RE.sub('(?, ...)', ' '.join(query.split()))
+
+def _estimate_result_bytes(result):
+    """Bytes aproximados de un resultado (DataFrame o lista de filas), extrapolando una muestra"""
+    try:
+        if isinstance(result, pd.DataFrame):
+            if len(result) <= _SIZE_SAMPLE_ROWS:
+                return int(result.memory_usage(index=False, deep=True).sum())
+            sample = result.head(_SIZE_SAMPLE_ROWS)
+            return int(sample.memory_usage(index=False, deep=True).sum() * len(result) / _SIZE_SAMPLE_ROWS)
+        if isinstance(result, list) and result:
+            sample = result[:_SIZE_SAMPLE_ROWS]
+            sample_bytes = sum(
+                len(value) if isinstance(value, (str, bytes)) else 8
+                for row in sample for value in row
+            )
+            return int(sample_bytes * len(result) / len(sample))
+    except Exception:
+        pass
+    return 0
+
+def _query_caller():
+    """Primer llamador fuera de database.py (y de Streamlit), como `modulo.funcion:linea`.
+
+    Los helpers privados (p. ej. dashboard_components._cached_query_df) se
+    reportan junto con su propio llamador.
+    """
+    frame = sys._getframe(1)
+    parts = []
+    while frame is not None and len(parts) < 2:
+        code = frame.f_code
+        filename = code.co_filename
+        if filename != __file__ and f"{os.sep}streamlit{os.sep}" not in filename:
+            module = os.path.splitext(os.path.basename(filename))[0]
+            parts.append(f"{module}.{code.co_name}:{frame.f_lineno}")
+            if not code.co_name.startswith('_'):
+                break
+        frame = frame.f_back
+    return " < ".join(parts) if parts else "database"
+
+def _explain_query_plan(cursor, query, params=None):
+    """Salida de EXPLAIN QUERY PLAN (una línea por paso) para una sentencia"""
+    if not query.lstrip().upper().startswith(_EXPLAINABLE_PREFIXES):
+        return None
+    explain_sql = f"EXPLAIN QUERY PLAN {query}"
+    rows = cursor.execute(explain_sql, params).fetchall() if params else cursor.execute(explain_sql).fetchall()
+    return "\n".join(str(row[-1]) for row in rows)
+
+class _StatementStats:
+    """Métricas acumuladas de una sentencia normalizada"""
+    __slots__ = ('count', 'total_ms', 'max_ms', 'rows', 'bytes', 'slow_count',
+                 'last_caller', 'last_source', 'last_at', 'plan', 'plan_at')
+    
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.slow_count = 0
+        self.last_caller = None
+        self.last_source = None
+        self.last_at = 0
+        self.plan = None
+        self.plan_at = 0
+
+class QueryProfiler:
+    """Tiempo, filas, bytes y llamador por sentencia, con log acotado de consultas lentas.
+
+    Las sentencias se agrupan por texto normalizado (LRU de `max_statements`).
+    Cada ejecución por encima de `slow_ms` entra al log de lentas con su plan
+    (EXPLAIN QUERY PLAN), que se pide como mucho una vez cada
+    _EXPLAIN_REFRESH_SECONDS por sentencia.
+    """
+    
+    def __init__(self, slow_ms=250, slow_log_size=100, top_n=20, max_statements=500,
+                 explain=True, enabled=True):
+        self.slow_ms = slow_ms
+        self.top_n = top_n
+        self.max_statements = max_statements
+        self.explain = explain
+        self.enabled = enabled
+        self._statements = OrderedDict()
+        self._slow_log = deque(maxlen=max(slow_log_size, 1))
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.slow_queries = 0
+        self.explain_failures = 0
+    
+    def record(self, query, params, elapsed_ms, rows, nbytes, caller, source='primary', explain=None):
+        """Registra una ejecución; `explain()` devuelve el plan y solo se llama si fue lenta"""
+        if not self.enabled:
+            return
+        sql = normalize_query(query)
+        now = time.time()
+        is_slow = elapsed_ms >= self.slow_ms
+        need_plan = False
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                stats = self._statements[sql] = _StatementStats()
+                if self.max_statements and len(self._statements) > self.max_statements:
+                    self._statements.popitem(last=False)
+            else:
+                self._statements.move_to_end(sql)
+            stats.count += 1
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            stats.rows += rows or 0
+            stats.bytes += nbytes or 0
+            stats.last_caller = caller
+            stats.last_source = source
+            stats.last_at = now
+            self.recorded += 1
+            if is_slow:
+                stats.slow_count += 1
+                self.slow_queries += 1
+                need_plan = (self.explain and explain is not None
+                             and now - stats.plan_at > _EXPLAIN_REFRESH_SECONDS)
+                if need_plan:
+                    stats.plan_at = now
+            plan = stats.plan
+        
+        if not is_slow:
+            return
+        if need_plan:
+            try:
+                plan = explain()
+            except Exception as e:
+                self.explain_failures += 1
+                plan = f"(EXPLAIN no disponible: {e})"
+            with self._lock:
+                stats.plan = plan
+        
+        self._slow_log.append({
+            'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'elapsed_ms': round(elapsed_ms, 2),
+            'rows': rows,
+            'bytes': nbytes,
+            'caller': caller,
+            'source': source,
+            'sql': sql,
+            'params': repr(params)[:200] if params else None,
+            'plan': plan
+        })
+        print(f"[SLOW QUERY] {elapsed_ms:.0f} ms, {rows} filas ({source}) en {caller}: {sql[:160]}")
+    
+    def get_top(self, n=None, order_by='total_ms'):
+        """Sentencias más costosas ordenadas por `order_by` (total_ms, max_ms, avg_ms, count)"""
+        with self._lock:
+            items = [(sql, stats) for sql, stats in self._statements.items()]
+            rows = [{
+                'sql': sql,
+                'count': stats.count,
+                'total_ms': stats.total_ms,
+                'avg_ms': stats.total_ms / stats.count,
+                'max_ms': stats.max_ms,
+                'avg_rows': stats.rows / stats.count,
+                'avg_bytes': stats.bytes / stats.count,
+                'slow_count': stats.slow_count,
+                'last_caller': stats.last_caller,
+                'last_source': stats.last_source,
+                'plan': stats.plan
+            } for sql, stats in items]
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows[:n or self.top_n]
+    
+    def get_slow_log(self):
+        """Consultas lentas recientes, de la más nueva a la más antigua"""
+        return list(reversed(self._slow_log))
+    
+    def get_stats(self):
+        with self._lock:
+            tracked = len(self._statements)
+        return {
+            'enabled': self.enabled,
+            'slow_ms': self.slow_ms,
+            'recorded': self.recorded,
+            'slow_queries': self.slow_queries,
+            'tracked_statements': tracked,
+            'explain_failures': self.explain_failures
+        }
+    
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow_log.clear()
+            self.recorded = 0
+            self.slow_queries = 0
+            self.explain_failures = 0
+
+_query_profiling_settings = get_query_profiling_settings()
+_query_profiler = QueryProfiler(
+    slow_ms=_query_profiling_settings['slow_ms'],
+    slow_log_size=_query_profiling_settings['slow_log_size'],
+    top_n=_query_profiling_settings['top_n'],
+    max_statements=_query_profiling_settings['max_statements'],
+    explain=_query_profiling_settings['explain'],
+    enabled=_query_profiling_settings['enabled']
+)
+
+def _profile(query, params, started, result, caller=None, source='primary', explain_cursor=None,
+             elapsed_ms=None, rows=None, result_bytes=None):
+    """Registra en el profiler una sentencia que empezó en `started` (perf_counter).
+
+    Las lecturas por bloques pasan `elapsed_ms`, `rows` y `result_bytes` ya
+    acumulados en lugar de `started`/`result`.
+    """
+    if not _query_profiler.enabled:
+        return
+    if elapsed_ms is None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    if rows is None:
+        if isinstance(result, (pd.DataFrame, list)):
+            rows = len(result)
+        else:
+            rows = getattr(result, 'rowcount', None)
+            rows = rows if rows is not None and rows >= 0 else 0
+    if result_bytes is None:
+        result_bytes = _estimate_result_bytes(result)
+    
+    def explain():
+        if explain_cursor is not None:
+            return _explain_query_plan(explain_cursor, query, params)
+        # Cursor nuevo en la conexión de la unidad de trabajo: no pisa rowcount/lastrowid del llamador
+        with read() as cursor:
+            return _explain_query_plan(cursor, query, params)
+    
+    _query_profiler.record(
+        query, params, elapsed_ms, rows, result_bytes,
+        caller or _query_caller(), source=source, explain=explain
+    )
+
+def get_query_stats(n=None, order_by='total_ms'):
+    """Top-N de sentencias por tiempo acumulado (o `max_ms`, `avg_ms`, `count`)"""
+    return _query_profiler.get_top(n, order_by)
+
+def get_slow_queries():
+    """Log reciente de consultas lentas con su EXPLAIN QUERY PLAN"""
+    return _query_profiler.get_slow_log()
+
+def get_query_profiler_stats():
+    return _query_profiler.get_stats()
+
+def reset_query_stats():
+    """Reinicia las métricas por consulta y el log de consultas lentas"""
+    _query_profiler.reset()
+
+def execute_query(query, params=None, use_pool=True):
+    """Ejecuta una consulta de manera compatible con ambos tipos de BD.
+
+    `use_pool` se conserva por compatibilidad: la conexión siempre sale de la
+    unidad de trabajo actual (o del pool).
+    """
+    # Para queries que devuelven datos
+    if query.strip().upper().startswith('SELECT'):
+        with read() as cursor:
+            started = time.perf_counter()
+            result = cursor.execute(query, params) if params else cursor.execute(query)
+            rows = result.fetchall()
+            _profile(query, params, started, rows)
+            return rows
+
+    with transaction() as tx:
+        started = time.perf_counter()
+        result = tx.execute(query, params) if params else tx.execute(query)
+        _profile(query, params, started, result)
+    return result
 
 def execute_batch_query(queries_with_params, use_transaction=True):
     """Ejecuta múltiples consultas en batch para mejor rendimiento"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
-    try:
-        if use_transaction:
-            cursor.execute("BEGIN TRANSACTION")
-        
+    with (transaction() if use_transaction else read()) as cursor:
         results = []
         for query, params in queries_with_params:
+            started = time.perf_counter()
             if params:
                 result = cursor.execute(query, params)
             else:
                 result = cursor.execute(query)
-            
+
             if query.strip().upper().startswith('SELECT'):
-                results.append(result.fetchall())
-            else:
-                results.append(result)
-        
-        if use_transaction:
-            conn.commit()
-        
+                result = result.fetchall()
+            _profile(query, params, started, result)
+            results.append(result)
+
         return results
-        
-    except Exception as e:
-        if use_transaction:
-            conn.rollback()
-        raise e
-    finally:
-        return_pooled_connection(conn)
 
-def create_database_indexes():
-    """Crea índices para optimizar consultas frecuentes"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    indexes = [
-        # Índices para catálogo de actividades
-        "CREATE INDEX IF NOT EXISTS idx_activities_catalog_name ON activities_catalog(name)",
-
-        # Índices para la tabla clients
-        "CREATE INDEX IF NOT EXISTS idx_clients_name ON clients(name)",
-        "CREATE INDEX IF NOT EXISTS idx_clients_codigo_ag ON clients(codigo_ag)",
-        "CREATE INDEX IF NOT EXISTS idx_clients_codigo_we ON clients(codigo_we)",
-        "CREATE INDEX IF NOT EXISTS idx_clients_tipo_region ON clients(tipo_cliente, region)",
-        
-        # Índices para la tabla client_activities
-        "CREATE INDEX IF NOT EXISTS idx_client_activities_client_id ON client_activities(client_id)",
-        "CREATE INDEX IF NOT EXISTS idx_client_activities_activity_name ON client_activities(activity_name)",
-        "CREATE INDEX IF NOT EXISTS idx_client_activities_activity_id ON client_activities(activity_id)",
-        "CREATE INDEX IF NOT EXISTS idx_client_activities_frequency_id ON client_activities(frequency_template_id)",
-        "CREATE INDEX IF NOT EXISTS idx_client_activities_composite ON client_activities(client_id, activity_name)",
-        
-        # Índices para la tabla calculated_dates
-        "CREATE INDEX IF NOT EXISTS idx_calculated_dates_client_id ON calculated_dates(client_id)",
-        "CREATE INDEX IF NOT EXISTS idx_calculated_dates_activity ON calculated_dates(activity_name)",
-        "CREATE INDEX IF NOT EXISTS idx_calculated_dates_activity_id ON calculated_dates(activity_id)",
-        "CREATE INDEX IF NOT EXISTS idx_calculated_dates_date ON calculated_dates(date)",
-        "CREATE INDEX IF NOT EXISTS idx_calculated_dates_composite ON calculated_dates(client_id, activity_name, date_position)",
-        
-        # Índices para la tabla frequency_templates
-        "CREATE INDEX IF NOT EXISTS idx_frequency_templates_name ON frequency_templates(name)",
-        "CREATE INDEX IF NOT EXISTS idx_frequency_templates_type ON frequency_templates(frequency_type)",
-        "CREATE INDEX IF NOT EXISTS idx_frequency_templates_sap_code ON frequency_templates(calendario_sap_code)",
-
-        # Índices para el módulo de cumplimiento
-        "CREATE INDEX IF NOT EXISTS idx_compliance_records_upload ON compliance_records(upload_id)",
-        "CREATE INDEX IF NOT EXISTS idx_compliance_records_client ON compliance_records(matched_client_id)",
-        "CREATE INDEX IF NOT EXISTS idx_compliance_records_status ON compliance_records(status)",
-        "CREATE INDEX IF NOT EXISTS idx_compliance_records_dates ON compliance_records(reference_date, expected_date)",
-
-        # Índices para la tabla de usuarios
-        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username)",
-        "CREATE INDEX IF NOT EXISTS idx_users_active_role ON users(is_active, role)",
-        "CREATE INDEX IF NOT EXISTS idx_users_locked ON users(locked_until)"
-    ]
+# Índices de la BD (create_database_indexes); verify_query_plans.create_plan_check_database los aplica a una BD en memoria
+_DATABASE_INDEXES = [
+    # Índices para catálogo de actividades
+    "CREATE INDEX IF NOT EXISTS idx_activities_catalog_name ON activities_catalog(name)",
+
+    # Índices para la tabla clients
+    "CREATE INDEX IF NOT EXISTS idx_clients_name ON clients(name)",
+    "CREATE INDEX IF NOT EXISTS idx_clients_codigo_ag ON clients(codigo_ag)",
+    "CREATE INDEX IF NOT EXISTS idx_clients_codigo_we ON clients(codigo_we)",
+    "CREATE INDEX IF NOT EXISTS idx_clients_tipo_region ON clients(tipo_cliente, region)",
+    # Filtro por país de dashboard y anomalías, ya en el orden de ORDER BY c.name
+    "CREATE INDEX IF NOT EXISTS idx_clients_pais_name ON clients(pais, name)",
     
-    try:
-        for index_sql in indexes:
+    # Índices para la tabla client_activities
+    "CREATE INDEX IF NOT EXISTS idx_client_activities_client_id ON client_activities(client_id)",
+    "CREATE INDEX IF NOT EXISTS idx_client_activities_activity_name ON client_activities(activity_name)",
+    "CREATE INDEX IF NOT EXISTS idx_client_activities_activity_id ON client_activities(activity_id)",
+    "CREATE INDEX IF NOT EXISTS idx_client_activities_frequency_id ON client_activities(frequency_template_id)",
+    "CREATE INDEX IF NOT EXISTS idx_client_activities_composite ON client_activities(client_id, activity_name)",
+    
+    # Índices para la tabla calculated_dates
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_activity ON calculated_dates(activity_name)",
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_date ON calculated_dates(date)",
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_year_month ON calculated_dates(date_year, date_month)",
+    # Dashboard y anomalías: actividad + día (o rango de días), JOIN por client_id; incluye
+    # date para resolver la consulta sin leer la tabla
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_activity_day_client "
+    "ON calculated_dates(activity_id, date_day, client_id, date)",
+    # Fechas de un cliente y el auto-JOIN albaranado/entrega por (client_id, activity_id, date_position)
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_client_activity_position "
+    "ON calculated_dates(client_id, activity_id, date_position, date_day, date)",
+    # Reemplazados por los compuestos anteriores (son prefijos suyos)
+    "DROP INDEX IF EXISTS idx_calculated_dates_client_id",
+    "DROP INDEX IF EXISTS idx_calculated_dates_activity_id",
+    "DROP INDEX IF EXISTS idx_calculated_dates_activity_day",
+    "CREATE INDEX IF NOT EXISTS idx_calculated_dates_composite ON calculated_dates(client_id, activity_name, date_position)",
+    
+    # Índices para la tabla frequency_templates
+    "CREATE INDEX IF NOT EXISTS idx_frequency_templates_name ON frequency_templates(name)",
+    "CREATE INDEX IF NOT EXISTS idx_frequency_templates_type ON frequency_templates(frequency_type)",
+    "CREATE INDEX IF NOT EXISTS idx_frequency_templates_sap_code ON frequency_templates(calendario_sap_code)",
+
+    # Índices para el módulo de cumplimiento
+    "CREATE INDEX IF NOT EXISTS idx_compliance_records_upload ON compliance_records(upload_id)",
+    "CREATE INDEX IF NOT EXISTS idx_compliance_records_client ON compliance_records(matched_client_id)",
+    "CREATE INDEX IF NOT EXISTS idx_compliance_records_status ON compliance_records(status)",
+    "CREATE INDEX IF NOT EXISTS idx_compliance_records_dates ON compliance_records(reference_date, expected_date)",
+
+    # Índices para la tabla de usuarios
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username)",
+    "CREATE INDEX IF NOT EXISTS idx_users_active_role ON users(is_active, role)",
+    "CREATE INDEX IF NOT EXISTS idx_users_locked ON users(locked_until)"
+]
+
+_INDEX_NAME_RE = re.compile(r'^(CREATE (?:UNIQUE )?INDEX|DROP INDEX) IF (?:NOT )?EXISTS (\w+)')
+_EXPECTED_INDEXES = frozenset(m.group(2) for m in map(_INDEX_NAME_RE.match, _DATABASE_INDEXES)
+                              if m.group(1) != 'DROP INDEX')
+_DROPPED_INDEXES = frozenset(m.group(2) for m in map(_INDEX_NAME_RE.match, _DATABASE_INDEXES)
+                             if m.group(1) == 'DROP INDEX')
+
+def _indexes_pending(existing_indexes):
+    """True si falta algún índice de _DATABASE_INDEXES o sigue alguno reemplazado (None: desconocido)"""
+    if existing_indexes is None:
+        return True
+    return bool(_EXPECTED_INDEXES - existing_indexes or _DROPPED_INDEXES & existing_indexes)
+
+def _create_indexes(cursor):
+    """Aplica _DATABASE_INDEXES con `cursor`; un índice fallido no deshace los demás. Devuelve los fallidos"""
+    failed = 0
+    for index_sql in _DATABASE_INDEXES:
+        # P. ej. tabla aún inexistente: el error es de la sentencia, no de la transacción
+        try:
             cursor.execute(index_sql)
-        
-        conn.commit()
-        print("Índices de base de datos creados exitosamente")
+        except Exception as e:
+            failed += 1
+            print(f"Error creando índice ({index_sql}): {e}")
+    return failed
+
+def create_database_indexes():
+    """Crea índices para optimizar consultas frecuentes (idempotente; los fallidos se reintentan en el siguiente arranque)"""
+    try:
+        with transaction() as tx:
+            failed = _create_indexes(tx)
+        if failed:
+            print(f"Índices de base de datos creados; {failed} pendientes")
+        else:
+            print("Índices de base de datos creados exitosamente")
         
     except Exception as e:
         print(f"Error creando índices: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
-def execute_query_df(query, params=None, use_cache=False, cache_ttl=60):
-    """Ejecuta una consulta y devuelve un DataFrame con cache optimizado"""
+# === RÉPLICA LOCAL DE LECTURA (GL_REPLICA_ENABLED) ===
+#
+# Las escrituras van siempre a la BD principal. Tras cada COMMIT que toca una tabla
+# replicada se aplican a la réplica los cambios de replica_changelog (en la misma
+# conexión), y un hilo en segundo plano repite la sincronización periódicamente
+# para recoger las escrituras de otros servidores.
+
+def _create_local_replica(settings):
+    """Crea la réplica local de lectura si está habilitada"""
+    if not settings['enabled']:
+        return None
+    try:
+        from local_replica import LocalReplica
+        replica = LocalReplica(get_db_config().get_replica_path())
+        print(f"[GREEN LOGISTICS] Réplica local de lectura habilitada en {replica.path}")
+        return replica
+    except Exception as e:
+        print(f"[GREEN LOGISTICS] Advertencia: réplica local deshabilitada: {e}")
+        return None
+
+_replica_settings = get_replica_settings()
+_local_replica = _create_local_replica(_replica_settings)
+_replica_sync_lock = threading.Lock()
+_replica_sync_started = False
+
+def _replica_available(tables):
+    """Indica si la réplica puede servir una lectura de esas tablas ahora mismo"""
+    if _local_replica is None or not _local_replica.covers(tables):
+        return False
+    unit = _current_unit()
+    if unit is not None and unit.depth > 0:
+        # Dentro de una transacción hay que leer los cambios aún no confirmados
+        return False
+    return _local_replica.is_fresh(_replica_settings['max_lag_seconds'])
+
+def get_read_connection(tables=None):
+    """Conexión para consultas de solo lectura: la réplica local si está al día, si no la BD principal.
+
+    `tables` son las tablas que se van a leer (por defecto, todas las replicadas).
+    Como con get_db_connection(), el llamador debe cerrarla con close().
+    """
+    if _local_replica is not None and _replica_available(tables or _local_replica.tables):
+        return _local_replica.connect()
+    return get_db_connection()
+
+def sync_local_replica():
+    """Aplica a la réplica local los cambios pendientes de la BD principal (filas aplicadas)"""
+    if _local_replica is None:
+        return 0
+    with read() as cursor:
+        return _local_replica.sync(cursor)
+
+def _sync_replica_after_write(tables):
+    """Lleva a la réplica una escritura recién confirmada en tablas replicadas"""
+    if _local_replica is None or not _local_replica.is_fresh(0):
+        return
+    if tables and not set(tables) & set(_local_replica.tables):
+        return
+    sync_local_replica()
+
+def prune_replica_changelog():
+    """Conserva solo los últimos GL_REPLICA_CHANGELOG_KEEP cambios en replica_changelog"""
+    keep = _replica_settings['changelog_keep']
+    if _local_replica is None or keep <= 0:
+        return 0
+    with transaction() as tx:
+        tx.execute('''
+            DELETE FROM replica_changelog
+            WHERE seq <= (SELECT COALESCE(MAX(seq), 0) FROM replica_changelog) - ?
+        ''', (keep,))
+        pruned = tx.rowcount
+    return pruned
+
+def _install_replica_changelog(mark_gap=False):
+    """Crea replica_changelog y sus triggers en la BD principal (idempotente).
+
+    Con `mark_gap` (faltaban triggers) deja una fila RESYNC_MARKER: las escrituras
+    hechas sin triggers no están en el registro y las réplicas deben copiar todo.
+    """
+    from local_replica import changelog_statements, RESYNC_MARKER
+    with transaction() as tx:
+        for statement in changelog_statements():
+            tx.execute(statement)
+        if mark_gap:
+            tx.execute("INSERT INTO replica_changelog (table_name, row_id) VALUES (?, 0)", (RESYNC_MARKER,))
+
+def _drop_replica_changelog():
+    """Elimina los triggers de réplica y vacía replica_changelog (ningún proceso lo purgaría)"""
+    from local_replica import drop_changelog_statements
+    with transaction() as tx:
+        for statement in drop_changelog_statements():
+            tx.execute(statement)
+    print("[REPLICA] Réplica local deshabilitada: triggers de replica_changelog eliminados de la BD principal")
+
+def _replica_sync_loop(sync_seconds):
+    """Copia inicial de la réplica y sincronización incremental periódica"""
+    cycles = 0
+    while True:
+        try:
+            # El hilo arranca antes que init_database: replica_changelog llega con las migraciones
+            migrate_schema()
+            # Un servidor sin réplica pudo eliminar los triggers al migrar: volver a crearlos
+            with read() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_replica_%'")
+                replica_triggers = cursor.fetchone()[0]
+            if replica_triggers < 3 * len(_local_replica.tables):
+                _install_replica_changelog(mark_gap=True)
+            sync_local_replica()
+            cycles += 1
+            if cycles % 100 == 0:
+                prune_replica_changelog()
+        except Exception as e:
+            print(f"[GREEN LOGISTICS] Error en sincronización de la réplica local: {e}")
+        time.sleep(sync_seconds)
+
+def start_replica_sync():
+    """Inicia (una vez por proceso) el hilo de sincronización de la réplica local"""
+    global _replica_sync_started
+    if _local_replica is None:
+        return False
+    with _replica_sync_lock:
+        if _replica_sync_started:
+            return False
+        _replica_sync_started = True
+    threading.Thread(
+        target=_replica_sync_loop,
+        args=(max(1, _replica_settings['sync_seconds']),),
+        name="db-replica-sync",
+        daemon=True
+    ).start()
+    return True
+
+def get_replica_stats():
+    """Estado de la réplica local (None si está deshabilitada)"""
+    return _local_replica.get_stats() if _local_replica is not None else None
+
+# === ESQUEMAS TIPADOS DE DATAFRAMES ===
+#
+# Los DataFrames de las tablas núcleo salen de la capa de datos ya tipados: fechas como
+# datetime64, ids y posiciones int32, textos repetidos como category e is_custom bool.
+# Se convierten una vez al cargar (antes de entrar al cache), así que las entradas
+# ocupan menos y los consumidores no vuelven a parsear fechas en cada render.
+
+DATE_DTYPE = 'date'
+
+CLIENTS_SCHEMA = {
+    'id': 'int32',
+    'tipo_cliente': 'category',
+    'region': 'category',
+    'pais': 'category'
+}
+
+CALCULATED_DATES_SCHEMA = {
+    'id': 'int32',
+    'client_id': 'int32',
+    'activity_id': 'int32',
+    'activity_name': 'category',
+    'date_position': 'int32',
+    'date': DATE_DTYPE,
+    'is_custom': 'bool'
+}
+
+def apply_schema(df, schema):
+    """Convierte (en el mismo DataFrame) las columnas presentes a los tipos de `schema`.
+
+    Las columnas enteras con nulos se dejan como están (float) en lugar de pasar a
+    un entero nullable, para que `if row[...]` y `int(...)` sigan funcionando. Las
+    fechas no válidas quedan como NaT.
+    """
+    if df is None or df.empty:
+        return df
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        try:
+            values = df[column]
+            if dtype == DATE_DTYPE:
+                df[column] = pd.to_datetime(values, errors='coerce')
+            elif dtype == 'bool':
+                df[column] = values.fillna(0).astype(bool)
+            elif dtype == 'category':
+                df[column] = values.astype('category')
+            elif not values.isna().any():
+                df[column] = values.astype(dtype)
+        except (TypeError, ValueError) as e:
+            print(f"[SCHEMA] No se pudo convertir la columna {column} a {dtype}: {e}")
+    return df
+
+# === CLAVES DE FECHA (date_day / date_year / date_month) ===
+#
+# calculated_dates.date se guarda siempre como texto ISO (YYYY-MM-DD) y junto a él se
+# mantienen, por triggers, tres columnas enteras: date_day (días desde 1970-01-01),
+# date_year y date_month. Los filtros por día, rango o mes comparan esas columnas
+# directamente (`cd.date_day BETWEEN ? AND ?`) en lugar de envolver la columna en
+# date(...), así SQLite puede resolverlos con un índice en vez de recorrer la tabla.
+
+_EPOCH = date(1970, 1, 1)
+
+# Expresiones SQL equivalentes a date_day_number() y al año/mes de una fecha
+_DATE_DAY_SQL = "CAST(julianday(date({0})) - 2440587.5 AS INTEGER)"
+_DATE_YEAR_SQL = "CAST(strftime('%Y', {0}) AS INTEGER)"
+_DATE_MONTH_SQL = "CAST(strftime('%m', {0}) AS INTEGER)"
+
+def date_day_number(value):
+    """Número de día (días desde 1970-01-01) de una fecha, para comparar con date_day"""
+    if isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, date):
+        value = date.fromisoformat(str(value)[:10])
+    return (value - _EPOCH).days
+
+# === TRANSPORTE ARROW ===
+#
+# Con GL_ARROW_TRANSPORT=true los resultados se leen del cursor en lotes (fetchmany) y
+# se arman por columnas como tablas Apache Arrow antes de pasar a pandas, en lugar de
+# pd.read_sql_query. Con GL_ARROW_CACHE=true execute_query_df guarda en cache la tabla
+# Arrow (inmutable, más compacta que el DataFrame y más barata de serializar al nivel
+# compartido) y entrega a cada llamador un DataFrame construido sobre sus buffers.
+# Sin pyarrow instalado ambas opciones se ignoran.
+
+_arrow_settings = get_arrow_settings()
+
+def arrow_available():
+    """pyarrow está instalado (lo instala Streamlit como dependencia)"""
+    return pa is not None
+
+def _arrow_column(values):
+    """Array Arrow de una columna; SQLite permite tipos mezclados, que se pasan a texto"""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([value if value is None else str(value) for value in values], pa.string())
+
+def _concat_arrow_tables(tables):
+    if len(tables) == 1:
+        return tables[0]
+    try:
+        # Un lote con una columna toda NULL (tipo null) se promueve al tipo de los demás
+        return pa.concat_tables(tables, promote_options='permissive')
+    except TypeError:
+        # pyarrow < 14
+        return pa.concat_tables(tables, promote=True)
+
+def _arrow_from_cursor(cursor, batch_size=None):
+    """Tabla Arrow armada por columnas a partir de lotes fetchmany de un cursor ya ejecutado"""
+    batch_size = batch_size or _arrow_settings['batch_rows']
+    names = [description[0] for description in cursor.description]
+    tables = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        columns = zip(*rows)
+        tables.append(pa.Table.from_arrays([_arrow_column(values) for values in columns], names=names))
+    if not tables:
+        return pa.Table.from_arrays([pa.array([], pa.null()) for _ in names], names=names)
+    return _concat_arrow_tables(tables)
+
+def _arrow_string_dtype():
+    """Dtype de texto respaldado por Arrow; con pandas >= 2.3 los nulos siguen siendo NaN"""
+    try:
+        return pd.StringDtype(storage='pyarrow', na_value=np.nan)
+    except TypeError:
+        return pd.ArrowDtype(pa.string())
+
+_ARROW_TYPES_MAPPER = {}
+if pa is not None:
+    _ARROW_TYPES_MAPPER = {pa.string(): _arrow_string_dtype(), pa.large_string(): _arrow_string_dtype()}
+
+def _arrow_to_df(table):
+    """DataFrame sobre los buffers de la tabla sin copiar: las columnas de texto quedan
+    como arreglos Arrow (no se crea un objeto str por celda) y las numéricas y de fecha
+    sin nulos usan los mismos buffers"""
+    return table.to_pandas(split_blocks=True, types_mapper=_ARROW_TYPES_MAPPER.get)
+
+def _df_to_arrow(df):
+    """Tabla Arrow de un DataFrame (category -> dictionary); None si alguna columna no se puede convertir"""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError) as e:
+        print(f"[ARROW] No se pudo convertir el resultado a Arrow, se guarda como DataFrame: {e}")
+        return None
+
+def _query_to_df(conn, query, params=None):
+    """Lee una consulta en `conn` como DataFrame, vía Arrow si el transporte está habilitado"""
+    if _arrow_settings['transport'] and pa is not None:
+        cursor = conn.cursor()
+        if params:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        try:
+            return _arrow_to_df(_arrow_from_cursor(cursor))
+        except pa.ArrowException as e:
+            print(f"[ARROW] Error armando la tabla Arrow, usando read_sql_query: {e}")
+    if params:
+        return pd.read_sql_query(query, conn, params=params)
+    return pd.read_sql_query(query, conn)
+
+def execute_query_arrow(query, params=None):
+    """Ejecuta una consulta y devuelve una tabla Arrow (sin pasar por pandas ni por el cache)"""
+    if pa is None:
+        raise RuntimeError("pyarrow no está instalado")
+    caller = _query_caller() if _query_profiler.enabled else None
     
-    # Generar clave de cache
-    cache_key = None
-    if use_cache:
-        param_str = str(params) if params else "None"
-        cache_key = hashlib.md5(f"{query}_{param_str}".encode()).hexdigest()
-        
-        # Verificar cache
-        cached_result = _db_cache.get(cache_key, cache_ttl)
-        if cached_result is not None:
-            return cached_result
+    if _replica_available(get_query_tables(query)):
+        replica_conn = _local_replica.connect()
+        try:
+            cursor = replica_conn.cursor()
+            started = time.perf_counter()
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            table = _arrow_from_cursor(cursor)
+            _profile(query, params, started, None, caller, source='replica',
+                     explain_cursor=replica_conn.cursor(), rows=table.num_rows, result_bytes=table.nbytes)
+            return table
+        except Exception as e:
+            print(f"[REPLICA] Error leyendo de la réplica local, usando BD principal: {e}")
+        finally:
+            replica_conn.close()
     
+    with read() as cursor:
+        started = time.perf_counter()
+        if params:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        table = _arrow_from_cursor(cursor)
+        _profile(query, params, started, None, caller, rows=table.num_rows, result_bytes=table.nbytes)
+        return table
+
+def _read_query_df(query, params=None, caller=None, schema=None):
+    """Ejecuta una consulta y devuelve un DataFrame.
+
+    Si todas las tablas leídas están en la réplica local y ésta está al día, la
+    consulta se sirve desde ella; si no, en la conexión de la unidad de trabajo.
+    Cada lectura queda registrada en el profiler de consultas. Con `schema` las
+    columnas se convierten con apply_schema antes de devolverlo.
+    """
     # Suprimir warnings temporalmente para esta consulta específica
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", UserWarning)
-        
-        conn = get_pooled_connection()
+
+        df = None
+        if _replica_available(get_query_tables(query)):
+            replica_conn = _local_replica.connect()
+            try:
+                started = time.perf_counter()
+                df = _query_to_df(replica_conn, query, params)
+                _profile(query, params, started, df, caller, source='replica',
+                         explain_cursor=replica_conn.cursor())
+            except Exception as e:
+                print(f"[REPLICA] Error leyendo de la réplica local, usando BD principal: {e}")
+            finally:
+                replica_conn.close()
+
+        if df is None:
+            with _unit_scope() as unit:
+                started = time.perf_counter()
+                df = _query_to_df(unit.conn, query, params)
+                _profile(query, params, started, df, caller)
+
+    return apply_schema(df, schema) if schema else df
+
+def execute_query_df(query, params=None, use_cache=False, cache_ttl=60, cache_tags=None,
+                     stale_while_revalidate=True, cache_family=None, schema=None):
+    """Ejecuta una consulta y devuelve un DataFrame con cache optimizado.
+
+    La clave incluye la versión de cada tabla leída, por lo que el resultado deja
+    de servirse en cuanto alguna de ellas se modifica. Si no se indican
+    `cache_tags`, la entrada se etiqueta con esas tablas (`table:<tabla>`).
+    Los misses concurrentes de la misma consulta se agrupan en una sola lectura.
+    `cache_family` antepone un prefijo a la clave para agrupar sus estadísticas
+    (por defecto las consultas cuentan en la familia `query-hash`).
+    `schema` (p. ej. CLIENTS_SCHEMA) tipa las columnas antes de guardar en cache.
+    """
+    # Dentro de una transacción abierta se lee siempre de la BD (ver _cacheable)
+    if not _cacheable(use_cache):
+        return _read_query_df(query, params, schema=schema)
+    
+    # Generar clave de cache
+    param_str = str(params) if params else "None"
+    query_tables = get_query_tables(query)
+    versions = _table_versions.snapshot(query_tables)
+    schema_str = str(sorted(schema.items())) if schema else ""
+    cache_key = hashlib.md5(f"{query}_{param_str}_{versions}{schema_str}".encode()).hexdigest()
+    if cache_family:
+        cache_key = f"{cache_family}_{cache_key}"
+    if cache_tags is None:
+        cache_tags = [table_tag(table) for table in query_tables]
+    
+    # El llamador se captura aquí: la carga puede ejecutarse en el hilo de revalidación
+    caller = _query_caller() if _query_profiler.enabled else None
+    
+    def load():
+        df = _read_query_df(query, params, caller, schema)
+        if _arrow_settings['cache'] and pa is not None:
+            table = _df_to_arrow(df)
+            if table is not None:
+                return table
+        return df
+    
+    result = _db_cache.get_or_load(
+        cache_key,
+        load,
+        cache_ttl,
+        tags=cache_tags,
+        stale_while_revalidate=stale_while_revalidate
+    )
+    # Entradas guardadas como Arrow (GL_ARROW_CACHE): cada llamador recibe su propio DataFrame
+    if pa is not None and isinstance(result, pa.Table):
+        return _arrow_to_df(result)
+    return result
+
+# === LECTURA POR BLOQUES (STREAMING) ===
+#
+#     for chunk in iter_query_df(query, params, chunksize=5000):   # DataFrames de <= 5000 filas
+#         ...
+#     for row in iter_query_rows(query, params):                    # tuplas, leídas con fetchmany
+#         ...
+#
+# A diferencia de execute_query_df, el resultado nunca se materializa completo: para
+# exportaciones y agregados sobre tablas que crecen con los años (calculated_dates).
+
+_STREAM_CHUNK_ROWS = 5000
+
+def _open_stream_cursor(query, params):
+    """Ejecuta la consulta para leerla por bloques; devuelve (cursor, liberar, origen, segundos).
+
+    Usa la réplica local si cubre las tablas de la consulta. En la BD principal
+    reutiliza la conexión de la unidad de trabajo si hay una abierta; si no, toma
+    una del pool solo para el stream, sin registrarla como unidad de trabajo del
+    hilo: el generador puede quedar suspendido mientras el llamador abre sus propias
+    transacciones, y al agotarse no debe devolver al pool una conexión ajena.
+    """
+    if _replica_available(get_query_tables(query)):
+        replica_conn = _local_replica.connect()
         try:
+            cursor = replica_conn.cursor()
+            started = time.perf_counter()
             if params:
-                df = pd.read_sql_query(query, conn, params=params)
+                cursor.execute(query, params)
             else:
-                df = pd.read_sql_query(query, conn)
-            
-            # Guardar en cache si se solicitó
-            if use_cache and cache_key:
-                _db_cache.set(cache_key, df, cache_ttl)
-            
-            return df
-        finally:
-            return_pooled_connection(conn)
+                cursor.execute(query)
+            return cursor, replica_conn.close, 'replica', time.perf_counter() - started
+        except Exception as e:
+            replica_conn.close()
+            print(f"[REPLICA] Error leyendo de la réplica local, usando BD principal: {e}")
+    
+    unit = _current_unit()
+    conn = unit.conn if unit is not None else get_pooled_connection()
+    release = (lambda: None) if unit is not None else (lambda: return_pooled_connection(conn))
+    try:
+        cursor = conn.cursor()
+        started = time.perf_counter()
+        if params:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+        return cursor, release, 'primary', time.perf_counter() - started
+    except Exception:
+        release()
+        raise
+
+def _iter_query_batches(query, params, batch_size):
+    """Genera (columnas, filas) con fetchmany y registra el total en el profiler al terminar"""
+    caller = _query_caller() if _query_profiler.enabled else None
+    cursor, release, source, db_seconds = _open_stream_cursor(query, params)
+    total_rows = 0
+    total_bytes = 0
+    try:
+        columns = [description[0] for description in cursor.description]
+        while True:
+            started = time.perf_counter()
+            rows = cursor.fetchmany(batch_size)
+            db_seconds += time.perf_counter() - started
+            if not rows:
+                break
+            total_rows += len(rows)
+            total_bytes += _estimate_result_bytes(rows)
+            yield columns, rows
+    finally:
+        release()
+        # Solo cuenta el tiempo en la BD, no el que el llamador dedica a cada bloque
+        _profile(query, params, None, None, caller, source=source,
+                 elapsed_ms=db_seconds * 1000, rows=total_rows, result_bytes=total_bytes)
+
+def iter_query_rows(query, params=None, batch_size=1000):
+    """Genera las filas (tuplas) de una consulta leyéndolas del cursor en lotes de `batch_size`.
+
+    La conexión queda ocupada hasta que el generador se agota o se cierra
+    (`close()`, o al salir de un `for` con break y liberarse el generador).
+    Mientras tanto la lectura sigue abierta en SQLite: las escrituras deben
+    esperar a que el stream termine, no hacerse entre bloques.
+    """
+    for _columns, rows in _iter_query_batches(query, params, batch_size):
+        yield from rows
+
+def iter_query_df(query, params=None, chunksize=_STREAM_CHUNK_ROWS):
+    """Genera DataFrames de hasta `chunksize` filas con el resultado de una consulta.
+
+    Equivalente por bloques de execute_query_df (sin cache): cada bloque se
+    procesa y se descarta antes de leer el siguiente.
+    """
+    for columns, rows in _iter_query_batches(query, params, chunksize):
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+_CALCULATED_DATES_PAGE_QUERY = '''
+    SELECT
+        cd.id,
+        cd.client_id,
+        c.name as client_name,
+        cd.activity_id,
+        COALESCE(ac.name, cd.activity_name) as activity_name,
+        cd.date_position,
+        cd.date,
+        cd.is_custom
+    FROM calculated_dates cd
+    LEFT JOIN activities_catalog ac ON ac.id = cd.activity_id
+    LEFT JOIN clients c ON c.id = cd.client_id
+    WHERE (cd.client_id, cd.id) > (?, ?){filters}
+    ORDER BY cd.client_id, cd.id
+    LIMIT ?
+'''
+
+def iter_calculated_dates(client_ids=None, start_date=None, end_date=None, chunksize=_STREAM_CHUNK_ROWS):
+    """Genera las fechas calculadas en DataFrames de hasta `chunksize` filas, ordenadas por cliente.
+
+    Pagina por clave (client_id, id) sobre el índice de client_id: cada bloque es
+    una consulta corta e independiente, así que entre bloques no se retiene ninguna
+    conexión y no se recorre de nuevo lo ya leído (a diferencia de OFFSET).
+    `start_date`/`end_date` ('YYYY-MM-DD') filtran el rango [inicio, fin).
+    """
+    filters = ''
+    filter_params = []
+    if client_ids is not None:
+        client_ids = [int(client_id) for client_id in client_ids]
+        if not client_ids:
+            return
+        filters += f" AND cd.client_id IN ({','.join(['?' for _ in client_ids])})"
+        filter_params.extend(client_ids)
+    if start_date:
+        filters += " AND cd.date >= ?"
+        filter_params.append(start_date)
+    if end_date:
+        filters += " AND cd.date < ?"
+        filter_params.append(end_date)
+    query = _CALCULATED_DATES_PAGE_QUERY.format(filters=filters)
+    
+    last_client_id, last_id = -1, -1
+    while True:
+        chunk = _read_query_df(query, (last_client_id, last_id, *filter_params, chunksize),
+                               schema=CALCULATED_DATES_SCHEMA)
+        if chunk.empty:
+            return
+        yield chunk
+        if len(chunk) < chunksize:
+            return
+        last_client_id = int(chunk['client_id'].iloc[-1])
+        last_id = int(chunk['id'].iloc[-1])
 
 def get_sap_calendar_mapping():
     """Retorna el mapeo de frecuencias a códigos de calendario SAP"""
@@ -409,85 +2339,118 @@ def get_sap_calendar_mapping():
         "1er Lunes del mes": "35"
     }
 
+def _apply_frequency_sap_codes(cursor):
+    """Asigna con `cursor` los códigos SAP del mapeo en un solo UPDATE (CASE por nombre)"""
+    mapping = get_sap_calendar_mapping()
+    if not mapping:
+        return
+    cases = ' '.join(['WHEN ? THEN ?' for _ in mapping])
+    placeholders = ','.join(['?' for _ in mapping])
+    params = [value for pair in mapping.items() for value in pair] + list(mapping)
+    cursor.execute(f'''
+        UPDATE frequency_templates
+        SET calendario_sap_code = CASE name {cases} END
+        WHERE name IN ({placeholders})
+    ''', params)
+    mark_tables_changed('frequency_templates')
+
 def update_frequency_sap_codes():
     """Actualiza los códigos SAP de las frecuencias existentes basándose en el mapeo"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    mapping = get_sap_calendar_mapping()
-    
     try:
-        for frequency_name, sap_code in mapping.items():
-            cursor.execute('''
-                UPDATE frequency_templates 
-                SET calendario_sap_code = ?
-                WHERE name = ?
-            ''', (sap_code, frequency_name))
-        
-        conn.commit()
+        with transaction() as tx:
+            _apply_frequency_sap_codes(tx)
         print("Códigos SAP actualizados para las frecuencias existentes")
-        
+
     except Exception as e:
         print(f"Error actualizando códigos SAP: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
 def auto_update_client_calendario_sap(client_id, activity_name, frequency_template_id):
     """Actualiza automáticamente el calendario SAP del cliente cuando se asigna la actividad Albaranado"""
     if activity_name != "Albaranado":
         return
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+
     try:
-        # Obtener el código SAP de la frecuencia seleccionada
-        cursor.execute('''
-            SELECT calendario_sap_code FROM frequency_templates 
-            WHERE id = ?
-        ''', (frequency_template_id,))
-        
-        result = cursor.fetchone()
-        if result:
+        # Dentro de otra transacción (p. ej. create_default_activities) es un SAVEPOINT
+        with transaction() as tx:
+            # Obtener el código SAP de la frecuencia seleccionada
+            tx.execute('''
+                SELECT calendario_sap_code FROM frequency_templates
+                WHERE id = ?
+            ''', (frequency_template_id,))
+
+            result = tx.fetchone()
+            if not result:
+                return
             sap_code = result[0] or "0"
-            
+
             # Actualizar el campo calendario_sap del cliente
-            cursor.execute('''
-                UPDATE clients 
+            tx.execute('''
+                UPDATE clients
                 SET calendario_sap = ?
                 WHERE id = ?
             ''', (sap_code, client_id))
-            
-            conn.commit()
-            print(f"Calendario SAP del cliente {client_id} actualizado automáticamente a: {sap_code}")
-            
+
+            invalidate_client_cache(client_id, ['clients'])
+        print(f"Calendario SAP del cliente {client_id} actualizado automáticamente a: {sap_code}")
+
     except Exception as e:
         print(f"Error actualizando calendario SAP automáticamente: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
-def init_database():
-    """Inicializa la base de datos y crea las tablas necesarias"""
-    try:
-        db_path = get_database_path()
-        config = get_db_config()
-        
-        print(f"[GREEN LOGISTICS] Inicializando base de datos: {db_path}")
-        print(f"[GREEN LOGISTICS] Entorno: {config.get_environment()}")
-        print(f"[GREEN LOGISTICS] Descripción: {config.db_config['description']}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-    except Exception as e:
-        print(f"[GREEN LOGISTICS] ERROR en inicialización de BD: {e}")
-        import streamlit as st
-        st.error(f"❌ Error de configuración de base de datos: {str(e)}")
-        st.stop()
-        return
-    
+def _date_key_assignments(source):
+    """SET de las columnas de fecha a partir de la expresión `source` (NEW.date o date)"""
+    return (
+        f"date = COALESCE(date({source}), {source}), "
+        f"date_day = {_DATE_DAY_SQL.format(source)}, "
+        f"date_year = {_DATE_YEAR_SQL.format(source)}, "
+        f"date_month = {_DATE_MONTH_SQL.format(source)}"
+    )
+
+def _migrate_date_keys(cursor):
+    """Normaliza calculated_dates.date a ISO y mantiene date_day/date_year/date_month.
+
+    Agrega las columnas si faltan, rellena las filas que aún no las tienen y crea los
+    triggers que las recalculan en cada INSERT y en cada UPDATE de `date`, de modo que
+    ningún módulo que escriba fechas tenga que conocerlas.
+    """
+    cursor.execute("PRAGMA table_info(calculated_dates)")
+    column_names = [col[1] for col in cursor.fetchall()]
+    for column_name in ('date_day', 'date_year', 'date_month'):
+        if column_name not in column_names:
+            cursor.execute(f'ALTER TABLE calculated_dates ADD COLUMN {column_name} INTEGER')
+            print(f"Campo {column_name} agregado a calculated_dates")
+
+    # Backfill: solo filas sin clave (todas la primera vez, ninguna después)
+    cursor.execute(f'''
+        UPDATE calculated_dates SET {_date_key_assignments('date')}
+        WHERE date_day IS NULL AND date(date) IS NOT NULL
+    ''')
+    if cursor.rowcount and cursor.rowcount > 0:
+        print(f"Claves de fecha calculadas para {cursor.rowcount} filas de calculated_dates")
+
+    cursor.execute("SELECT COUNT(*) FROM calculated_dates WHERE date_day IS NULL")
+    invalid_rows = cursor.fetchone()[0]
+    if invalid_rows:
+        print(f"[SCHEMA] {invalid_rows} filas de calculated_dates tienen una fecha no válida (sin date_day)")
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_calculated_dates_keys_insert AFTER INSERT ON calculated_dates
+        BEGIN
+            UPDATE calculated_dates SET {_date_key_assignments('NEW.date')}
+            WHERE rowid = NEW.rowid;
+        END
+    ''')
+    # El WHEN evita reescribir la fila cuando las claves ya corresponden a la fecha
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_calculated_dates_keys_update AFTER UPDATE OF date ON calculated_dates
+        WHEN NEW.date IS NOT date(NEW.date) OR NEW.date_day IS NOT {_DATE_DAY_SQL.format('NEW.date')}
+        BEGIN
+            UPDATE calculated_dates SET {_date_key_assignments('NEW.date')}
+            WHERE rowid = NEW.rowid;
+        END
+    ''')
+
+def _create_schema(cursor):
+    """Crea las tablas necesarias y aplica las migraciones no destructivas"""
     # Tabla de clientes
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS clients (
@@ -624,6 +2587,9 @@ def init_database():
                 date_position INTEGER NOT NULL DEFAULT 1,
                 date DATE NOT NULL,
                 is_custom BOOLEAN DEFAULT 0,
+                date_day INTEGER,
+                date_year INTEGER,
+                date_month INTEGER,
                 FOREIGN KEY (client_id) REFERENCES clients (id),
                 UNIQUE(client_id, activity_name, date_position)
             )
@@ -781,16 +2747,358 @@ def init_database():
             )
     except Exception as e:
         print(f"Error migrando catálogo de actividades: {e}")
+
+# === MIGRACIONES VERSIONADAS (schema_version) ===
+#
+# Cada paso de _MIGRATIONS se aplica una sola vez, en la misma transacción que su
+# fila en schema_version. Sin pasos pendientes, init_database hace una consulta (la
+# versión y los triggers de la réplica) y, ya verificado, el proceso no vuelve a
+# consultar. Los pasos aplicados no se editan: un cambio de esquema o de datos
+# iniciales (p. ej. el mapeo SAP) es un paso nuevo al final de la lista.
+
+_MIGRATIONS = [
+    (1, 'esquema base y migraciones previas', _create_schema),
+    (2, 'claves de fecha en calculated_dates', _migrate_date_keys),
+    # 3 ('índices') ya no es un paso versionado: migrate_schema asegura los índices en cada
+    # arranque con create_database_indexes, para reintentar los que fallen (tablas aún inexistentes)
+    (4, 'códigos SAP de frecuencias', _apply_frequency_sap_codes),
+]
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def _read_schema_state():
+    """Versión aplicada, triggers de réplica e índices existentes, en una sola consulta"""
+    try:
+        with read() as cursor:
+            cursor.execute('''
+                SELECT
+                    (SELECT COALESCE(MAX(version), 0) FROM schema_version),
+                    (SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_replica_%'),
+                    (SELECT group_concat(name) FROM sqlite_master WHERE type = 'index')
+            ''')
+            version, replica_triggers, index_names = cursor.fetchone()
+            return version, replica_triggers, set(index_names.split(',')) if index_names else set()
+    except Exception:
+        # BD nueva o anterior a schema_version; un error de conexión vuelve a salir al migrar
+        return 0, 0, None
+
+# Intentos por paso cuando otro proceso tiene la BD bloqueada, y espera entre ellos
+_SCHEMA_STEP_ATTEMPTS = 5
+_SCHEMA_RETRY_SECONDS = 1
+
+def _apply_migration_step(step_version, name, step):
+    """Aplica un paso con su fila en schema_version; False si otro proceso ya lo aplicó"""
+    for attempt in range(1, _SCHEMA_STEP_ATTEMPTS + 1):
+        try:
+            with transaction(immediate=True) as tx:
+                tx.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                tx.execute("SELECT 1 FROM schema_version WHERE version = ?", (step_version,))
+                if tx.fetchone():
+                    return False
+                step(tx)
+                tx.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (step_version, name))
+            return True
+        except Exception as e:
+            # BD bloqueada o fila duplicada: otro proceso pudo terminar el paso mientras tanto
+            if _read_schema_state()[0] >= step_version:
+                return False
+            if attempt == _SCHEMA_STEP_ATTEMPTS:
+                raise
+            print(f"[SCHEMA] Migración {step_version} ({name}) no se pudo aplicar "
+                  f"(intento {attempt}/{_SCHEMA_STEP_ATTEMPTS}), reintentando: {e}")
+            time.sleep(_SCHEMA_RETRY_SECONDS)
+
+def migrate_schema():
+    """Aplica las migraciones pendientes (una vez por proceso); devuelve los pasos aplicados.
+
+    El candado evita que dos sesiones del mismo proceso migren a la vez. Entre
+    procesos, cada paso abre su transacción con BEGIN IMMEDIATE y vuelve a leer la
+    versión ya con el candado de escritura: el proceso que espera encuentra el paso
+    aplicado y lo salta. Si la espera vence (BD bloqueada) se reintenta hasta
+    _SCHEMA_STEP_ATTEMPTS veces, y un error tras el cual otro proceso ya registró
+    el paso cuenta como aplicado.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return 0
+    with _schema_lock:
+        if _schema_ready:
+            return 0
+        version, replica_triggers, index_names = _read_schema_state()
+        applied = 0
+        for step_version, name, step in _MIGRATIONS:
+            if step_version <= version:
+                continue
+            started = time.perf_counter()
+            if _apply_migration_step(step_version, name, step):
+                applied += 1
+                print(f"[SCHEMA] Migración {step_version} aplicada ({name}) en "
+                      f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+        # Índices: pasada idempotente fuera de las versiones, solo si falta alguno; los que
+        # fallan (p. ej. tabla aún inexistente) quedan pendientes para el siguiente arranque
+        if applied or _indexes_pending(index_names):
+            create_database_indexes()
+
+        # Registro de cambios para la réplica local: depende de la configuración, no de la
+        # versión, y va después de los pasos (calculated_dates puede haberse recreado). Sin
+        # réplica se eliminan: nadie purgaría el registro y cada escritura pagaría sus filas
+        if _replica_settings['enabled']:
+            from local_replica import REPLICATED_TABLES
+            if applied or replica_triggers < 3 * len(REPLICATED_TABLES):
+                _install_replica_changelog(mark_gap=replica_triggers < 3 * len(REPLICATED_TABLES))
+        elif replica_triggers:
+            _drop_replica_changelog()
+        _schema_ready = True
+        return applied
+
+def init_database():
+    """Inicializa la base de datos y aplica las migraciones pendientes"""
+    if _schema_ready:
+        return
+    try:
+        db_path = get_database_path()
+        config = get_db_config()
+        
+        print(f"[GREEN LOGISTICS] Inicializando base de datos: {db_path}")
+        print(f"[GREEN LOGISTICS] Entorno: {config.get_environment()}")
+        print(f"[GREEN LOGISTICS] Descripción: {config.db_config['description']}")
+        
+    except Exception as e:
+        print(f"[GREEN LOGISTICS] ERROR en inicialización de BD: {e}")
+        import streamlit as st
+        st.error(f"❌ Error de configuración de base de datos: {str(e)}")
+        st.stop()
+        return
+    
+    applied = migrate_schema()
+    if applied:
+        print(f"[GREEN LOGISTICS] {applied} migraciones aplicadas")
+
+
+# === COLA DE ESCRITURA DIFERIDA (write-behind) ===
+#
+# Escrituras "fire-and-forget" que no deben bloquear la petición (eventos de login,
+# last_login). Un hilo en segundo plano las confirma por lotes en una sola
+# transacción cada GL_WRITE_BEHIND_FLUSH_MS o al juntar GL_WRITE_BEHIND_BATCH_ROWS
+# filas, y la cola se vacía al terminar el proceso.
+
+class _PendingWrite:
+    """Escritura encolada: sentencia, parámetros y tablas a marcar como modificadas"""
+    __slots__ = ('query', 'params', 'tables', 'enqueued_at', 'attempts')
+    
+    def __init__(self, query, params, tables):
+        self.query = query
+        self.params = params
+        self.tables = tables
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class WriteBehindQueue:
+    """Cola de escrituras diferidas que un hilo confirma por lotes"""
+    
+    # Intentos por escritura antes de descartarla (p. ej. con la BD caída)
+    MAX_ATTEMPTS = 3
+    
+    def __init__(self, flush_ms=500, batch_rows=100, max_queue=10000, enabled=True):
+        self.flush_interval = max(flush_ms, 1) / 1000
+        self.batch_rows = max(batch_rows, 1)
+        self.max_queue = max_queue
+        self.enabled = enabled
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._closed = False
+        self._flush_requested = False
+        self._in_flight = 0
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.sync_writes = 0
+        self.max_depth = 0
+        self.last_batch_ms = 0.0
+        self.max_latency_ms = 0.0
+        self._latency_total_ms = 0.0
     
-    conn.commit()
+    def enqueue(self, query, params=(), tables=()):
+        """Encola una escritura; si la cola está deshabilitada, cerrada o llena, la ejecuta ya"""
+        item = _PendingWrite(query, tuple(params), tuple(tables))
+        with self._cond:
+            if self.enabled and not self._closed and (not self.max_queue or len(self._pending) < self.max_queue):
+                self._pending.append(item)
+                self.enqueued += 1
+                self.max_depth = max(self.max_depth, len(self._pending))
+                self._ensure_worker()
+                self._cond.notify_all()
+                return True
+            self.sync_writes += 1
+        self._commit([item])
+        return False
+    
+    def _ensure_worker(self):
+        """Arranca el hilo de escritura en el primer encolado (requiere el lock)"""
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+            self._worker.start()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # Esperar a completar un lote o a que venza el plazo de la escritura más antigua
+                deadline = self._pending[0].enqueued_at + self.flush_interval
+                while len(self._pending) < self.batch_rows and not (self._closed or self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(self.batch_rows, len(self._pending)))]
+                self._in_flight += len(batch)
+            
+            committed = self._commit(batch)
+            with self._cond:
+                self._in_flight -= len(batch)
+                self._cond.notify_all()
+            if not committed and not self._closed:
+                time.sleep(self.flush_interval)
+    
+    def _commit(self, batch):
+        """Confirma un lote en una transacción; reencola las escrituras que aún tienen intentos"""
+        started = time.perf_counter()
+        try:
+            with transaction() as tx:
+                # Sentencias iguales consecutivas van en un solo executemany (un roundtrip)
+                for query, run in groupby(batch, key=lambda item: item.query):
+                    tx.executemany(query, [item.params for item in run])
+                tables = sorted({table for item in batch for table in item.tables})
+                if tables:
+                    mark_tables_changed(*tables)
+        except Exception as e:
+            if len(batch) > 1 and not _is_connection_error(e):
+                # Error SQL de alguna escritura: confirmar el resto una a una para aislarla
+                print(f"[WRITE-BEHIND] Error confirmando lote de {len(batch)} escrituras, reintentando una a una: {e}")
+                results = [self._commit([item]) for item in batch]
+                return all(results)
+            for item in batch:
+                item.attempts += 1
+            retry = [item for item in batch if item.attempts < self.MAX_ATTEMPTS]
+            with self._cond:
+                self.failures += 1
+                self.dropped += len(batch) - len(retry)
+                self._pending.extendleft(reversed(retry))
+            print(f"[WRITE-BEHIND] Error confirmando lote de {len(batch)} escrituras "
+                  f"({len(batch) - len(retry)} descartadas): {e}")
+            return False
+        
+        now = time.monotonic()
+        latencies = [(now - item.enqueued_at) * 1000 for item in batch]
+        with self._cond:
+            self.written += len(batch)
+            self.batches += 1
+            self.last_batch_ms = (time.perf_counter() - started) * 1000
+            self._latency_total_ms += sum(latencies)
+            self.max_latency_ms = max(self.max_latency_ms, max(latencies))
+        return True
     
-    # Crear índices para optimizar consultas
-    create_database_indexes()
+    def flush(self, timeout=5):
+        """Confirma ya todo lo pendiente; devuelve True si la cola quedó vacía"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            try:
+                while self._pending or self._in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._worker is None or not self._worker.is_alive():
+                        break
+                    self._cond.wait(remaining)
+            finally:
+                self._flush_requested = False
+            return not self._pending and not self._in_flight
     
-    # Actualizar códigos SAP de frecuencias existentes
-    update_frequency_sap_codes()
+    def close(self, timeout=5):
+        """Detiene el hilo vaciando la cola; lo que quede se escribe de forma síncrona.
+
+        Sin el hilo nadie reintenta: los lotes fallidos vuelven a `_pending` y se
+        reintentan aquí hasta agotar MAX_ATTEMPTS; lo descartado se cuenta en `dropped`.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+            dropped_before = self.dropped
+        if worker is not None and worker.is_alive():
+            worker.join(timeout)
+        while True:
+            with self._cond:
+                leftover = list(self._pending)
+                self._pending.clear()
+            if not leftover:
+                break
+            failed = False
+            while leftover:
+                batch, leftover = leftover[:self.batch_rows], leftover[self.batch_rows:]
+                failed = not self._commit(batch) or failed
+            if failed:
+                time.sleep(self.flush_interval)
+        with self._cond:
+            given_up = self.dropped - dropped_before
+        if given_up:
+            print(f"[WRITE-BEHIND] Cierre: {given_up} escrituras descartadas tras {self.MAX_ATTEMPTS} intentos")
     
-    conn.close()
+    def get_stats(self):
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'queue_depth': len(self._pending) + self._in_flight,
+                'max_depth': self.max_depth,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'batches': self.batches,
+                'avg_batch_rows': self.written / self.batches if self.batches else 0,
+                'avg_latency_ms': self._latency_total_ms / self.written if self.written else 0,
+                'max_latency_ms': self.max_latency_ms,
+                'last_batch_ms': self.last_batch_ms,
+                'failures': self.failures,
+                'dropped': self.dropped,
+                'sync_writes': self.sync_writes,
+                'flush_ms': self.flush_interval * 1000,
+                'batch_rows': self.batch_rows
+            }
+
+_write_behind_settings = get_write_behind_settings()
+_write_behind_queue = WriteBehindQueue(
+    flush_ms=_write_behind_settings['flush_ms'],
+    batch_rows=_write_behind_settings['batch_rows'],
+    max_queue=_write_behind_settings['max_queue'],
+    enabled=_write_behind_settings['enabled']
+)
+# Vaciar la cola al terminar el proceso (el hilo es daemon)
+atexit.register(_write_behind_queue.close)
+
+def enqueue_write(query, params=(), tables=()):
+    """Encola una escritura no crítica (sin resultado) para confirmarla por lotes en segundo plano"""
+    return _write_behind_queue.enqueue(query, params, tables)
+
+def flush_write_behind(timeout=5):
+    """Confirma de inmediato las escrituras diferidas pendientes"""
+    return _write_behind_queue.flush(timeout)
+
+def get_write_behind_stats():
+    """Profundidad de la cola, latencia encolado→commit y lotes de la cola de escritura diferida"""
+    return _write_behind_queue.get_stats()
 
 
 # === FUNCIONES DE USUARIOS ===
@@ -815,8 +3123,6 @@ def _deserialize_permissions(raw: str) -> dict:
 
 def get_user_by_username(username: str, include_inactive: bool = False) -> dict | None:
     """Obtiene un usuario por username."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
         query = '''
             SELECT id, username, password_hash, role, name, permissions, country_filter,
@@ -827,8 +3133,9 @@ def get_user_by_username(username: str, include_inactive: bool = False) -> dict
             LIMIT 1
         '''.replace("{status_filter}", "" if include_inactive else "AND is_active = 1")
 
-        cursor.execute(query, (username,))
-        row = cursor.fetchone()
+        with read() as cursor:
+            cursor.execute(query, (username,))
+            row = cursor.fetchone()
         if not row:
             return None
 
@@ -853,8 +3160,6 @@ def get_user_by_username(username: str, include_inactive: bool = False) -> dict
     except Exception as e:
         print(f"Error obteniendo usuario {username}: {e}")
         return None
-    finally:
-        return_pooled_connection(conn)
 
 
 def list_users(include_inactive: bool = False):
@@ -878,34 +3183,28 @@ def create_user(username: str, password_hash: str, role: str, name: str, permiss
                 country_filter: str | None, created_by: str | None = None,
                 must_reset_password: bool = False, is_active: bool = True) -> bool:
     """Crea un usuario nuevo."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute('''
-            INSERT INTO users (username, password_hash, role, name, permissions, country_filter,
-                               is_active, must_reset_password, failed_attempts, created_by, updated_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
-        ''', (
-            username.strip(),
-            password_hash,
-            role,
-            name.strip(),
-            _serialize_permissions(permissions),
-            country_filter.strip() if country_filter else None,
-            1 if is_active else 0,
-            1 if must_reset_password else 0,
-            created_by,
-            created_by
-        ))
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                INSERT INTO users (username, password_hash, role, name, permissions, country_filter,
+                                   is_active, must_reset_password, failed_attempts, created_by, updated_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+            ''', (
+                username.strip(),
+                password_hash,
+                role,
+                name.strip(),
+                _serialize_permissions(permissions),
+                country_filter.strip() if country_filter else None,
+                1 if is_active else 0,
+                1 if must_reset_password else 0,
+                created_by,
+                created_by
+            ))
         return True
     except Exception as e:
-        conn.rollback()
         print(f"Error creando usuario {username}: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def update_user(username: str, name: str | None = None, role: str | None = None,
@@ -946,93 +3245,86 @@ def update_user(username: str, name: str | None = None, role: str | None = None,
     params.append(username)
     sql = f"UPDATE users SET {', '.join(fields)} WHERE username = ?"
 
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(sql, params)
-        conn.commit()
-        return cursor.rowcount > 0
+        with transaction() as tx:
+            tx.execute(sql, params)
+            updated = tx.rowcount > 0
+        return updated
     except Exception as e:
-        conn.rollback()
         print(f"Error actualizando usuario {username}: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def set_user_password(username: str, password_hash: str, updated_by: str | None = None,
                       must_reset_password: bool = False) -> bool:
     """Actualiza contraseña y limpia bloqueos."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute('''
-            UPDATE users
-            SET password_hash = ?, failed_attempts = 0, locked_until = NULL,
-                must_reset_password = 0, updated_at = CURRENT_TIMESTAMP, updated_by = ?
-            WHERE username = ?
-        ''', (password_hash, updated_by, username))
-        conn.commit()
-        return cursor.rowcount > 0
+        with transaction() as tx:
+            tx.execute('''
+                UPDATE users
+                SET password_hash = ?, failed_attempts = 0, locked_until = NULL,
+                    must_reset_password = 0, updated_at = CURRENT_TIMESTAMP, updated_by = ?
+                WHERE username = ?
+            ''', (password_hash, updated_by, username))
+            updated = tx.rowcount > 0
+        return updated
     except Exception as e:
-        conn.rollback()
         print(f"Error actualizando contraseña para {username}: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def record_login_failure(username: str, max_attempts: int = 5, lock_minutes: int = 15):
     """Incrementa intentos fallidos y aplica lockout temporal."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute('''
-            UPDATE users
-            SET failed_attempts = failed_attempts + 1,
-                locked_until = CASE WHEN failed_attempts + 1 >= ? THEN ? ELSE locked_until END,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE username = ?
-        ''', (max_attempts, (datetime.utcnow() + timedelta(minutes=lock_minutes)).isoformat(), username))
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                UPDATE users
+                SET failed_attempts = failed_attempts + 1,
+                    locked_until = CASE WHEN failed_attempts + 1 >= ? THEN ? ELSE locked_until END,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE username = ?
+            ''', (max_attempts, (datetime.utcnow() + timedelta(minutes=lock_minutes)).isoformat(), username))
     except Exception as e:
-        conn.rollback()
         print(f"Error registrando intento fallido para {username}: {e}")
-    finally:
-        return_pooled_connection(conn)
 
 
-def record_login_success(username: str):
-    """Limpia contadores tras login exitoso."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
+def _utc_timestamp() -> str:
+    """Marca de tiempo UTC con el formato de CURRENT_TIMESTAMP (para escrituras diferidas)"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def record_login_success(username: str, clear_lockout: bool = True):
+    """Limpia contadores tras login exitoso.
+
+    Con `clear_lockout=False` (sin intentos fallidos ni bloqueo que limpiar) solo
+    queda actualizar last_login, que se encola en la escritura diferida.
+    """
+    if not clear_lockout:
+        timestamp = _utc_timestamp()
+        enqueue_write(
+            "UPDATE users SET last_login = ?, updated_at = ? WHERE username = ?",
+            (timestamp, timestamp, username)
+        )
+        return
+
     try:
-        cursor.execute('''
-            UPDATE users
-            SET failed_attempts = 0, locked_until = NULL, last_login = CURRENT_TIMESTAMP,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE username = ?
-        ''', (username,))
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                UPDATE users
+                SET failed_attempts = 0, locked_until = NULL, last_login = CURRENT_TIMESTAMP,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE username = ?
+            ''', (username,))
     except Exception as e:
-        conn.rollback()
         print(f"Error registrando login exitoso para {username}: {e}")
-    finally:
-        return_pooled_connection(conn)
 
 
 def record_login_event(username: str):
-    """Registra un login exitoso para analítica de uso."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
+    """Registra un login exitoso para analítica de uso (escritura diferida)."""
     try:
-        cursor.execute('INSERT INTO login_events (username) VALUES (?)', (username,))
-        conn.commit()
+        enqueue_write('INSERT INTO login_events (username, login_at) VALUES (?, ?)', (username, _utc_timestamp()))
     except Exception as e:
-        conn.rollback()
         print(f"Error registrando login_event para {username}: {e}")
-    finally:
-        return_pooled_connection(conn)
 
 
 def get_login_counts_by_day(year: int, month: int):
@@ -1059,36 +3351,33 @@ def get_login_counts_by_day(year: int, month: int):
 def ensure_admin_user(username: str, password_hash: str, name: str, role: str,
                       permissions: dict, country_filter: str | None = None):
     """Crea o actualiza el usuario administrador base (idempotente)."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-        row = cursor.fetchone()
-        perm_json = _serialize_permissions(permissions)
+        with transaction() as tx:
+            tx.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
+            row = tx.fetchone()
+            perm_json = _serialize_permissions(permissions)
 
-        if row:
-            cursor.execute('''
-                UPDATE users
-                SET role = ?, name = ?, permissions = ?, country_filter = ?, is_active = 1,
-                    password_hash = ?, must_reset_password = 0, updated_at = CURRENT_TIMESTAMP,
-                    updated_by = 'system'
-                WHERE username = ?
-            ''', (role, name, perm_json, country_filter, password_hash, username))
-        else:
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, role, name, permissions, country_filter,
-                                   is_active, must_reset_password, created_by, updated_by)
-                VALUES (?, ?, ?, ?, ?, ?, 1, 0, 'system', 'system')
-            ''', (username, password_hash, role, name, perm_json, country_filter))
-        conn.commit()
+            if row:
+                tx.execute('''
+                    UPDATE users
+                    SET role = ?, name = ?, permissions = ?, country_filter = ?, is_active = 1,
+                        password_hash = ?, must_reset_password = 0, updated_at = CURRENT_TIMESTAMP,
+                        updated_by = 'system'
+                    WHERE username = ?
+                ''', (role, name, perm_json, country_filter, password_hash, username))
+            else:
+                tx.execute('''
+                    INSERT INTO users (username, password_hash, role, name, permissions, country_filter,
+                                       is_active, must_reset_password, created_by, updated_by)
+                    VALUES (?, ?, ?, ?, ?, ?, 1, 0, 'system', 'system')
+                ''', (username, password_hash, role, name, perm_json, country_filter))
     except Exception as e:
-        conn.rollback()
         print(f"Error asegurando usuario admin {username}: {e}")
-    finally:
-        return_pooled_connection(conn)
 
 # === FUNCIONES DE CLIENTES OPTIMIZADAS ===
 
+_CLIENTS_QUERY = "SELECT * FROM clients ORDER BY name"
+
 def get_clients(use_cache=True):
     """Obtiene todos los clientes con cache optimizado y filtro por país"""
     from auth_system import get_user_country_filter
@@ -1098,7 +3387,8 @@ def get_clients(use_cache=True):
         print(f"[DEBUG] get_clients() iniciando, use_cache={use_cache}")
         
         # Obtener todos los clientes
-        df = execute_query_df("SELECT * FROM clients ORDER BY name", use_cache=use_cache, cache_ttl=120)
+        df = execute_query_df(_CLIENTS_QUERY, use_cache=use_cache, cache_ttl=120, cache_family='clients',
+                              schema=CLIENTS_SCHEMA)
         print(f"[DEBUG] execute_query_df retornó {len(df)} clientes")
         
         # Aplicar filtro de país si el usuario lo tiene
@@ -1124,7 +3414,8 @@ def get_clients_summary():
     
     try:
         query = "SELECT id, name, codigo_ag, codigo_we, tipo_cliente, region, pais FROM clients ORDER BY name"
-        df = execute_query_df(query, use_cache=True, cache_ttl=300)
+        df = execute_query_df(query, use_cache=True, cache_ttl=300, cache_family='clients',
+                              schema=CLIENTS_SCHEMA)
         
         # Aplicar filtro de país si el usuario lo tiene
         country_filter = get_user_country_filter()
@@ -1147,7 +3438,9 @@ def get_clients_batch(client_ids):
     try:
         placeholders = ','.join(['?' for _ in client_ids])
         query = f"SELECT * FROM clients WHERE id IN ({placeholders}) ORDER BY name"
-        df = execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=60)
+        df = execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=60,
+                              cache_tags=[client_tag(client_id) for client_id in client_ids],
+                              cache_family='clients', schema=CLIENTS_SCHEMA)
         
         # Aplicar filtro de país si el usuario lo tiene
         country_filter = get_user_country_filter()
@@ -1163,7 +3456,8 @@ def get_clients_batch(client_ids):
 def get_client_by_id(client_id, use_cache=True):
     """Obtiene un cliente por su ID - Versión optimizada con cache y filtro por país"""
     from auth_system import get_user_country_filter
-    
+
+    use_cache = _cacheable(use_cache)
     if use_cache:
         # Intentar obtener del cache primero
         cache_key = f"client_{client_id}"
@@ -1175,213 +3469,187 @@ def get_client_by_id(client_id, use_cache=True):
                 if cached_client.get('pais') != country_filter:
                     return None  # Cliente no accesible para este usuario
             return cached_client
-    
-    conn = get_pooled_connection()
+
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
-        client_data = cursor.fetchone()
-        
+        with read() as cursor:
+            cursor.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
+            client_data = cursor.fetchone()
+            column_names = [description[0] for description in cursor.description] if client_data else []
+
         if client_data:
-            column_names = [description[0] for description in cursor.description]
             client_dict = dict(zip(column_names, client_data))
             client_series = pd.Series(client_dict)
-            
+
             # Verificar filtro de país
             country_filter = get_user_country_filter()
             if country_filter:
                 if client_dict.get('pais') != country_filter:
                     return None  # Cliente no accesible para este usuario
-            
+
             # Guardar en cache
             if use_cache:
                 cache_key = f"client_{client_id}"
-                _db_cache.set(cache_key, client_series, 60)
-            
+                _db_cache.set(cache_key, client_series, 60, tags=[client_tag(client_id)])
+
             print(f"Cliente encontrado: {client_dict}")
             return client_series
         else:
             print(f"No se encontró cliente con ID {client_id}")
             return None
-            
+
     except Exception as e:
         print(f"Error obteniendo cliente {client_id}: {e}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         return None
-    finally:
-        return_pooled_connection(conn)
 
 def add_client(name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente='Otro', region='Otro', pais='Colombia', numero_tarea_sap=0, estado='', ciudad=''):
     """Agrega un nuevo cliente con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            INSERT INTO clients (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad))
-        client_id = cursor.lastrowid
-        
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                INSERT INTO clients (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad))
+            client_id = tx.lastrowid
+
+            # Invalidar cache relacionado con clientes
+            mark_tables_changed('clients')
+
         print(f"Cliente {client_id} creado exitosamente")
-        
-        # Invalidar cache relacionado con clientes
-        _db_cache.invalidate_pattern("clients")
-        
         return client_id
-        
+
     except Exception as e:
         print(f"Error creando cliente: {e}")
-        conn.rollback()
         return None
-    finally:
-        return_pooled_connection(conn)
 
 def update_client(client_id, name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente='Otro', region='Otro', pais='Colombia', numero_tarea_sap=0, estado='', ciudad=''):
     """Actualiza la información de un cliente con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Debug: verificar que el cliente existe antes de actualizar
-        cursor.execute("SELECT id, name FROM clients WHERE id = ?", (client_id,))
-        existing_client = cursor.fetchone()
-        
-        if not existing_client:
-            print(f"Error: Cliente con ID {client_id} no encontrado")
-            return False
-        
-        print(f"Cliente encontrado: ID {existing_client[0]}, Nombre: {existing_client[1]}")
-        print(f"Actualizando con nuevos datos:")
-        print(f"  Nombre: '{name}'")
-        print(f"  Código AG: '{codigo_ag}'")
-        print(f"  Código WE: '{codigo_we}'")
-        print(f"  CSR: '{csr}'")
-        print(f"  Vendedor: '{vendedor}'")
-        print(f"  Calendario SAP: '{calendario_sap}'")
-        print(f"  Numero Tarea SAP: '{numero_tarea_sap}'")
-        print(f"  Estado: '{estado}'")
-        print(f"  Ciudad: '{ciudad}'")
-        print(f"  Tipo Cliente: '{tipo_cliente}'")
-        print(f"  Región: '{region}'")
-        print(f"  País: '{pais}'")
-        
-        # Realizar la actualización
-        cursor.execute('''
-            UPDATE clients 
-            SET name = ?, codigo_ag = ?, codigo_we = ?, csr = ?, vendedor = ?, calendario_sap = ?, tipo_cliente = ?, region = ?, pais = ?, numero_tarea_sap = ?, estado = ?, ciudad = ?
-            WHERE id = ?
-        ''', (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad, client_id))
-        
-        # Verificar que se actualizó al menos una fila
-        if cursor.rowcount == 0:
-            print(f"Advertencia: No se actualizó ninguna fila para cliente ID {client_id}")
-            conn.rollback()
-            return False
-        
-        conn.commit()
-        
-        # Verificar la actualización
-        cursor.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
-        updated_client = cursor.fetchone()
+        with transaction() as tx:
+            # Debug: verificar que el cliente existe antes de actualizar
+            tx.execute("SELECT id, name FROM clients WHERE id = ?", (client_id,))
+            existing_client = tx.fetchone()
+
+            if not existing_client:
+                print(f"Error: Cliente con ID {client_id} no encontrado")
+                return False
+
+            print(f"Cliente encontrado: ID {existing_client[0]}, Nombre: {existing_client[1]}")
+            print(f"Actualizando con nuevos datos:")
+            print(f"  Nombre: '{name}'")
+            print(f"  Código AG: '{codigo_ag}'")
+            print(f"  Código WE: '{codigo_we}'")
+            print(f"  CSR: '{csr}'")
+            print(f"  Vendedor: '{vendedor}'")
+            print(f"  Calendario SAP: '{calendario_sap}'")
+            print(f"  Numero Tarea SAP: '{numero_tarea_sap}'")
+            print(f"  Estado: '{estado}'")
+            print(f"  Ciudad: '{ciudad}'")
+            print(f"  Tipo Cliente: '{tipo_cliente}'")
+            print(f"  Región: '{region}'")
+            print(f"  País: '{pais}'")
+
+            # Realizar la actualización
+            tx.execute('''
+                UPDATE clients
+                SET name = ?, codigo_ag = ?, codigo_we = ?, csr = ?, vendedor = ?, calendario_sap = ?, tipo_cliente = ?, region = ?, pais = ?, numero_tarea_sap = ?, estado = ?, ciudad = ?
+                WHERE id = ?
+            ''', (name, codigo_ag, codigo_we, csr, vendedor, calendario_sap, tipo_cliente, region, pais, numero_tarea_sap, estado, ciudad, client_id))
+            updated_rows = tx.rowcount
+
+            # Verificar que se actualizó al menos una fila
+            if updated_rows == 0:
+                print(f"Advertencia: No se actualizó ninguna fila para cliente ID {client_id}")
+                tx.rollback()
+                return False
+
+            # Verificar la actualización
+            tx.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
+            updated_client = tx.fetchone()
+
+            # Invalidar cache relacionado con este cliente específico
+            invalidate_client_cache(client_id, ['clients'])
+
         print(f"Cliente actualizado exitosamente:")
         print(f"  Datos finales: {updated_client}")
-        
-        print(f"Cliente ID {client_id} actualizado exitosamente. Filas afectadas: {cursor.rowcount}")
-        
-        # Invalidar cache relacionado con este cliente específico
-        _db_cache.invalidate_pattern("clients")
-        _db_cache.invalidate_pattern(f"client_{client_id}")
-        
+        print(f"Cliente ID {client_id} actualizado exitosamente. Filas afectadas: {updated_rows}")
+
         return True
-        
+
     except Exception as e:
         print(f"Error actualizando cliente ID {client_id}: {e}")
         import traceback
         print(f"Traceback completo: {traceback.format_exc()}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 def delete_client(client_id):
     """Elimina un cliente y todos sus datos relacionados con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Verificar que el cliente existe
-        cursor.execute("SELECT id, name FROM clients WHERE id = ?", (client_id,))
-        existing_client = cursor.fetchone()
-        
-        if not existing_client:
-            print(f"Error: Cliente con ID {client_id} no encontrado")
-            return False
-        
-        client_name = existing_client[1]
-        print(f"Eliminando cliente: ID {client_id}, Nombre: {client_name}")
-        
-        # Usar transacción para mantener consistencia
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Eliminar en orden para mantener integridad referencial
-        # 1. Eliminar fechas calculadas
-        cursor.execute("DELETE FROM calculated_dates WHERE client_id = ?", (client_id,))
-        deleted_dates = cursor.rowcount
-        print(f"  Fechas calculadas eliminadas: {deleted_dates}")
-        
-        # 2. Eliminar actividades del cliente
-        cursor.execute("DELETE FROM client_activities WHERE client_id = ?", (client_id,))
-        deleted_activities = cursor.rowcount
-        print(f"  Actividades eliminadas: {deleted_activities}")
-        
-        # 3. Eliminar el cliente
-        cursor.execute("DELETE FROM clients WHERE id = ?", (client_id,))
-        deleted_client = cursor.rowcount
-        
-        if deleted_client == 0:
-            print(f"Error: No se pudo eliminar el cliente ID {client_id}")
-            conn.rollback()
-            return False
-        
-        conn.commit()
+        # Una sola transacción para mantener consistencia
+        with transaction() as tx:
+            # Verificar que el cliente existe
+            tx.execute("SELECT id, name FROM clients WHERE id = ?", (client_id,))
+            existing_client = tx.fetchone()
+
+            if not existing_client:
+                print(f"Error: Cliente con ID {client_id} no encontrado")
+                return False
+
+            client_name = existing_client[1]
+            print(f"Eliminando cliente: ID {client_id}, Nombre: {client_name}")
+
+            # Eliminar en orden para mantener integridad referencial
+            # 1. Eliminar fechas calculadas
+            tx.execute("DELETE FROM calculated_dates WHERE client_id = ?", (client_id,))
+            deleted_dates = tx.rowcount
+            print(f"  Fechas calculadas eliminadas: {deleted_dates}")
+
+            # 2. Eliminar actividades del cliente
+            tx.execute("DELETE FROM client_activities WHERE client_id = ?", (client_id,))
+            deleted_activities = tx.rowcount
+            print(f"  Actividades eliminadas: {deleted_activities}")
+
+            # 3. Eliminar el cliente
+            tx.execute("DELETE FROM clients WHERE id = ?", (client_id,))
+            deleted_client = tx.rowcount
+
+            if deleted_client == 0:
+                print(f"Error: No se pudo eliminar el cliente ID {client_id}")
+                tx.rollback()
+                return False
+
+            # Invalidar todo el cache relacionado con clientes y este cliente específico
+            invalidate_client_cache(client_id, ['clients', 'client_activities', 'calculated_dates'])
+
         print(f"Cliente '{client_name}' (ID {client_id}) eliminado exitosamente")
         print(f"  Total eliminado: 1 cliente, {deleted_activities} actividades, {deleted_dates} fechas")
-        
-        # Invalidar todo el cache relacionado con clientes y este cliente específico
-        _db_cache.invalidate_pattern("clients")
-        _db_cache.invalidate_pattern(f"client_{client_id}")
-        _db_cache.invalidate_pattern(f"activities_{client_id}")
-        _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
+
         return True
-        
+
     except Exception as e:
         print(f"Error eliminando cliente ID {client_id}: {e}")
         import traceback
         print(f"Traceback completo: {traceback.format_exc()}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 # === FUNCIONES DE FRECUENCIAS OPTIMIZADAS ===
 
 def get_frequency_templates(use_cache=True):
     """Obtiene todas las plantillas de frecuencias con cache"""
     try:
-        return execute_query_df("SELECT * FROM frequency_templates ORDER BY name", use_cache=use_cache, cache_ttl=300)
+        return execute_query_df("SELECT * FROM frequency_templates ORDER BY name", use_cache=use_cache,
+                                cache_ttl=READ_MOSTLY_CACHE_TTL)
     except Exception as e:
         print(f"Error obteniendo frecuencias: {e}")
         return pd.DataFrame()
 
 def get_frequency_template_by_id(template_id, use_cache=True):
     """Obtiene una plantilla de frecuencia específica"""
+    use_cache = _cacheable(use_cache)
     if use_cache:
         cache_key = f"frequency_{template_id}"
-        cached_freq = _db_cache.get(cache_key, 300)
+        cached_freq = _db_cache.get(cache_key, READ_MOSTLY_CACHE_TTL)
         if cached_freq is not None:
             return cached_freq
     
@@ -1391,7 +3659,7 @@ def get_frequency_template_by_id(template_id, use_cache=True):
         
         if not df.empty and use_cache:
             cache_key = f"frequency_{template_id}"
-            _db_cache.set(cache_key, df.iloc[0], 300)
+            _db_cache.set(cache_key, df.iloc[0], READ_MOSTLY_CACHE_TTL, tags=[table_tag('frequency_templates')])
             
         return df.iloc[0] if not df.empty else None
     except Exception as e:
@@ -1400,124 +3668,99 @@ def get_frequency_template_by_id(template_id, use_cache=True):
 
 def add_frequency_template(name, frequency_type, frequency_config, description, manual_sap_code=None):
     """Agrega una nueva plantilla de frecuencia con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     # Usar código SAP manual si se proporciona, sino obtener automáticamente basado en el nombre
     if manual_sap_code is not None:
         calendario_sap_code = manual_sap_code.strip() if manual_sap_code.strip() else "0"
     else:
         mapping = get_sap_calendar_mapping()
         calendario_sap_code = mapping.get(name, "0")
-    
+
     try:
-        cursor.execute('''
-            INSERT INTO frequency_templates (name, frequency_type, frequency_config, description, calendario_sap_code)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, frequency_type, frequency_config, description, calendario_sap_code))
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                INSERT INTO frequency_templates (name, frequency_type, frequency_config, description, calendario_sap_code)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, frequency_type, frequency_config, description, calendario_sap_code))
+
+            # Invalidar cache de frecuencias
+            mark_tables_changed('frequency_templates')
         print(f"Frecuencia '{name}' creada con código SAP: {calendario_sap_code}")
-        
-        # Invalidar cache de frecuencias
-        _db_cache.invalidate_pattern("frequency")
-        
+
         return True
     except Exception as e:
         print(f"Error agregando frecuencia: {e}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 def update_frequency_template(template_id, name, frequency_type, frequency_config, description, manual_sap_code=None):
     """Actualiza una plantilla de frecuencia existente"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # Usar código SAP manual si se proporciona, sino obtener automáticamente basado en el nombre
     if manual_sap_code is not None:
         calendario_sap_code = manual_sap_code.strip() if manual_sap_code.strip() else "0"
     else:
         mapping = get_sap_calendar_mapping()
         calendario_sap_code = mapping.get(name, "0")
-    
+
     try:
-        cursor.execute('''
-            UPDATE frequency_templates 
-            SET name = ?, frequency_type = ?, frequency_config = ?, description = ?, calendario_sap_code = ?
-            WHERE id = ?
-        ''', (name, frequency_type, frequency_config, description, calendario_sap_code, template_id))
-        
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                UPDATE frequency_templates
+                SET name = ?, frequency_type = ?, frequency_config = ?, description = ?, calendario_sap_code = ?
+                WHERE id = ?
+            ''', (name, frequency_type, frequency_config, description, calendario_sap_code, template_id))
+
+            # Invalidar cache de frecuencias (incluye actividades que las referencian)
+            mark_tables_changed('frequency_templates')
         print(f"Frecuencia '{name}' actualizada exitosamente con código SAP: {calendario_sap_code}")
         return True
     except Exception as e:
         print(f"Error actualizando frecuencia: {e}")
-        conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def delete_frequency_template(template_id):
     """Elimina una plantilla de frecuencia"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Verificar si la frecuencia está siendo usada por algún cliente
-        cursor.execute('''
-            SELECT COUNT(*) FROM client_activities 
-            WHERE frequency_template_id = ?
-        ''', (template_id,))
-        
-        usage_count = cursor.fetchone()[0]
-        
-        if usage_count > 0:
-            print(f"No se puede eliminar: la frecuencia está siendo usada por {usage_count} actividades")
-            return False, f"Esta frecuencia está siendo usada por {usage_count} actividad(es). No se puede eliminar."
-        
-        cursor.execute('DELETE FROM frequency_templates WHERE id = ?', (template_id,))
-        
-        conn.commit()
+        with transaction() as tx:
+            # Verificar si la frecuencia está siendo usada por algún cliente
+            tx.execute('''
+                SELECT COUNT(*) FROM client_activities
+                WHERE frequency_template_id = ?
+            ''', (template_id,))
+
+            usage_count = tx.fetchone()[0]
+
+            if usage_count > 0:
+                print(f"No se puede eliminar: la frecuencia está siendo usada por {usage_count} actividades")
+                return False, f"Esta frecuencia está siendo usada por {usage_count} actividad(es). No se puede eliminar."
+
+            tx.execute('DELETE FROM frequency_templates WHERE id = ?', (template_id,))
+            mark_tables_changed('frequency_templates')
+
         print(f"Frecuencia eliminada exitosamente")
         return True, "Frecuencia eliminada exitosamente"
-        
+
     except Exception as e:
         print(f"Error eliminando frecuencia: {e}")
-        conn.rollback()
         return False, f"Error al eliminar frecuencia: {e}"
-    finally:
-        conn.close()
 
 def get_frequency_usage_count(template_id):
     """Obtiene el número de actividades que usan una frecuencia específica"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            SELECT COUNT(*) FROM client_activities 
-            WHERE frequency_template_id = ?
-        ''', (template_id,))
-        
-        count = cursor.fetchone()[0]
+        with read() as cursor:
+            cursor.execute('''
+                SELECT COUNT(*) FROM client_activities
+                WHERE frequency_template_id = ?
+            ''', (template_id,))
+
+            count = cursor.fetchone()[0]
         return count
     except Exception as e:
         print(f"Error obteniendo uso de frecuencia: {e}")
         return 0
-    finally:
-        conn.close()
 
 # === FUNCIONES DE ACTIVIDADES OPTIMIZADAS ===
 
 def get_client_activities(client_id, use_cache=True):
     """Obtiene las actividades de un cliente en orden específico con cache"""
-    if use_cache:
-        cache_key = f"activities_{client_id}"
-        cached_activities = _db_cache.get(cache_key, 120)
-        if cached_activities is not None:
-            return cached_activities
-    
     try:
         query = '''
             SELECT
@@ -1543,13 +3786,16 @@ def get_client_activities(client_id, use_cache=True):
                 END,
                 COALESCE(ac.name, ca.activity_name)
         '''
-        df = execute_query_df(query, params=(client_id,))
-        
-        if use_cache:
-            cache_key = f"activities_{client_id}"
-            _db_cache.set(cache_key, df, 120)
-        
-        return df
+        if not _cacheable(use_cache):
+            return execute_query_df(query, params=(client_id,))
+        
+        # Single-flight: sesiones concurrentes comparten la misma lectura
+        return _db_cache.get_or_load(
+            f"activities_{client_id}",
+            lambda: execute_query_df(query, params=(client_id,)),
+            120,
+            tags=[client_tag(client_id), table_tag('frequency_templates'), table_tag('activities_catalog')]
+        )
     except Exception as e:
         print(f"Error obteniendo actividades del cliente {client_id}: {e}")
         return pd.DataFrame()
@@ -1585,190 +3831,203 @@ def get_multiple_client_activities(client_ids):
                 END,
                 COALESCE(ac.name, ca.activity_name)
         '''
-        return execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=120)
+        cache_tags = [client_tag(client_id) for client_id in client_ids]
+        cache_tags += [table_tag('frequency_templates'), table_tag('activities_catalog')]
+        return execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=120, cache_tags=cache_tags)
     except Exception as e:
         print(f"Error obteniendo actividades batch: {e}")
         return pd.DataFrame()
 
 def create_default_activities(client_id):
     """Crea las actividades predeterminadas para un cliente"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar que existan las frecuencias predeterminadas
-    cursor.execute("SELECT COUNT(*) FROM frequency_templates")
-    if cursor.fetchone()[0] == 0:
-        conn.close()
-        return
-    
     # Actividades predeterminadas en el orden requerido
     default_activities = [
         ("Fecha Envío OC", 1, 1),   # (nombre, activity_id, frequency_template_id)
         ("Albaranado", 2, 2),       # (nombre, activity_id, frequency_template_id)
         ("Fecha Entrega", 3, 3)     # (nombre, activity_id, frequency_template_id)
     ]
-    
+
     try:
-        for activity_name, activity_id, freq_id in default_activities:
-            cursor.execute('''
-                SELECT COUNT(*) FROM client_activities 
-                WHERE client_id = ? AND activity_name = ?
-            ''', (client_id, activity_name))
-            
-            if cursor.fetchone()[0] == 0:
-                cursor.execute('''
-                    INSERT INTO client_activities (client_id, activity_id, activity_name, frequency_template_id)
-                    VALUES (?, ?, ?, ?)
-                ''', (client_id, activity_id, activity_name, freq_id))
-                print(f"Creada actividad: {activity_name} para cliente {client_id}")
-                
-                # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
-                if activity_name == "Albaranado":
-                    auto_update_client_calendario_sap(client_id, activity_name, freq_id)
-        
-        conn.commit()
+        with transaction() as tx:
+            # Verificar que existan las frecuencias predeterminadas
+            tx.execute("SELECT COUNT(*) FROM frequency_templates")
+            if tx.fetchone()[0] == 0:
+                return
+
+            for activity_name, activity_id, freq_id in default_activities:
+                tx.execute('''
+                    SELECT COUNT(*) FROM client_activities
+                    WHERE client_id = ? AND activity_name = ?
+                ''', (client_id, activity_name))
+
+                if tx.fetchone()[0] == 0:
+                    tx.execute('''
+                        INSERT INTO client_activities (client_id, activity_id, activity_name, frequency_template_id)
+                        VALUES (?, ?, ?, ?)
+                    ''', (client_id, activity_id, activity_name, freq_id))
+                    print(f"Creada actividad: {activity_name} para cliente {client_id}")
+
+                    # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
+                    # (misma conexión y transacción: SAVEPOINT)
+                    if activity_name == "Albaranado":
+                        auto_update_client_calendario_sap(client_id, activity_name, freq_id)
+
+            invalidate_client_cache(client_id, ['client_activities'])
     except Exception as e:
         print(f"Error creando actividades predeterminadas: {e}")
-    finally:
-        conn.close()
 
 def update_client_activity_frequency(client_id, activity_name, frequency_template_id):
     """Actualiza la frecuencia de una actividad específica con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
-        row = cursor.fetchone()
-        activity_id = row[0] if row else None
+        with transaction() as tx:
+            tx.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
+            row = tx.fetchone()
+            activity_id = row[0] if row else None
+
+            if activity_id is None:
+                tx.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
+                activity_id = tx.fetchone()[0]
+                tx.execute(
+                    "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
+                    (activity_id, activity_name)
+                )
 
-        if activity_id is None:
-            cursor.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
-            activity_id = cursor.fetchone()[0]
-            cursor.execute(
-                "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
-                (activity_id, activity_name)
-            )
+            tx.execute('''
+                UPDATE client_activities
+                SET frequency_template_id = ?, activity_id = ?
+                WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
+            ''', (frequency_template_id, activity_id, client_id, activity_id, activity_name))
 
-        cursor.execute('''
-            UPDATE client_activities 
-            SET frequency_template_id = ?, activity_id = ?
-            WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
-        ''', (frequency_template_id, activity_id, client_id, activity_id, activity_name))
-        
-        conn.commit()
+            # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
+            auto_update_client_calendario_sap(client_id, activity_name, frequency_template_id)
+
+            # Invalidar cache relacionado
+            invalidate_client_cache(client_id, ['client_activities'])
         print(f"Frecuencia actualizada para {activity_name}")
-        
-        # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
-        auto_update_client_calendario_sap(client_id, activity_name, frequency_template_id)
-        
-        # Invalidar cache relacionado
-        _db_cache.invalidate_pattern(f"activities_{client_id}")
-        
+
         return True
     except Exception as e:
         print(f"Error actualizando frecuencia: {e}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 def add_client_activity(client_id, activity_name, frequency_template_id):
     """Agrega una nueva actividad a un cliente con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
-        row = cursor.fetchone()
-        activity_id = row[0] if row else None
+        with transaction() as tx:
+            tx.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
+            row = tx.fetchone()
+            activity_id = row[0] if row else None
+
+            if activity_id is None:
+                tx.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
+                activity_id = tx.fetchone()[0]
+                tx.execute(
+                    "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
+                    (activity_id, activity_name)
+                )
 
-        if activity_id is None:
-            cursor.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
-            activity_id = cursor.fetchone()[0]
-            cursor.execute(
-                "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
-                (activity_id, activity_name)
-            )
+            tx.execute('''
+                INSERT INTO client_activities (client_id, activity_id, activity_name, frequency_template_id)
+                VALUES (?, ?, ?, ?)
+            ''', (client_id, activity_id, activity_name, frequency_template_id))
 
-        cursor.execute('''
-            INSERT INTO client_activities (client_id, activity_id, activity_name, frequency_template_id)
-            VALUES (?, ?, ?, ?)
-        ''', (client_id, activity_id, activity_name, frequency_template_id))
-        
-        conn.commit()
+            # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
+            auto_update_client_calendario_sap(client_id, activity_name, frequency_template_id)
+
+            # Invalidar cache relacionado
+            invalidate_client_cache(client_id, ['client_activities'])
         print(f"Actividad {activity_name} agregada al cliente {client_id}")
-        
-        # Si es la actividad Albaranado, actualizar automáticamente el calendario SAP del cliente
-        auto_update_client_calendario_sap(client_id, activity_name, frequency_template_id)
-        
-        # Invalidar cache relacionado
-        _db_cache.invalidate_pattern(f"activities_{client_id}")
-        
+
         return True
     except Exception as e:
         print(f"Error agregando actividad: {e}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 def delete_client_activity(client_id, activity_name):
     """Elimina una actividad de un cliente con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
-        row = cursor.fetchone()
-        activity_id = row[0] if row else None
-
         # Usar transacción para mantener consistencia
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Eliminar actividad
-        cursor.execute('''
-            DELETE FROM client_activities 
-            WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
-        ''', (client_id, activity_id, activity_name))
-        
-        # Eliminar fechas asociadas
-        cursor.execute('''
-            DELETE FROM calculated_dates 
-            WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
-        ''', (client_id, activity_id, activity_name))
-        
-        conn.commit()
+        with transaction() as tx:
+            tx.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
+            row = tx.fetchone()
+            activity_id = row[0] if row else None
+
+            # Eliminar actividad
+            tx.execute('''
+                DELETE FROM client_activities
+                WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
+            ''', (client_id, activity_id, activity_name))
+
+            # Eliminar fechas asociadas
+            tx.execute('''
+                DELETE FROM calculated_dates
+                WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
+            ''', (client_id, activity_id, activity_name))
+
+            # Invalidar cache relacionado
+            invalidate_client_cache(client_id, ['client_activities', 'calculated_dates'])
         print(f"Actividad {activity_name} eliminada del cliente {client_id}")
-        
-        # Invalidar cache relacionado
-        _db_cache.invalidate_pattern(f"activities_{client_id}")
-        _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
+
         return True
     except Exception as e:
         print(f"Error eliminando actividad: {e}")
-        conn.rollback()
         return False
-    finally:
-        return_pooled_connection(conn)
 
 # === FUNCIONES DE FECHAS OPTIMIZADAS ===
 
+_CALCULATED_DATES_QUERY = '''
+    SELECT
+        cd.id,
+        cd.client_id,
+        cd.activity_id,
+        COALESCE(ac.name, cd.activity_name) as activity_name,
+        cd.date_position,
+        cd.date,
+        cd.is_custom
+    FROM calculated_dates cd
+    LEFT JOIN activities_catalog ac ON ac.id = cd.activity_id
+    WHERE cd.client_id = ?
+    ORDER BY
+        CASE COALESCE(cd.activity_id, 999999)
+            WHEN 1 THEN 1
+            WHEN 2 THEN 2
+            WHEN 3 THEN 3
+            ELSE 4
+        END,
+        cd.date_position
+'''
+
 def get_calculated_dates(client_id, use_cache=True):
     """Obtiene las fechas calculadas para un cliente en orden específico con cache"""
     # Convertir numpy.int64 a int de Python para evitar problemas de serialización
     client_id = int(client_id)
     
-    if use_cache:
-        cache_key = f"dates_{client_id}"
-        cached_dates = _db_cache.get(cache_key, 60)
-        if cached_dates is not None:
-            return cached_dates
+    def load_dates():
+        return _read_query_df(_CALCULATED_DATES_QUERY, (client_id,), schema=CALCULATED_DATES_SCHEMA)
     
-    conn = get_pooled_connection()
     try:
-        dates = pd.read_sql_query('''
+        if not _cacheable(use_cache):
+            return load_dates()
+        
+        # Single-flight: sesiones concurrentes comparten la misma lectura
+        return _db_cache.get_or_load(
+            f"dates_{client_id}",
+            load_dates,
+            60,
+            tags=[client_tag(client_id), table_tag('activities_catalog')]
+        )
+    except Exception as e:
+        print(f"Error en get_calculated_dates: {e}")
+        init_database()
+        try:
+            return load_dates()
+        except:
+            return pd.DataFrame()
+
+def get_calculated_dates_by_month(year, month, use_cache=True):
+    """Obtiene las fechas calculadas de todos los clientes para un mes en una sola consulta"""
+    try:
+        query = '''
             SELECT
                 cd.id,
                 cd.client_id,
@@ -1779,55 +4038,21 @@ def get_calculated_dates(client_id, use_cache=True):
                 cd.is_custom
             FROM calculated_dates cd
             LEFT JOIN activities_catalog ac ON ac.id = cd.activity_id
-            WHERE cd.client_id = ?
-            ORDER BY
-                CASE COALESCE(cd.activity_id, 999999)
-                    WHEN 1 THEN 1
-                    WHEN 2 THEN 2
-                    WHEN 3 THEN 3
-                    ELSE 4
-                END,
-                cd.date_position
-        ''', conn, params=(client_id,))
-        
-        if use_cache:
-            cache_key = f"dates_{client_id}"
-            _db_cache.set(cache_key, dates, 60)
-            
+            WHERE cd.date_year = ? AND cd.date_month = ?
+            ORDER BY cd.client_id, cd.date_position
+        '''
+        # Además de las tablas, la etiqueta del mes: las ediciones puntuales solo invalidan su mes
+        return execute_query_df(
+            query,
+            params=(year, month),
+            use_cache=use_cache,
+            cache_ttl=120,
+            cache_tags=[table_tag('calculated_dates'), table_tag('activities_catalog'), month_tag(year, month)],
+            schema=CALCULATED_DATES_SCHEMA
+        )
     except Exception as e:
-        print(f"Error en get_calculated_dates: {e}")
-        init_database()
-        conn_retry = get_pooled_connection()
-        try:
-            dates = pd.read_sql_query('''
-                SELECT
-                    cd.id,
-                    cd.client_id,
-                    cd.activity_id,
-                    COALESCE(ac.name, cd.activity_name) as activity_name,
-                    cd.date_position,
-                    cd.date,
-                    cd.is_custom
-                FROM calculated_dates cd
-                LEFT JOIN activities_catalog ac ON ac.id = cd.activity_id
-                WHERE cd.client_id = ?
-                ORDER BY
-                    CASE COALESCE(cd.activity_id, 999999)
-                        WHEN 1 THEN 1
-                        WHEN 2 THEN 2
-                        WHEN 3 THEN 3
-                        ELSE 4
-                    END,
-                    cd.date_position
-            ''', conn_retry, params=(client_id,))
-        except:
-            dates = pd.DataFrame()
-        finally:
-            return_pooled_connection(conn_retry)
-    finally:
-        return_pooled_connection(conn)
-    
-    return dates
+        print(f"Error obteniendo fechas del mes {year}-{month:02d}: {e}")
+        return pd.DataFrame()
 
 def get_multiple_calculated_dates(client_ids):
     """Obtiene fechas calculadas de múltiples clientes en una sola consulta"""
@@ -1857,7 +4082,9 @@ def get_multiple_calculated_dates(client_ids):
                 END,
                 cd.date_position
         '''
-        return execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=60)
+        cache_tags = [client_tag(client_id) for client_id in client_ids] + [table_tag('activities_catalog')]
+        return execute_query_df(query, params=client_ids, use_cache=True, cache_ttl=60, cache_tags=cache_tags,
+                                schema=CALCULATED_DATES_SCHEMA)
     except Exception as e:
         print(f"Error obteniendo fechas batch: {e}")
         return pd.DataFrame()
@@ -1867,102 +4094,156 @@ def save_calculated_dates(client_id, activity_name, dates_list):
     if not dates_list:
         print(f"No hay fechas para guardar para actividad {activity_name}")
         return
-        
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
-        row = cursor.fetchone()
-        activity_id = row[0] if row else None
-
-        if activity_id is None:
-            cursor.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
-            activity_id = cursor.fetchone()[0]
-            cursor.execute(
-                "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
-                (activity_id, activity_name)
-            )
 
+    try:
         # Usar transacción para operaciones atómicas
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Eliminar fechas existentes para esta actividad
-        cursor.execute('''
-            DELETE FROM calculated_dates 
-            WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
-        ''', (client_id, activity_id, activity_name))
-        
-        # Insertar nuevas fechas en posiciones secuenciales (1, 2, 3, 4)
-        for position, date in enumerate(dates_list[:4], 1):
-            if date:
-                # Manejo más robusto de diferentes tipos de fecha
-                if isinstance(date, (datetime, date)):
-                    date_str = date.strftime('%Y-%m-%d')
-                elif hasattr(date, 'strftime'):
-                    date_str = date.strftime('%Y-%m-%d')
-                else:
-                    date_str = str(date)
-                
-                cursor.execute('''
-                    INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (client_id, activity_id, activity_name, position, date_str))
-        
-        conn.commit()
+        with transaction() as tx:
+            tx.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
+            row = tx.fetchone()
+            activity_id = row[0] if row else None
+
+            if activity_id is None:
+                tx.execute("SELECT COALESCE(MAX(id), 3) + 1 FROM activities_catalog")
+                activity_id = tx.fetchone()[0]
+                tx.execute(
+                    "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)",
+                    (activity_id, activity_name)
+                )
+
+            # Eliminar fechas existentes para esta actividad
+            tx.execute('''
+                DELETE FROM calculated_dates
+                WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
+            ''', (client_id, activity_id, activity_name))
+
+            # Insertar nuevas fechas en posiciones secuenciales (1, 2, 3, 4)
+            for position, date_value in enumerate(dates_list[:4], 1):
+                if date_value:
+                    # Manejo más robusto de diferentes tipos de fecha
+                    if isinstance(date_value, (datetime, date)):
+                        date_str = date_value.strftime('%Y-%m-%d')
+                    elif hasattr(date_value, 'strftime'):
+                        date_str = date_value.strftime('%Y-%m-%d')
+                    else:
+                        date_str = str(date_value)
+
+                    tx.execute('''
+                        INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (client_id, activity_id, activity_name, position, date_str))
+
+            # Invalidar cache de fechas para este cliente
+            invalidate_client_cache(client_id, ['calculated_dates'])
         print(f"Guardadas {min(len(dates_list), 4)} fechas para {activity_name} en posiciones secuenciales")
-        
-        # Invalidar cache de fechas para este cliente
-        _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
+
     except Exception as e:
         print(f"Error guardando fechas para {activity_name}: {e}")
-        conn.rollback()
-    finally:
-        return_pooled_connection(conn)
 
 def update_calculated_date(client_id, activity_name, date_position, new_date):
     """Actualiza una fecha específica con invalidación de cache"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
-        row = cursor.fetchone()
-        activity_id = row[0] if row else None
+        with transaction() as tx:
+            tx.execute("SELECT id FROM activities_catalog WHERE name = ?", (activity_name,))
+            row = tx.fetchone()
+            activity_id = row[0] if row else None
+
+            tx.execute('''
+                UPDATE calculated_dates
+                SET date = ?, is_custom = 1
+                WHERE client_id = ? AND date_position = ? AND (activity_id = ? OR activity_name = ?)
+            ''', (new_date, client_id, date_position, activity_id, activity_name))
+
+            # Invalidar cache de fechas para este cliente
+            invalidate_client_cache(client_id, ['calculated_dates'])
 
-        cursor.execute('''
-            UPDATE calculated_dates 
-            SET date = ?, is_custom = 1
-            WHERE client_id = ? AND date_position = ? AND (activity_id = ? OR activity_name = ?)
-        ''', (new_date, client_id, date_position, activity_id, activity_name))
-        conn.commit()
-        
-        # Invalidar cache de fechas para este cliente
-        _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
     except Exception as e:
         print(f"Error actualizando fecha: {e}")
-        conn.rollback()
-    finally:
-        return_pooled_connection(conn)
+
+def apply_calculated_date_changes(client_id, changes):
+    """Aplica en una transacción los cambios puntuales del editor de fechas de un cliente.
+
+    `changes` son tuplas (acción, actividad, posición, fecha_anterior, fecha_nueva)
+    con acción 'update', 'insert' o 'delete' y fechas 'YYYY-MM-DD'. Un insert sin
+    posición va después de la posición más alta de la actividad. Solo se escriben
+    las celdas cambiadas y se invalidan el cliente y los meses tocados. Devuelve
+    {acción: filas}; si falla no se guarda nada y la excepción se propaga.
+    """
+    client_id = int(client_id)
+    counts = {'update': 0, 'insert': 0, 'delete': 0}
+    if not changes:
+        return counts
+    unknown = sorted({change[0] for change in changes} - set(counts))
+    if unknown:
+        raise ValueError(f"Acciones de edición no soportadas: {unknown}")
+
+    months = set()
+    for _, _, _, old_date, new_date in changes:
+        for value in (old_date, new_date):
+            if value:
+                months.add((int(value[:4]), int(value[5:7])))
+
+    with transaction() as tx:
+        activity_ids = resolve_activity_ids([change[1] for change in changes])
+        updates = [(new_date, activity_ids[activity], client_id, position, activity_ids[activity], activity)
+                   for action, activity, position, _, new_date in changes if action == 'update']
+        deletes = [(client_id, position, activity_ids[activity], activity)
+                   for action, activity, position, _, _ in changes if action == 'delete']
+        inserts = [(activity, position, new_date)
+                   for action, activity, position, _, new_date in changes if action == 'insert']
+
+        if updates:
+            tx.executemany('''
+                UPDATE calculated_dates
+                SET date = ?, is_custom = 1, activity_id = ?
+                WHERE client_id = ? AND date_position = ? AND (activity_id = ? OR activity_name = ?)
+            ''', updates)
+            counts['update'] = len(updates)
+        if deletes:
+            tx.executemany('''
+                DELETE FROM calculated_dates
+                WHERE client_id = ? AND date_position = ? AND (activity_id = ? OR activity_name = ?)
+            ''', deletes)
+            counts['delete'] = len(deletes)
+        if inserts:
+            # Las posiciones nuevas siguen a la más alta de la actividad (UNIQUE por nombre de actividad)
+            tx.execute('''
+                SELECT activity_name, MAX(date_position)
+                FROM calculated_dates
+                WHERE client_id = ?
+                GROUP BY activity_name
+            ''', (client_id,))
+            max_positions = {activity: max_position or 0 for activity, max_position in tx.fetchall()}
+            rows = []
+            for activity, position, new_date in inserts:
+                if position is None:
+                    position = max_positions.get(activity, 0) + 1
+                max_positions[activity] = max(max_positions.get(activity, 0), position)
+                rows.append((client_id, activity_ids[activity], activity, position, new_date))
+            tx.executemany('''
+                INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date, is_custom)
+                VALUES (?, ?, ?, ?, ?, 1)
+            ''', rows)
+            counts['insert'] = len(rows)
+
+        invalidate_calendar_cache(client_id, months)
+    return counts
 
 # === FUNCIONES DE COPIA DE FECHAS ===
 
 def get_clients_with_matching_frequencies(source_client_id, use_cache=True):
     """Obtiene clientes que tienen las mismas frecuencias de actividades que el cliente de origen con cache"""
+    use_cache = _cacheable(use_cache)
     if use_cache:
         cache_key = f"matching_frequencies_{source_client_id}"
         cached_result = _db_cache.get(cache_key, 180)
         if cached_result is not None:
             return cached_result
-    
-    conn = get_pooled_connection()
+
     try:
         query = '''
         SELECT DISTINCT c.id, c.name, c.codigo_ag, c.codigo_we, c.csr, c.vendedor
         FROM clients c
-        WHERE c.id != ? 
+        WHERE c.id != ?
         AND NOT EXISTS (
             -- Verificar que no haya actividades en origen que no estén en destino con la misma frecuencia
             SELECT 1 FROM client_activities ca_source
@@ -1987,98 +4268,88 @@ def get_clients_with_matching_frequencies(source_client_id, use_cache=True):
         )
         ORDER BY c.name
         '''
-        df = pd.read_sql_query(query, conn, params=(source_client_id, source_client_id, source_client_id))
-        
+        df = _read_query_df(query, (source_client_id, source_client_id, source_client_id))
+
         if use_cache:
             cache_key = f"matching_frequencies_{source_client_id}"
-            _db_cache.set(cache_key, df, 180)
-        
+            _db_cache.set(cache_key, df, 180, tags=[
+                client_tag(source_client_id), table_tag('clients'), table_tag('client_activities')
+            ])
+
         return df
     except Exception as e:
         print(f"Error obteniendo clientes compatibles: {e}")
         return pd.DataFrame()
-    finally:
-        return_pooled_connection(conn)
 
 def copy_dates_to_clients(source_client_id, target_client_ids):
     """Copia las fechas del cliente origen a los clientes destino de manera optimizada con invalidación de cache"""
     if not target_client_ids:
         return True, "No hay clientes seleccionados"
-    
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
+
     try:
         # Usar transacción para operaciones atómicas
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Obtener todas las fechas del cliente origen
-        cursor.execute('''
-            SELECT activity_id, activity_name, date_position, date, is_custom
-            FROM calculated_dates 
-            WHERE client_id = ?
-            ORDER BY activity_name, date_position
-        ''', (source_client_id,))
-        
-        source_dates = cursor.fetchall()
-        
-        if not source_dates:
-            conn.rollback()
-            return False, "El cliente origen no tiene fechas para copiar"
-        
-        # Preparar datos para inserción batch
-        insert_data = []
-        for target_client_id in target_client_ids:
-            for activity_id, activity_name, date_position, date_value, is_custom in source_dates:
-                insert_data.append((target_client_id, activity_id, activity_name, date_position, date_value, is_custom))
-        
-        # Eliminar fechas existentes de los clientes destino en una sola operación
-        placeholders = ','.join(['?' for _ in target_client_ids])
-        cursor.execute(f'''
-            DELETE FROM calculated_dates 
-            WHERE client_id IN ({placeholders})
-        ''', target_client_ids)
-        
-        # Insertar nuevas fechas en batch
-        cursor.executemany('''
-            INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date, is_custom)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', insert_data)
-        
-        conn.commit()
-        
+        with transaction() as tx:
+            # Obtener todas las fechas del cliente origen
+            tx.execute('''
+                SELECT activity_id, activity_name, date_position, date, is_custom
+                FROM calculated_dates
+                WHERE client_id = ?
+                ORDER BY activity_name, date_position
+            ''', (source_client_id,))
+
+            source_dates = tx.fetchall()
+
+            if not source_dates:
+                tx.rollback()
+                return False, "El cliente origen no tiene fechas para copiar"
+
+            # Preparar datos para inserción batch
+            insert_data = []
+            for target_client_id in target_client_ids:
+                for activity_id, activity_name, date_position, date_value, is_custom in source_dates:
+                    insert_data.append((target_client_id, activity_id, activity_name, date_position, date_value, is_custom))
+
+            # Eliminar fechas existentes de los clientes destino en una sola operación
+            placeholders = ','.join(['?' for _ in target_client_ids])
+            tx.execute(f'''
+                DELETE FROM calculated_dates
+                WHERE client_id IN ({placeholders})
+            ''', target_client_ids)
+
+            # Insertar nuevas fechas en batch
+            tx.executemany('''
+                INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date, is_custom)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', insert_data)
+
+            # Invalidar cache de fechas para todos los clientes afectados
+            invalidate_client_cache(target_client_ids, ['calculated_dates'])
+
         copied_count = len(source_dates)
         target_count = len(target_client_ids)
-        
-        # Invalidar cache de fechas para todos los clientes afectados
-        for client_id in target_client_ids:
-            _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
+
         return True, f"Se copiaron {copied_count} fechas a {target_count} cliente(s) exitosamente"
-        
+
     except Exception as e:
         print(f"Error copiando fechas: {e}")
-        conn.rollback()
         return False, f"Error al copiar fechas: {str(e)}"
-    finally:
-        return_pooled_connection(conn)
 
 def get_client_activity_summary(client_id, use_cache=True):
     """Obtiene un resumen de las actividades y frecuencias de un cliente con cache"""
+    use_cache = _cacheable(use_cache)
     if use_cache:
         cache_key = f"activity_summary_{client_id}"
         cached_summary = _db_cache.get(cache_key, 180)
         if cached_summary is not None:
             return cached_summary
-    
-    conn = get_pooled_connection()
+
     try:
         query = '''
         SELECT ca.activity_name, ft.name as frequency_name
         FROM client_activities ca
         JOIN frequency_templates ft ON ca.frequency_template_id = ft.id
         WHERE ca.client_id = ?
-        ORDER BY 
+        ORDER BY
             CASE ca.activity_name
                 WHEN 'Fecha Envío OC' THEN 1
                 WHEN 'Albaranado' THEN 2
@@ -2086,18 +4357,16 @@ def get_client_activity_summary(client_id, use_cache=True):
                 ELSE 4
             END
         '''
-        df = pd.read_sql_query(query, conn, params=(client_id,))
-        
+        df = _read_query_df(query, (client_id,))
+
         if use_cache:
             cache_key = f"activity_summary_{client_id}"
-            _db_cache.set(cache_key, df, 180)
-        
+            _db_cache.set(cache_key, df, 180, tags=[client_tag(client_id), table_tag('frequency_templates')])
+
         return df
     except Exception as e:
         print(f"Error obteniendo resumen de actividades: {e}")
         return pd.DataFrame()
-    finally:
-        return_pooled_connection(conn)
 
 
 # === FUNCIONES DE COPIA DE FRECUENCIAS ===
@@ -2107,17 +4376,17 @@ def get_clients_with_default_activities_only(source_client_id, use_cache=True):
     Obtiene clientes que SOLO tienen las 3 actividades por defecto (Fecha Envío OC, Albaranado, Fecha Entrega).
     Excluye clientes que tengan actividades extra.
     """
+    use_cache = _cacheable(use_cache)
     if use_cache:
         cache_key = f"default_activities_only_{source_client_id}"
         cached_result = _db_cache.get(cache_key, 180)
         if cached_result is not None:
             return cached_result
-    
-    conn = get_pooled_connection()
+
     try:
         # Actividades por defecto
         default_activities = ('Fecha Envío OC', 'Albaranado', 'Fecha Entrega')
-        
+
         query = '''
         SELECT c.id, c.name, c.codigo_ag, c.codigo_we, c.csr, c.vendedor, c.pais
         FROM clients c
@@ -2128,30 +4397,30 @@ def get_clients_with_default_activities_only(source_client_id, use_cache=True):
         ) = 3
         AND (
             -- Y las 3 son las actividades por defecto
-            SELECT COUNT(*) FROM client_activities ca 
-            WHERE ca.client_id = c.id 
+            SELECT COUNT(*) FROM client_activities ca
+            WHERE ca.client_id = c.id
             AND ca.activity_name IN (?, ?, ?)
         ) = 3
         ORDER BY c.name
         '''
-        
-        df = pd.read_sql_query(query, conn, params=(
-            source_client_id, 
-            default_activities[0], 
-            default_activities[1], 
+
+        df = _read_query_df(query, (
+            source_client_id,
+            default_activities[0],
+            default_activities[1],
             default_activities[2]
         ))
-        
+
         if use_cache:
             cache_key = f"default_activities_only_{source_client_id}"
-            _db_cache.set(cache_key, df, 180)
-        
+            _db_cache.set(cache_key, df, 180, tags=[
+                client_tag(source_client_id), table_tag('clients'), table_tag('client_activities')
+            ])
+
         return df
     except Exception as e:
         print(f"Error obteniendo clientes con actividades por defecto: {e}")
         return pd.DataFrame()
-    finally:
-        return_pooled_connection(conn)
 
 
 def copy_frequencies_to_clients(source_client_id, target_client_ids):
@@ -2161,84 +4430,151 @@ def copy_frequencies_to_clients(source_client_id, target_client_ids):
     """
     if not target_client_ids:
         return True, "No hay clientes seleccionados"
-    
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
+
     try:
         # Usar transacción para operaciones atómicas
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Obtener las frecuencias del cliente origen
-        cursor.execute('''
-            SELECT activity_name, frequency_template_id
-            FROM client_activities 
-            WHERE client_id = ?
-        ''', (source_client_id,))
-        
-        source_frequencies = cursor.fetchall()
-        
-        if not source_frequencies:
-            conn.rollback()
-            return False, "El cliente origen no tiene actividades configuradas"
-        
-        # Actualizar las frecuencias de cada cliente destino
-        updates_count = 0
-        for target_client_id in target_client_ids:
-            for activity_name, frequency_template_id in source_frequencies:
-                cursor.execute('''
-                    UPDATE client_activities 
-                    SET frequency_template_id = ?
-                    WHERE client_id = ? AND activity_name = ?
-                ''', (frequency_template_id, target_client_id, activity_name))
-                updates_count += cursor.rowcount
-        
-        conn.commit()
-        
+        with transaction() as tx:
+            # Obtener las frecuencias del cliente origen
+            tx.execute('''
+                SELECT activity_name, frequency_template_id
+                FROM client_activities
+                WHERE client_id = ?
+            ''', (source_client_id,))
+
+            source_frequencies = tx.fetchall()
+
+            if not source_frequencies:
+                tx.rollback()
+                return False, "El cliente origen no tiene actividades configuradas"
+
+            # Actualizar las frecuencias de cada cliente destino
+            updates_count = 0
+            for target_client_id in target_client_ids:
+                for activity_name, frequency_template_id in source_frequencies:
+                    tx.execute('''
+                        UPDATE client_activities
+                        SET frequency_template_id = ?
+                        WHERE client_id = ? AND activity_name = ?
+                    ''', (frequency_template_id, target_client_id, activity_name))
+                    updates_count += tx.rowcount
+
+            # Invalidar cache de actividades para todos los clientes afectados
+            invalidate_client_cache(target_client_ids, ['client_activities'])
+
         target_count = len(target_client_ids)
-        
-        # Invalidar cache de actividades para todos los clientes afectados
-        for client_id in target_client_ids:
-            _db_cache.invalidate_pattern(f"activities_{client_id}")
-            _db_cache.invalidate_pattern(f"activity_summary_{client_id}")
-        
+
         return True, f"Se copiaron las frecuencias a {target_count} cliente(s) exitosamente ({updates_count} actualizaciones)"
-        
+
     except Exception as e:
         print(f"Error copiando frecuencias: {e}")
-        conn.rollback()
         return False, f"Error al copiar frecuencias: {str(e)}"
-    finally:
-        return_pooled_connection(conn)
 
 
 # === FUNCIONES DE ANÁLISIS Y MONITOREO ===
 
 def get_database_statistics():
     """Obtiene estadísticas de la base de datos para monitoreo"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
         stats = {}
-        
+
         # Contar registros por tabla
         tables = ['clients', 'frequency_templates', 'client_activities', 'calculated_dates']
-        for table in tables:
-            cursor.execute(f"SELECT COUNT(*) FROM {table}")
-            stats[f"{table}_count"] = cursor.fetchone()[0]
-        
+        with read() as cursor:
+            for table in tables:
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                stats[f"{table}_count"] = cursor.fetchone()[0]
+
         # Estadísticas del cache
         cache_stats = _db_cache.get_stats()
         stats.update(cache_stats)
+
+        # Estadísticas del pool de conexiones
+        stats['connection_pool'] = _connection_pool.get_stats()
         
-        return stats
+        # Estado de la réplica local de lectura (si está habilitada)
+        stats['replica'] = get_replica_stats()
         
+        # Cola de escritura diferida
+        stats['write_behind'] = get_write_behind_stats()
+
+        return stats
+
     except Exception as e:
         print(f"Error obteniendo estadísticas: {e}")
         return {}
-    finally:
-        return_pooled_connection(conn)
+
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+def warm_up_cache():
+    """Precarga en DatabaseCache los datos más consultados tras un despliegue.
+
+    Carga clientes, plantillas de frecuencia, actividades de todos los clientes
+    (una consulta, repartida en las claves `activities_<id>`) y las fechas del
+    mes actual y el siguiente (una consulta por mes). Devuelve los tiempos por paso.
+    """
+    timings = {}
+    total_start = time.perf_counter()
+    
+    def run_step(name, loader):
+        step_start = time.perf_counter()
+        try:
+            result = loader()
+            rows = len(result) if result is not None else 0
+            timings[name] = round((time.perf_counter() - step_start) * 1000, 1)
+            print(f"[CACHE WARM-UP] {name}: {rows} filas en {timings[name]} ms")
+            return result
+        except Exception as e:
+            timings[name] = None
+            print(f"[CACHE WARM-UP] Error precargando {name}: {e}")
+            return None
+    
+    # El hilo arranca antes que init_database: las consultas usan columnas de las migraciones
+    try:
+        migrate_schema()
+    except Exception as e:
+        print(f"[CACHE WARM-UP] No se pudieron aplicar las migraciones, se omite la precarga: {e}")
+        return timings
+    
+    print("[CACHE WARM-UP] Iniciando precarga del cache")
+    clients = run_step('clients', lambda: execute_query_df(_CLIENTS_QUERY, use_cache=True, cache_ttl=120,
+                                                           cache_family='clients', schema=CLIENTS_SCHEMA))
+    run_step('frequency_templates', lambda: get_frequency_templates(use_cache=True))
+    
+    if clients is not None and not clients.empty:
+        client_ids = [int(client_id) for client_id in clients['id'].tolist()]
+        activities = run_step('client_activities', lambda: get_multiple_client_activities(client_ids))
+        
+        # Repartir el resultado masivo en las claves por cliente que usa get_client_activities
+        if activities is not None and 'client_id' in activities.columns:
+            grouped = {int(client_id): group for client_id, group in activities.groupby('client_id', sort=False)}
+            empty = activities.iloc[0:0]
+            for client_id in client_ids:
+                client_activities = grouped.get(client_id, empty).reset_index(drop=True)
+                _db_cache.set(f"activities_{client_id}", client_activities, 120, tags=[
+                    client_tag(client_id), table_tag('frequency_templates'), table_tag('activities_catalog')
+                ])
+    
+    today = date.today()
+    next_month_year, next_month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+    run_step(f'calculated_dates {today.year}-{today.month:02d}',
+             lambda: get_calculated_dates_by_month(today.year, today.month))
+    run_step(f'calculated_dates {next_month_year}-{next_month:02d}',
+             lambda: get_calculated_dates_by_month(next_month_year, next_month))
+    
+    timings['total'] = round((time.perf_counter() - total_start) * 1000, 1)
+    print(f"[CACHE WARM-UP] Precarga completada en {timings['total']} ms")
+    return timings
+
+def start_cache_warm_up():
+    """Lanza warm_up_cache en segundo plano una sola vez por proceso"""
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return False
+        _warm_up_started = True
+    threading.Thread(target=warm_up_cache, name="cache-warm-up", daemon=True).start()
+    return True
 
 def test_cache_functionality():
     """Función para probar que el cache funciona correctamente"""
@@ -2280,89 +4616,152 @@ def test_cache_functionality():
 
 def optimize_database():
     """Ejecuta comandos de optimización de la base de datos"""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Analizar tablas para actualizar estadísticas del optimizador
-        cursor.execute("ANALYZE")
-        
-        # Vacuum para limpiar espacio no utilizado
-        cursor.execute("VACUUM")
-        
+        # VACUUM no puede ejecutarse dentro de una transacción: usar read() (sin BEGIN)
+        with read() as cursor:
+            # Analizar tablas para actualizar estadísticas del optimizador
+            cursor.execute("ANALYZE")
+
+            # Vacuum para limpiar espacio no utilizado
+            cursor.execute("VACUUM")
+
         print("Optimización de base de datos completada")
         return True
-        
+
     except Exception as e:
         print(f"Error en optimización de BD: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
+
+# Clientes por consulta IN (...) al leer posiciones en la escritura masiva
+_BULK_CLIENT_CHUNK = 500
+
+def resolve_activity_ids(activity_names):
+    """Ids del catálogo para varios nombres de actividad, creando los que falten ({nombre: id})"""
+    names = sorted({name for name in activity_names if name})
+    if not names:
+        return {}
+    with transaction() as tx:
+        placeholders = ','.join(['?' for _ in names])
+        tx.execute(f"SELECT name, id FROM activities_catalog WHERE name IN ({placeholders})", names)
+        activity_ids = {name: activity_id for name, activity_id in tx.fetchall()}
+        missing = [name for name in names if name not in activity_ids]
+        if missing:
+            tx.execute("SELECT COALESCE(MAX(id), 3) FROM activities_catalog")
+            next_id = tx.fetchone()[0] + 1
+            new_rows = [(next_id + i, name) for i, name in enumerate(missing)]
+            tx.executemany(
+                "INSERT OR IGNORE INTO activities_catalog (id, name, is_active) VALUES (?, ?, 1)", new_rows
+            )
+            activity_ids.update({name: activity_id for activity_id, name in new_rows})
+            mark_tables_changed('activities_catalog')
+    return activity_ids
+
+def _write_calculated_dates(cursor, entries, activity_names):
+    """Núcleo de save_calculated_dates_bulk sobre `cursor`; devuelve las filas insertadas.
+
+    `activity_names` es {activity_id: nombre}. Un executemany borra el rango de cada
+    entrada y otro inserta todas las filas nuevas.
+    """
+    delete_params = []
+    for client_id, activity_id, year, _ in entries:
+        if year is None:
+            first_day = last_day = None
+        else:
+            first_day = date_day_number(date(year, 1, 1))
+            last_day = date_day_number(date(year, 12, 31))
+        year_pattern = f"{year}-%" if year is not None else None
+        delete_params.append((client_id, activity_id, activity_names[activity_id],
+                              first_day, first_day, last_day, year_pattern))
+    # activity_name cubre filas anteriores al catálogo que aún no tienen activity_id; las
+    # fechas que no se pudieron interpretar (date_day NULL) se reconocen por el texto, como antes
+    cursor.executemany('''
+        DELETE FROM calculated_dates
+        WHERE client_id = ? AND (activity_id = ? OR activity_name = ?)
+        AND (? IS NULL OR date_day BETWEEN ? AND ? OR (date_day IS NULL AND date LIKE ?))
+    ''', delete_params)
+
+    # Las fechas nuevas siguen a la posición más alta que quede (UNIQUE por nombre de actividad)
+    client_ids = sorted({entry[0] for entry in entries})
+    max_positions = {}
+    for start in range(0, len(client_ids), _BULK_CLIENT_CHUNK):
+        chunk = client_ids[start:start + _BULK_CLIENT_CHUNK]
+        placeholders = ','.join(['?' for _ in chunk])
+        cursor.execute(f'''
+            SELECT client_id, activity_name, MAX(date_position)
+            FROM calculated_dates
+            WHERE client_id IN ({placeholders})
+            GROUP BY client_id, activity_name
+        ''', chunk)
+        for client_id, activity_name, max_position in cursor.fetchall():
+            max_positions[(client_id, activity_name)] = max_position or 0
+
+    rows = []
+    for client_id, activity_id, year, dates_list in entries:
+        activity_name = activity_names[activity_id]
+        position = max_positions.get((client_id, activity_name), 0)
+        year_prefix = f"{year}-" if year is not None else None
+        for date_item in dates_list:
+            if not date_item:
+                continue
+            date_str = date_item.strftime('%Y-%m-%d') if hasattr(date_item, 'strftime') else str(date_item)
+            # Solo fechas del año indicado
+            if year_prefix and not date_str.startswith(year_prefix):
+                continue
+            position += 1
+            rows.append((client_id, activity_id, activity_name, position, date_str))
+        max_positions[(client_id, activity_name)] = position
+
+    if rows:
+        cursor.executemany('''
+            INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+    return len(rows)
+
+def save_calculated_dates_bulk(entries):
+    """Reemplaza en una sola transacción las fechas de muchos clientes, actividades y años.
+
+    `entries` son tuplas (client_id, activity_id, year, fechas). Para cada una se
+    borran las fechas de ese año de la actividad del cliente (todas si year es None)
+    y se insertan las nuevas a continuación de la posición más alta que quede, con
+    activity_id siempre poblado. Devuelve las filas insertadas; si falla no se
+    guarda nada y la excepción se propaga.
+    """
+    entries = [
+        (int(client_id), int(activity_id), None if year is None else int(year), list(dates_list or []))
+        for client_id, activity_id, year, dates_list in entries
+    ]
+    if not entries:
+        return 0
+
+    with transaction() as tx:
+        activity_ids = sorted({entry[1] for entry in entries})
+        placeholders = ','.join(['?' for _ in activity_ids])
+        tx.execute(f"SELECT id, name FROM activities_catalog WHERE id IN ({placeholders})", activity_ids)
+        activity_names = dict(tx.fetchall())
+        unknown = [activity_id for activity_id in activity_ids if activity_id not in activity_names]
+        if unknown:
+            raise ValueError(f"Actividades inexistentes en el catálogo: {unknown}")
+
+        saved = _write_calculated_dates(tx, entries, activity_names)
+        invalidate_client_cache(sorted({entry[0] for entry in entries}), ['calculated_dates'])
+    return saved
 
 def save_calculated_dates_by_year(client_id, activity_name, dates_list, year):
     """Guarda fechas para una actividad específica de un año específico, preservando otros años"""
     if not dates_list:
         print(f"No hay fechas para guardar para actividad {activity_name} del año {year}")
         return
-        
-    # Convertir client_id para evitar problemas de serialización
-    client_id = int(client_id)
-    
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-    
+
     try:
-        # Usar transacción para operaciones atómicas
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Eliminar solo fechas del año específico para esta actividad
-        cursor.execute('''
-            DELETE FROM calculated_dates 
-            WHERE client_id = ? AND activity_name = ? 
-            AND date LIKE ?
-        ''', (client_id, activity_name, f"{year}-%"))
-        
-        # Obtener la máxima posición existente para esta actividad
-        cursor.execute('''
-            SELECT COALESCE(MAX(date_position), 0) 
-            FROM calculated_dates 
-            WHERE client_id = ? AND activity_name = ?
-        ''', (client_id, activity_name))
-        
-        max_position = cursor.fetchone()[0]
-        
-        # Insertar nuevas fechas con posiciones que no conflicten
-        for i, date_item in enumerate(dates_list):
-            if date_item:
-                position = max_position + i + 1  # Continuar desde la máxima posición existente
-                
-                # Manejo más robusto de diferentes tipos de fecha
-                if hasattr(date_item, 'strftime'):
-                    date_str = date_item.strftime('%Y-%m-%d')
-                else:
-                    date_str = str(date_item)
-                
-                # Verificar que la fecha sea del año correcto
-                if date_str.startswith(f"{year}-"):
-                    cursor.execute('''
-                        INSERT INTO calculated_dates (client_id, activity_name, date_position, date)
-                        VALUES (?, ?, ?, ?)
-                    ''', (client_id, activity_name, position, date_str))
-        
-        conn.commit()
-        # Contar fechas válidas guardadas de manera más simple
-        dates_saved_count = len([d for d in dates_list if d])
+        with transaction():
+            activity_id = resolve_activity_ids([activity_name])[activity_name]
+            dates_saved_count = save_calculated_dates_bulk([(client_id, activity_id, year, dates_list)])
         print(f"Guardadas {dates_saved_count} fechas para {activity_name} del año {year}")
-        
-        # Invalidar cache relacionado
-        _db_cache.invalidate_pattern(f"dates_{client_id}")
-        
+
     except Exception as e:
-        conn.rollback()
         print(f"Error guardando fechas calculadas por año: {e}")
         raise e
-    finally:
-        return_pooled_connection(conn)
 
 
 # === FUNCIONES DEL MÓDULO DE CUMPLIMIENTO ===
@@ -2370,23 +4769,18 @@ def save_calculated_dates_by_year(client_id, activity_name, dates_list, year):
 def create_compliance_upload(original_filename, file_bytes, row_count, uploaded_by, country_filter=None):
     """Crea un registro de carga de cumplimiento y guarda el archivo como referencia."""
     file_hash = hashlib.md5(file_bytes).hexdigest() if file_bytes else None
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
 
     try:
-        cursor.execute('''
-            INSERT INTO compliance_uploads (original_filename, file_hash, row_count, uploaded_by, country_filter, file_blob)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (original_filename, file_hash, row_count or 0, uploaded_by, country_filter, file_bytes))
-        upload_id = cursor.lastrowid
-        conn.commit()
+        with transaction() as tx:
+            tx.execute('''
+                INSERT INTO compliance_uploads (original_filename, file_hash, row_count, uploaded_by, country_filter, file_blob)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (original_filename, file_hash, row_count or 0, uploaded_by, country_filter, file_bytes))
+            upload_id = tx.lastrowid
         return upload_id
     except Exception as e:
-        conn.rollback()
         print(f"Error creando carga de cumplimiento: {e}")
         return None
-    finally:
-        return_pooled_connection(conn)
 
 
 def save_compliance_records(upload_id, records):
@@ -2394,44 +4788,37 @@ def save_compliance_records(upload_id, records):
     if not upload_id or not records:
         return False
 
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.executemany('''
-            INSERT INTO compliance_records (
-                upload_id, sales_document, reference_date, ag_code, client_name_excel,
-                matched_client_id, matched_client_name, match_score, expected_date, activity_id,
-                activity_name, status, matched_by, assigned_manually, manual_note, raw_row, country_filter
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', [(
-            upload_id,
-            rec.get('sales_document'),
-            rec.get('reference_date'),
-            rec.get('ag_code'),
-            rec.get('client_name_excel'),
-            rec.get('matched_client_id'),
-            rec.get('matched_client_name'),
-            rec.get('match_score'),
-            rec.get('expected_date'),
-            rec.get('activity_id'),
-            rec.get('activity_name'),
-            rec.get('status', 'sin_asignar'),
-            rec.get('matched_by'),
-            rec.get('assigned_manually', 0),
-            rec.get('manual_note'),
-            rec.get('raw_row'),
-            rec.get('country_filter')
-        ) for rec in records])
-        conn.commit()
+        with transaction() as tx:
+            tx.executemany('''
+                INSERT INTO compliance_records (
+                    upload_id, sales_document, reference_date, ag_code, client_name_excel,
+                    matched_client_id, matched_client_name, match_score, expected_date, activity_id,
+                    activity_name, status, matched_by, assigned_manually, manual_note, raw_row, country_filter
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [(
+                upload_id,
+                rec.get('sales_document'),
+                rec.get('reference_date'),
+                rec.get('ag_code'),
+                rec.get('client_name_excel'),
+                rec.get('matched_client_id'),
+                rec.get('matched_client_name'),
+                rec.get('match_score'),
+                rec.get('expected_date'),
+                rec.get('activity_id'),
+                rec.get('activity_name'),
+                rec.get('status', 'sin_asignar'),
+                rec.get('matched_by'),
+                rec.get('assigned_manually', 0),
+                rec.get('manual_note'),
+                rec.get('raw_row'),
+                rec.get('country_filter')
+            ) for rec in records])
         return True
     except Exception as e:
-        conn.rollback()
         print(f"Error guardando registros de cumplimiento: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def get_compliance_records(upload_id):
@@ -2491,43 +4878,31 @@ def delete_compliance_upload(upload_id):
     """Elimina una carga de cumplimiento y todas sus referencias (registros)."""
     if not upload_id:
         return False
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.execute("DELETE FROM compliance_records WHERE upload_id = ?", (upload_id,))
-        cursor.execute("DELETE FROM compliance_uploads WHERE id = ?", (upload_id,))
-        conn.commit()
+        with transaction() as tx:
+            tx.execute("DELETE FROM compliance_records WHERE upload_id = ?", (upload_id,))
+            tx.execute("DELETE FROM compliance_uploads WHERE id = ?", (upload_id,))
         return True
     except Exception as e:
-        conn.rollback()
         print(f"Error eliminando carga de cumplimiento {upload_id}: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def update_compliance_record_assignment(record_id, client_id, expected_date, status, manual_note=None, matched_by='manual'):
     """Actualiza la asignación manual de un registro de cumplimiento."""
-    conn = get_pooled_connection()
-    cursor = conn.cursor()
-
     try:
-        cursor.execute('''
-            UPDATE compliance_records
-            SET matched_client_id = ?, expected_date = ?, status = ?, matched_by = ?,
-                assigned_manually = 1, manual_note = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (client_id, expected_date, status, matched_by, manual_note, record_id))
-
-        conn.commit()
-        return cursor.rowcount > 0
+        with transaction() as tx:
+            tx.execute('''
+                UPDATE compliance_records
+                SET matched_client_id = ?, expected_date = ?, status = ?, matched_by = ?,
+                    assigned_manually = 1, manual_note = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (client_id, expected_date, status, matched_by, manual_note, record_id))
+            updated = tx.rowcount > 0
+        return updated
     except Exception as e:
-        conn.rollback()
         print(f"Error actualizando asignación de cumplimiento: {e}")
         return False
-    finally:
-        return_pooled_connection(conn)
 
 
 def get_client_oc_dates(client_id):
@@ -1,8 +1,14 @@
 import json
-import calendar
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from database import get_client_activities, save_calculated_dates, create_default_activities, get_db_connection
+from database import (get_client_activities, save_calculated_dates, create_default_activities,
+                      transaction, resolve_activity_ids, save_calculated_dates_bulk,
+                      add_table_change_listener)
+from config import get_cache_settings
 
 def get_nth_weekday_of_month(year, month, weekday, n):
     """Obtiene el n-ésimo día de la semana de un mes"""
@@ -21,64 +27,199 @@ def get_nth_weekday_of_month(year, month, weekday, n):
     
     return nth_occurrence.date()
 
+# === MOTOR VECTORIZADO DE FRECUENCIAS ===
+#
+# Calcula con numpy.datetime64 las fechas de años completos: los inicios de mes de
+# todos los años se arman como una matriz (años x 12) y cada semana/día de la
+# configuración agrega una columna. Mismas reglas que el cálculo mes a mes: una
+# semana que cae fuera del mes se descarta y un día mayor a 28 que no existe en el
+# mes pasa al último día del mes.
+
+_WEEKMASK_DAYS = 7
+
+def _parse_frequency(frequency_type, frequency_config):
+    """Configuración de una frecuencia lista para el motor: (tipo, valores, weekmask)"""
+    config = json.loads(frequency_config) if isinstance(frequency_config, str) else frequency_config
+    if frequency_type == "nth_weekday":
+        weekmask = ['0'] * _WEEKMASK_DAYS
+        weekmask[int(config["weekday"])] = '1'
+        return frequency_type, np.asarray(config["weeks"], dtype=np.int64), ''.join(weekmask)
+    if frequency_type == "specific_days":
+        return frequency_type, np.asarray(config["days"], dtype=np.int64), None
+    return frequency_type, np.empty(0, dtype=np.int64), None
+
+def _frequency_matrix(parsed, years):
+    """Fechas candidatas (años x 12 x valores) y la máscara de las que aplican"""
+    frequency_type, values, weekmask = parsed
+    years = np.asarray(years, dtype=np.int64)
+    month_index = (years[:, None] - 1970) * 12 + np.arange(12)
+    month_starts = month_index.astype('datetime64[M]').astype('datetime64[D]')[:, :, None]
+    next_starts = (month_index + 1).astype('datetime64[M]').astype('datetime64[D]')[:, :, None]
+    shape = month_starts.shape[:2] + (len(values),)
+
+    if frequency_type == "nth_weekday" and len(values):
+        # Primera ocurrencia del día en el mes (roll='forward') y luego n-1 semanas
+        first = np.busday_offset(month_starts, 0, roll='forward', weekmask=weekmask)
+        candidates = first + (values - 1) * 7
+        valid = (candidates >= month_starts) & (candidates < next_starts)
+        return candidates, valid
+    if frequency_type == "specific_days" and len(values):
+        days_in_month = (next_starts - month_starts).astype(np.int64)
+        days = np.minimum(values, days_in_month)
+        candidates = month_starts + (days - 1)
+        valid = np.broadcast_to((values >= 1) & ((values <= days_in_month) | (values > 28)), shape)
+        return candidates, valid
+    empty = np.zeros(shape, dtype='datetime64[D]')
+    return empty, np.zeros(shape, dtype=bool)
+
+def compute_frequency_dates(frequency_type, frequency_config, years):
+    """Fechas de una frecuencia para uno o varios años completos, ordenadas (datetime64[D])"""
+    years = np.atleast_1d(years)
+    candidates, valid = _frequency_matrix(_parse_frequency(frequency_type, frequency_config), years)
+    return np.sort(candidates[valid])
+
+class CompiledScheduleCache:
+    """LRU acotado de calendarios compilados: (tipo, configuración canónica, año) -> fechas.
+
+    Las fechas se guardan como arreglos datetime64[D] de solo lectura y se comparten
+    entre llamadores. La clave es el contenido de la configuración, así que una
+    entrada nunca da fechas de otra plantilla; aun así se vacía cuando cambia
+    frequency_templates para no conservar calendarios que ya nadie usa.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.computed = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_many(self, keys, requests):
+        """Entradas en cache de `keys` (únicas); `requests` cuenta las solicitudes que cubren"""
+        found = {}
+        with self._lock:
+            self.requests += requests
+            for key in keys:
+                dates = self._entries.get(key)
+                if dates is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = dates
+        return found
+
+    def put_many(self, schedules):
+        with self._lock:
+            for key, dates in schedules.items():
+                self._entries[key] = dates
+                self._entries.move_to_end(key)
+            self.computed += len(schedules)
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'requests': self.requests,
+                'computed': self.computed,
+                'hit_rate': round((self.requests - self.computed) / self.requests * 100, 1) if self.requests else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+_schedule_cache = CompiledScheduleCache(get_cache_settings()['schedule_max_entries'])
+
+@lru_cache(maxsize=1024)
+def _canonical_config_text(frequency_config):
+    """Configuración JSON con claves y listas (weeks/days) ordenadas; el texto original si no es JSON válido"""
+    try:
+        config = json.loads(frequency_config)
+        for field in ('weeks', 'days'):
+            if isinstance(config.get(field), list):
+                config[field] = sorted(config[field])
+        return json.dumps(config, sort_keys=True, separators=(',', ':'))
+    except Exception:
+        return frequency_config
+
+def _canonical_frequency_config(frequency_config):
+    if not isinstance(frequency_config, str):
+        frequency_config = json.dumps(frequency_config, sort_keys=True)
+    return _canonical_config_text(frequency_config)
+
+def _compute_schedules(keys):
+    """Calcula las claves (tipo, configuración canónica, año): cada configuración, todos sus años a la vez"""
+    groups = {}
+    for key in keys:
+        groups.setdefault(key[:2], []).append(key[2])
+
+    schedules = {}
+    for (frequency_type, frequency_config), years in groups.items():
+        years = sorted(years)
+        try:
+            candidates, valid = _frequency_matrix(_parse_frequency(frequency_type, frequency_config), years)
+            by_year = [np.sort(candidates[row][valid[row]]) for row in range(len(years))]
+        except Exception as e:
+            print(f"Error procesando frecuencia {frequency_type} {frequency_config}: {e}")
+            by_year = [np.empty(0, dtype='datetime64[D]') for _ in years]
+        for year, dates in zip(years, by_year):
+            dates.flags.writeable = False
+            schedules[(frequency_type, frequency_config, year)] = dates
+    return schedules
+
+def compute_frequency_dates_batch(requests, use_cache=True):
+    """Fechas de muchas frecuencias en una llamada.
+
+    `requests` son tuplas (frequency_type, frequency_config, year). Devuelve, en el
+    mismo orden, un arreglo datetime64[D] ordenado y de solo lectura por solicitud;
+    una configuración inválida da un arreglo vacío. Las solicitudes repetidas (o ya
+    calculadas antes, con `use_cache`) no se recalculan: cada configuración faltante
+    se interpreta una vez y se calcula para todos sus años a la vez.
+    """
+    keys = [(frequency_type, _canonical_frequency_config(frequency_config), int(year))
+            for frequency_type, frequency_config, year in requests]
+    unique_keys = list(dict.fromkeys(keys))
+    if use_cache:
+        schedules = _schedule_cache.get_many(unique_keys, len(keys))
+        computed = _compute_schedules([key for key in unique_keys if key not in schedules])
+        _schedule_cache.put_many(computed)
+        schedules.update(computed)
+    else:
+        schedules = _compute_schedules(unique_keys)
+    return [schedules[key] for key in keys]
+
+def clear_frequency_schedules():
+    """Vacía el cache de calendarios compilados"""
+    _schedule_cache.clear()
+
+def get_schedule_cache_stats():
+    """Estadísticas del cache de calendarios compilados (para monitoreo)"""
+    return _schedule_cache.get_stats()
+
+def _on_tables_changed(tables):
+    if 'frequency_templates' in tables:
+        clear_frequency_schedules()
+
+add_table_change_listener(_on_tables_changed)
+
 def calculate_dates_for_frequency(frequency_type, frequency_config, start_date=None, full_year=True):
     """Calcula las fechas basadas en la frecuencia especificada para todo el año"""
-    dates = []
-    
     # Si no se especifica fecha de inicio, usar enero del año actual
-    if start_date is None:
-        current_year = datetime.now().year
-        start_date = datetime(current_year, 1, 1).date()
-    else:
-        current_year = start_date.year
+    current_year = start_date.year if start_date is not None else datetime.now().year
     
-    print(f"Calculando fechas para todo el año {current_year}: tipo={frequency_type}, config={frequency_config}")
-    
-    # Calcular para todos los meses del año (enero a diciembre)
-    for month in range(1, 13):  # Meses 1-12
-        try:
-            if frequency_type == "nth_weekday":
-                config = json.loads(frequency_config)
-                weekday = config["weekday"]  # 0=lunes, 1=martes, etc.
-                weeks = config["weeks"]
-                
-                print(f"Calculando nth_weekday para {current_year}-{month:02d}: weekday={weekday}, weeks={weeks}")
-                
-                for week in weeks:
-                    date = get_nth_weekday_of_month(current_year, month, weekday, week)
-                    if date:
-                        dates.append(date)
-                        print(f"Fecha agregada: {date}")
-            
-            elif frequency_type == "specific_days":
-                config = json.loads(frequency_config)
-                days = config["days"]
-                
-                print(f"Calculando specific_days para {current_year}-{month:02d}: days={days}")
-                
-                for day in days:
-                    try:
-                        date = datetime(current_year, month, day).date()
-                        dates.append(date)
-                        print(f"Fecha agregada: {date}")
-                    except ValueError:
-                        # Si el día no existe en este mes, tomar el último día del mes
-                        if day > 28:
-                            last_day = calendar.monthrange(current_year, month)[1]
-                            date = datetime(current_year, month, last_day).date()
-                            dates.append(date)
-                            print(f"Fecha ajustada agregada: {date}")
-            
-        except Exception as e:
-            print(f"Error procesando mes {current_year}-{month:02d}: {e}")
-            continue
-    
-    sorted_dates = sorted(dates)
-    print(f"Total de fechas calculadas para el año {current_year}: {len(sorted_dates)}")
-    print(f"Primeras 5 fechas: {sorted_dates[:5] if sorted_dates else 'Ninguna'}")
-    print(f"Últimas 5 fechas: {sorted_dates[-5:] if len(sorted_dates) >= 5 else sorted_dates}")
-    
-    return sorted_dates
+    # Los clientes que comparten plantilla reutilizan el calendario compilado del año
+    try:
+        return compute_frequency_dates_batch([(frequency_type, frequency_config, current_year)])[0].tolist()
+    except Exception as e:
+        print(f"Error calculando fechas {frequency_type} para {current_year}: {e}")
+        return []
 
 def recalculate_client_dates(client_id):
     """Recalcula todas las fechas para un cliente para todo el año"""
@@ -219,72 +360,15 @@ def save_calculated_dates_full_year(client_id, activity_name, dates_list):
         print(f"No hay fechas para guardar para actividad {activity_name}")
         return
     
-    from database import save_calculated_dates
-    
-    # Organizar fechas por meses para mejor visualización
-    dates_by_month = {}
-    
-    for date in dates_list:
-        month_key = date.strftime('%Y-%m')
-        if month_key not in dates_by_month:
-            dates_by_month[month_key] = []
-        dates_by_month[month_key].append(date)
-    
-    # Guardar fechas usando posiciones secuenciales dentro de cada grupo
-    all_positions = []
-    position = 1
-    
-    for month_key in sorted(dates_by_month.keys()):
-        month_dates = sorted(dates_by_month[month_key])
-        for date in month_dates:
-            all_positions.append((position, date))
-            position += 1
-    
-    # Guardar usando el método existente pero con todas las fechas
-    dates_to_save = [item[1] for item in all_positions]
-    
-    # Guardar en lotes para no sobrecargar la base de datos
-    batch_size = 50  # Máximo 50 fechas por vez
-    for i in range(0, len(dates_to_save), batch_size):
-        batch = dates_to_save[i:i + batch_size]
-        save_calculated_dates_batch(client_id, activity_name, batch, i + 1)
-    
-    print(f"Guardadas {len(dates_to_save)} fechas para {activity_name} (año completo) en {len(dates_by_month)} meses")
-
-def save_calculated_dates_batch(client_id, activity_name, dates_batch, start_position):
-    """Guarda un lote de fechas con posiciones específicas"""
-    import sqlite3
-    from datetime import datetime
-    
-    if not dates_batch:
-        return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    # Guardar todas las fechas, ordenadas, en una sola transacción (reemplaza las anteriores de la actividad)
+    dates_to_save = sorted(dates_list)
     try:
-        # Si es el primer lote, limpiar fechas existentes
-        if start_position == 1:
-            cursor.execute('''
-                DELETE FROM calculated_dates 
-                WHERE client_id = ? AND activity_name = ?
-            ''', (client_id, activity_name))
-        
-        # Insertar fechas del lote
-        for i, date in enumerate(dates_batch):
-            position = start_position + i
-            date_str = date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else str(date)
-            
-            cursor.execute('''
-                INSERT INTO calculated_dates (client_id, activity_name, date_position, date)
-                VALUES (?, ?, ?, ?)
-            ''', (client_id, activity_name, position, date_str))
-        
-        conn.commit()
-        print(f"Lote guardado: posiciones {start_position} a {start_position + len(dates_batch) - 1}")
-        
+        with transaction():
+            activity_id = resolve_activity_ids([activity_name])[activity_name]
+            save_calculated_dates_bulk([(client_id, activity_id, None, dates_to_save)])
     except Exception as e:
-        print(f"Error guardando lote de fechas: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
\ No newline at end of file
+        print(f"Error guardando fechas para {activity_name}: {e}")
+        return
+    
+    months = len({date.strftime('%Y-%m') for date in dates_to_save})
+    print(f"Guardadas {len(dates_to_save)} fechas para {activity_name} (año completo) en {months} meses")
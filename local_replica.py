@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Tablas copiadas a la réplica: las que leen dashboard, galería y detección de anomalías
+REPLICATED_TABLES = ('clients', 'frequency_templates', 'client_activities', 'calculated_dates', 'activities_catalog')
+
+# table_name de la fila que obliga a las réplicas a copiar todo (cambios sin registrar)
+RESYNC_MARKER = '*'
+
+# Lote de ids por consulta IN (...) al traer filas modificadas
+_FETCH_CHUNK = 500
+
+# Filas por lote al copiar una tabla completa
+_COPY_BATCH = 5000
+
+
+def changelog_statements(tables=REPLICATED_TABLES):
+    """DDL para la BD principal: registro de cambios por fila y los triggers que lo alimentan.
+
+    Cada INSERT/UPDATE/DELETE sobre una tabla replicada deja (tabla, rowid) en
+    replica_changelog; las réplicas aplican los cambios con seq mayor al último
+    que vieron, sin importar qué servidor hizo la escritura.
+    """
+    statements = ['''
+        CREATE TABLE IF NOT EXISTS replica_changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''']
+    for table in tables:
+        statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_replica_{table}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO replica_changelog (table_name, row_id) VALUES ('{table}', NEW.rowid);
+            END
+        ''')
+        statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_replica_{table}_update AFTER UPDATE ON {table}
+            BEGIN
+                INSERT INTO replica_changelog (table_name, row_id)
+                SELECT '{table}', OLD.rowid UNION SELECT '{table}', NEW.rowid;
+            END
+        ''')
+        statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_replica_{table}_delete AFTER DELETE ON {table}
+            BEGIN
+                INSERT INTO replica_changelog (table_name, row_id) VALUES ('{table}', OLD.rowid);
+            END
+        ''')
+    return statements
+
+
+def drop_changelog_statements(tables=REPLICATED_TABLES):
+    """DDL para la BD principal sin réplicas: elimina los triggers y vacía replica_changelog.
+
+    La tabla se conserva para que seq siga creciendo (AUTOINCREMENT) si los
+    triggers se vuelven a crear; quien los crea deja entonces una fila RESYNC_MARKER.
+    """
+    statements = [
+        f"DROP TRIGGER IF EXISTS trg_replica_{table}_{event}"
+        for table in tables
+        for event in ('insert', 'update', 'delete')
+    ]
+    statements.append("DELETE FROM replica_changelog")
+    return statements
+
+
+class LocalReplica:
+    """Copia local (archivo SQLite) de las tablas de lectura frecuente de la BD principal.
+
+    La primera sincronización copia las tablas completas; las siguientes leen
+    replica_changelog desde el último seq aplicado y reemplazan solo las filas
+    modificadas (o las borran si ya no existen). Si el registro fue purgado más
+    allá de ese seq, aparece una marca RESYNC_MARKER, o cambian las columnas de
+    una tabla, se vuelve a copiar todo. Las escrituras siempre van a la BD principal: la réplica solo se
+    escribe desde sync().
+    """
+
+    def __init__(self, path, tables=REPLICATED_TABLES):
+        self.path = path
+        self.tables = tuple(tables)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._ready = False
+        # Tras un error de sincronización la réplica no sirve lecturas hasta el siguiente éxito
+        self._sync_failed = False
+        self.last_seq = 0
+        self.last_sync_at = 0
+        self.last_sync_ms = 0.0
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.rows_applied = 0
+        self.sync_errors = 0
+        self.reads = 0
+        self._open()
+
+    def _open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS replica_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        self._conn = conn
+        last_seq = self._get_meta('last_seq')
+        self._ready = last_seq is not None
+        self.last_seq = int(last_seq or 0)
+
+    def _get_meta(self, key):
+        row = self._conn.execute("SELECT value FROM replica_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO replica_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _replica_columns(self, table):
+        return [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+    def covers(self, tables):
+        """Indica si todas las tablas de una consulta están replicadas"""
+        return bool(tables) and set(tables) <= set(self.tables)
+
+    def is_fresh(self, max_lag_seconds):
+        """La réplica ya se copió y su última sincronización no supera el retraso permitido"""
+        if not self._ready or self._sync_failed:
+            return False
+        return not max_lag_seconds or time.time() - self.last_sync_at <= max_lag_seconds
+
+    def connect(self):
+        """Conexión de solo lectura a la réplica para servir una consulta"""
+        self.reads += 1
+        uri = 'file:' + os.path.abspath(self.path).replace(os.sep, '/') + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, timeout=5, check_same_thread=False)
+
+    def sync(self, source_cursor):
+        """Sincroniza con la BD principal usando `source_cursor`; devuelve las filas aplicadas"""
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                source_cursor.execute("SELECT COALESCE(MAX(seq), 0), MIN(seq) FROM replica_changelog")
+                max_seq, min_seq = source_cursor.fetchone()
+                last_seq = self.last_seq
+
+                gap = min_seq is not None and min_seq > last_seq + 1
+                if not self._ready or gap:
+                    applied = self._full_sync(source_cursor, max_seq)
+                elif max_seq > last_seq:
+                    applied = self._delta_sync(source_cursor, last_seq, max_seq)
+                    if applied is None:
+                        # Cambió el esquema de alguna tabla: copiar de nuevo
+                        applied = self._full_sync(source_cursor, max_seq)
+                else:
+                    applied = 0
+
+                self.rows_applied += applied
+                self._sync_failed = False
+                self.last_sync_at = time.time()
+                self.last_sync_ms = (time.perf_counter() - started) * 1000
+                return applied
+        except Exception as e:
+            self.sync_errors += 1
+            self._sync_failed = True
+            print(f"[REPLICA] Error sincronizando réplica local: {e}")
+            return 0
+
+    def _full_sync(self, source_cursor, max_seq):
+        """Copia completa de las tablas replicadas (esquema incluido) en una transacción.
+
+        Las filas se leen de la BD principal en lotes de _COPY_BATCH y se insertan
+        antes de pedir el siguiente, sin materializar las tablas en memoria; mientras
+        tanto los lectores (WAL) siguen viendo la copia anterior.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            applied = 0
+            copied_tables = 0
+            for table in self.tables:
+                source_cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+                row = source_cursor.fetchone()
+                if not row:
+                    continue
+                create_sql = row[0]
+                # Los índices de la BD principal también sirven a las consultas sobre la réplica
+                source_cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)
+                )
+                index_sql = [index_row[0] for index_row in source_cursor.fetchall()]
+                
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self._conn.execute(create_sql)
+                source_cursor.execute(f"SELECT * FROM {table}")
+                columns = [description[0] for description in source_cursor.description]
+                insert_sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({','.join(['?' for _ in columns])})"
+                while True:
+                    rows = source_cursor.fetchmany(_COPY_BATCH)
+                    if not rows:
+                        break
+                    self._conn.executemany(insert_sql, rows)
+                    applied += len(rows)
+                # Índices después de la carga: construirlos una vez es más barato que mantenerlos fila a fila
+                for statement in index_sql:
+                    self._conn.execute(statement)
+                copied_tables += 1
+            self._set_meta('last_seq', max_seq)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._ready = True
+        self.last_seq = max_seq
+        self.full_syncs += 1
+        print(f"[REPLICA] Copia completa: {applied} filas en {copied_tables} tablas (seq {max_seq})")
+        return applied
+
+    def _delta_sync(self, source_cursor, last_seq, max_seq):
+        """Aplica las filas modificadas entre dos seq; None si las columnas ya no coinciden o hay una marca de copia completa"""
+        source_cursor.execute('''
+            SELECT table_name, row_id FROM replica_changelog
+            WHERE seq > ? AND seq <= ?
+        ''', (last_seq, max_seq))
+        changed = {}
+        for table_name, row_id in source_cursor.fetchall():
+            if table_name == RESYNC_MARKER:
+                return None
+            if table_name in self.tables:
+                changed.setdefault(table_name, set()).add(row_id)
+
+        updates = []
+        for table, row_ids in changed.items():
+            row_ids = sorted(row_ids)
+            replica_columns = self._replica_columns(table)
+            for start in range(0, len(row_ids), _FETCH_CHUNK):
+                chunk = row_ids[start:start + _FETCH_CHUNK]
+                placeholders = ','.join(['?' for _ in chunk])
+                source_cursor.execute(f"SELECT * FROM {table} WHERE rowid IN ({placeholders})", chunk)
+                columns = [description[0] for description in source_cursor.description]
+                if columns != replica_columns:
+                    return None
+                updates.append((table, chunk, columns, source_cursor.fetchall()))
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Otro proceso que comparta el archivo pudo aplicar ya estos cambios (o más nuevos)
+            stored_seq = int(self._get_meta('last_seq') or 0)
+            if stored_seq >= max_seq:
+                self._conn.execute("ROLLBACK")
+                self.last_seq = stored_seq
+                return 0
+            applied = 0
+            for table, chunk, columns, rows in updates:
+                placeholders = ','.join(['?' for _ in chunk])
+                self._conn.execute(f"DELETE FROM {table} WHERE rowid IN ({placeholders})", chunk)
+                if rows:
+                    self._conn.executemany(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({','.join(['?' for _ in columns])})",
+                        rows
+                    )
+                applied += len(chunk)
+            self._set_meta('last_seq', max_seq)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self.last_seq = max_seq
+        self.delta_syncs += 1
+        return applied
+
+    def get_stats(self):
+        return {
+            'path': self.path,
+            'ready': self._ready,
+            'sync_failed': self._sync_failed,
+            'last_seq': self.last_seq,
+            'last_sync_age_seconds': round(time.time() - self.last_sync_at, 1) if self.last_sync_at else None,
+            'last_sync_ms': round(self.last_sync_ms, 2),
+            'full_syncs': self.full_syncs,
+            'delta_syncs': self.delta_syncs,
+            'rows_applied': self.rows_applied,
+            'sync_errors': self.sync_errors,
+            'reads': self.reads
+        }
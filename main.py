@@ -1,6 +1,6 @@
 import streamlit as st
 import base64
-from database import init_database
+from database import init_database, start_cache_warm_up, start_connection_keepalive, start_replica_sync
 from config import get_db_config
 from auth_system import auth_system, require_auth, is_read_only_mode, get_current_user
 from ui_components import (
@@ -55,6 +55,14 @@ def inject_scroll_reset_on_tabs():
 def main():
     """Función principal de la aplicación"""
     
+    # Abrir conexiones de antemano y mantenerlas vivas, sincronizar la réplica local (si
+    # está habilitada) y precargar el cache de datos. Todo corre en segundo plano una vez
+    # por proceso, mientras el usuario inicia sesión; los hilos aplican antes las migraciones
+    # pendientes (migrate_schema), ya que arrancan antes que init_database.
+    start_connection_keepalive()
+    start_replica_sync()
+    start_cache_warm_up()
+    
     # Aplicar estilos CSS personalizados
     st.markdown(get_custom_css(), unsafe_allow_html=True)
     inject_scroll_reset_on_tabs()
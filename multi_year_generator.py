@@ -11,7 +11,7 @@ import json
 try:
     from database import (
         get_clients, get_client_by_id, get_client_activities, 
-        save_calculated_dates, get_calculated_dates
+        get_calculated_dates
     )
     from date_calculator import calculate_dates_for_frequency
     from calendar_utils import create_client_calendar_table, get_client_year_summary
@@ -853,89 +853,9 @@ def save_all_calculated_dates(client_id, activity_name, dates_list):
         print(f"No hay fechas para guardar para actividad {activity_name}")
         return 0
 
-def save_all_calculated_dates_by_year(client_id, activity_name, dates_list, year):
-    """Guarda todas las fechas para una actividad específica de un año, preservando otros años"""
-    if not dates_list:
-        print(f"No hay fechas para guardar para actividad {activity_name} del año {year}")
-        return 0
-        
-    try:
-        from database import save_calculated_dates_by_year
-        
-        # Usar la nueva función de base de datos que preserva otros años
-        save_calculated_dates_by_year(client_id, activity_name, dates_list, year)
-        
-        return len(dates_list)
-        
-    except Exception as e:
-        print(f"Error guardando fechas para {activity_name} del año {year}: {e}")
-        return 0
-        
-    try:
-        from database import get_pooled_connection, return_pooled_connection, _db_cache
-        from datetime import datetime, date
-        
-        conn = get_pooled_connection()
-        cursor = conn.cursor()
-        
-        try:
-            # Usar transacción para operaciones atómicas
-            cursor.execute("BEGIN TRANSACTION")
-            
-            # Eliminar fechas existentes para esta actividad
-            cursor.execute('''
-                DELETE FROM calculated_dates 
-                WHERE client_id = ? AND activity_name = ?
-            ''', (client_id, activity_name))
-            
-            # Insertar todas las fechas en posiciones secuenciales
-            dates_saved = 0
-            for position, date_item in enumerate(dates_list, 1):
-                if date_item:
-                    # Manejo simplificado de conversión de fecha a string
-                    try:
-                        if hasattr(date_item, 'strftime'):
-                            date_str = date_item.strftime('%Y-%m-%d')
-                        else:
-                            date_str = str(date_item)
-                            # Validar que sea un formato de fecha válido
-                            if len(date_str) == 10 and date_str.count('-') == 2:
-                                pass  # Parece ser YYYY-MM-DD
-                            else:
-                                print(f"Advertencia: formato de fecha no estándar: {date_str}")
-                    except Exception as date_convert_error:
-                        print(f"Error convirtiendo fecha: {date_convert_error}")
-                        date_str = str(date_item)
-                    
-                    cursor.execute('''
-                        INSERT INTO calculated_dates (client_id, activity_name, date_position, date)
-                        VALUES (?, ?, ?, ?)
-                    ''', (client_id, activity_name, position, date_str))
-                    dates_saved += 1
-            
-            conn.commit()
-            print(f"Guardadas {dates_saved} fechas para {activity_name}")
-            
-            # Invalidar cache de fechas para este cliente
-            _db_cache.invalidate_pattern(f"dates_{client_id}")
-            
-            return dates_saved
-            
-        except Exception as e:
-            print(f"Error guardando fechas para {activity_name}: {e}")
-            conn.rollback()
-            raise e
-        finally:
-            return_pooled_connection(conn)
-            
-    except ImportError:
-        # Fallback a la función original si hay problemas con imports
-        print(f"Usando función original para {activity_name}")
-        save_calculated_dates(client_id, activity_name, dates_list)
-        return min(len(dates_list), 4)
-
 def execute_generation(preview_data):
     """Ejecuta la generación real de fechas en la base de datos"""
+    from database import transaction, resolve_activity_ids, save_calculated_dates_bulk
     
     with st.spinner("Generando fechas en la base de datos..."):
         success_count = 0
@@ -953,21 +873,18 @@ def execute_generation(preview_data):
             try:
                 debug_info.info(f"Procesando: {item['client_name']} ({item['year']}) - {len(item['activities'])} actividades")
                 
-                # Generar fechas para cada actividad del cliente
+                # Guardar las fechas de todas las actividades del cliente en una sola transacción,
+                # preservando las fechas de otros años
+                activities_with_dates = [activity for activity in item['activities'] if activity['dates']]
                 client_dates_saved = 0
-                for activity in item['activities']:
-                    if activity['dates']:
-                        # Preparar lista de fechas para esta actividad específica
-                        dates_list = activity['dates']  # Ya son objetos datetime
-                        
-                        # Debug: mostrar información de la actividad
-                        debug_info.info(f"Guardando {len(dates_list)} fechas para {activity['name']} del año {item['year']}")
-                        
-                        # Usar la nueva función que preserva fechas de otros años
-                        dates_saved = save_all_calculated_dates_by_year(item['client_id'], activity['name'], dates_list, item['year'])
-                        
-                        client_dates_saved += dates_saved
-                        total_dates_saved += dates_saved
+                if activities_with_dates:
+                    with transaction():
+                        activity_ids = resolve_activity_ids([activity['name'] for activity in activities_with_dates])
+                        client_dates_saved = save_calculated_dates_bulk([
+                            (item['client_id'], activity_ids[activity['name']], item['year'], activity['dates'])
+                            for activity in activities_with_dates
+                        ])
+                total_dates_saved += client_dates_saved
                 
                 success_count += 1
                 debug_info.success(f"OK {item['client_name']}: {client_dates_saved} fechas guardadas")
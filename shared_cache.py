@@ -0,0 +1,232 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class SharedCacheTier:
+    """Segundo nivel de cache en un archivo SQLite local compartido por los procesos del host.
+
+    Cada réplica del servidor Streamlit (y cada reinicio) puede reutilizar los
+    resultados ya leídos de SQLiteCloud. Mantiene la misma semántica que
+    DatabaseCache: TTL por lectura, invalidación por etiquetas y versiones por
+    tabla compartidas entre procesos. Cualquier error de E/S degrada a "miss"
+    sin afectar al cache en memoria.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, purge_interval=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_purge = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self.write_count = 0
+        self.error_count = 0
+        self._open()
+
+    def _open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                tags TEXT NOT NULL DEFAULT '[]',
+                created_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_tags (
+                tag TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (tag, key)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_tags_key ON cache_tags(key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_created ON cache_entries(created_at)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        ''')
+        self._conn = conn
+
+    def _delete_keys(self, keys):
+        """Elimina entradas y su índice de etiquetas (requiere el lock y una transacción)"""
+        for key in keys:
+            self._conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            self._conn.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+
+    def get(self, key, ttl):
+        """Devuelve (valor, created_at, tags) si la entrada existe y no ha expirado"""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value, tags, created_at FROM cache_entries WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None or time.time() - row[2] > ttl:
+                self.miss_count += 1
+                return None
+            self.hit_count += 1
+            return pickle.loads(row[0]), row[2], json.loads(row[1])
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error leyendo {key[:24]}: {e}")
+            return None
+
+    def set(self, key, value, created_at, tags=None):
+        try:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            tag_list = sorted(tags or [])
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._delete_keys([key])
+                    self._conn.execute(
+                        "INSERT INTO cache_entries (key, value, tags, created_at, size) VALUES (?, ?, ?, ?, ?)",
+                        (key, payload, json.dumps(tag_list), created_at, len(payload))
+                    )
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                        [(tag, key) for tag in tag_list]
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                self.write_count += 1
+            self._maybe_purge()
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error guardando {key[:24]}: {e}")
+
+    def invalidate_tags(self, *tags):
+        if not tags:
+            return 0
+        try:
+            placeholders = ','.join(['?' for _ in tags])
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    keys = [row[0] for row in self._conn.execute(
+                        f"SELECT DISTINCT key FROM cache_tags WHERE tag IN ({placeholders})", tags
+                    ).fetchall()]
+                    self._delete_keys(keys)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            return len(keys)
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error invalidando etiquetas {tags}: {e}")
+            return 0
+
+    def invalidate_pattern(self, pattern):
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    keys = [row[0] for row in self._conn.execute(
+                        "SELECT key FROM cache_entries WHERE instr(key, ?) > 0", (pattern,)
+                    ).fetchall()]
+                    self._delete_keys(keys)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error invalidando patrón {pattern}: {e}")
+
+    def clear(self):
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM cache_entries")
+                self._conn.execute("DELETE FROM cache_tags")
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error limpiando cache compartido: {e}")
+
+    def _maybe_purge(self):
+        """Respeta el límite de tamaño eliminando las entradas más antiguas"""
+        now = time.time()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        try:
+            with self._lock:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+                if not self.max_bytes or total <= self.max_bytes:
+                    return
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    keys = []
+                    for key, size in self._conn.execute(
+                        "SELECT key, size FROM cache_entries ORDER BY created_at"
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        keys.append(key)
+                        total -= size
+                    self._delete_keys(keys)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            self.error_count += 1
+            print(f"[CACHE L2] Error purgando cache compartido: {e}")
+
+    # --- Versiones por tabla compartidas entre procesos ---
+
+    def get_versions(self, tables):
+        with self._lock:
+            if not tables:
+                return {}
+            placeholders = ','.join(['?' for _ in tables])
+            rows = self._conn.execute(
+                f"SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})",
+                list(tables)
+            ).fetchall()
+        return dict(rows)
+
+    def get_all_versions(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT table_name, version FROM table_versions").fetchall())
+
+    def bump_versions(self, tables):
+        with self._lock:
+            self._conn.executemany('''
+                INSERT INTO table_versions (table_name, version) VALUES (?, 1)
+                ON CONFLICT(table_name) DO UPDATE SET version = version + 1
+            ''', [(table,) for table in tables])
+
+    def get_stats(self):
+        try:
+            with self._lock:
+                entries, total = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+                ).fetchone()
+        except Exception:
+            entries, total = 0, 0
+        return {
+            'path': self.path,
+            'hits': self.hit_count,
+            'misses': self.miss_count,
+            'writes': self.write_count,
+            'errors': self.error_count,
+            'cached_items': entries,
+            'cached_bytes': total,
+            'max_bytes': self.max_bytes
+        }
@@ -1,5 +1,6 @@
 import streamlit as st
 import pydeck as pdk
+import io
 import json
 import sqlite3
 import pandas as pd
@@ -13,8 +14,9 @@ from database import (
     delete_frequency_template, get_frequency_usage_count,
     get_client_activities, get_multiple_client_activities, update_client_activity_frequency,
     add_client_activity, delete_client_activity,
-    get_calculated_dates, get_multiple_calculated_dates, save_calculated_dates, update_calculated_date,
-    get_db_connection, get_cache_stats, clear_cache_pattern,
+    get_calculated_dates, get_multiple_calculated_dates, get_calculated_dates_by_month, iter_calculated_dates,
+    save_calculated_dates, update_calculated_date, apply_calculated_date_changes,
+    get_db_connection, get_cache_stats, invalidate_client_cache,
     get_clients_with_matching_frequencies, copy_dates_to_clients, get_client_activity_summary,
     get_clients_with_default_activities_only, copy_frequencies_to_clients
 )
@@ -273,7 +275,8 @@ def show_clients_gallery():
 
     
     # Filtrar clientes basado en los criterios seleccionados
-    filtered_clients = clients.copy()
+    # (cada filtro genera un DataFrame nuevo, no hace falta copiar el resultado del cache)
+    filtered_clients = clients
     
     # Aplicar filtro de texto (verificar que no sea None o vacío)
     if search_term and search_term.strip():
@@ -285,7 +288,7 @@ def show_clients_gallery():
             filtered_clients['vendedor'].str.contains(term, case=False, na=False) |
             filtered_clients['tipo_cliente'].str.contains(term, case=False, na=False) |
             filtered_clients['region'].str.contains(term, case=False, na=False) |
-            (filtered_clients['pais'].fillna('').str.contains(term, case=False, na=False)) |
+            filtered_clients['pais'].str.contains(term, case=False, na=False) |
             (filtered_clients.get('estado', pd.Series()).fillna('').str.contains(term, case=False, na=False)) |
             (filtered_clients.get('ciudad', pd.Series()).fillna('').str.contains(term, case=False, na=False)) |
             (filtered_clients.get('numero_tarea_sap', pd.Series()).astype(str).str.contains(term, case=False, na=False))
@@ -445,19 +448,23 @@ def show_clients_gallery():
 
 def get_client_current_month_data(client_id, year):
     """Obtiene los datos del mes actual y año seleccionado para un cliente específico (vista compacta)"""
-    dates_df = get_calculated_dates(client_id)
+    # Obtener mes actual
+    current_month = datetime.now().month
     
-    if dates_df.empty:
+    # Una sola consulta (cacheada) con las fechas del mes de todos los clientes de la galería
+    month_df = get_calculated_dates_by_month(year, current_month)
+    if month_df.empty or 'client_id' not in month_df.columns:
         return None
+    dates_df = month_df[month_df['client_id'] == client_id]
     
-    # Obtener mes actual
-    current_month = datetime.now().month
+    if dates_df.empty:
+        return None
     
     # Filtrar fechas del mes actual
     month_dates = []
     for _, row in dates_df.iterrows():
         try:
-            date_obj = datetime.strptime(row['date'], '%Y-%m-%d')
+            date_obj = row['date']
             if date_obj.month == current_month and date_obj.year == year:
                 # Mapear meses al español para formato abreviado
                 months_spanish = {
@@ -699,7 +706,7 @@ def show_clients_map_view(clients_to_show):
         return
 
     mexico_clients = clients_to_show[
-        clients_to_show.get('pais', '').fillna('').str.lower().str.contains('mexico|méxico')
+        clients_to_show['pais'].str.lower().str.contains('mexico|méxico', na=False)
     ]
 
     if mexico_clients.empty:
@@ -1047,6 +1054,7 @@ def show_client_detail():
                         cursor.execute("DELETE FROM calculated_dates WHERE client_id = ?", (client_id,))
                         conn.commit()
                         conn.close()
+                        invalidate_client_cache(client_id, ['calculated_dates'])
 
                         st.success("Fechas eliminadas exitosamente")
                         st.session_state[f'confirm_clear_{client_id}'] = False
@@ -1138,6 +1146,7 @@ def show_client_detail():
                         cursor.execute("DELETE FROM calculated_dates WHERE client_id = ?", (client_id,))
                         conn.commit()
                         conn.close()
+                        invalidate_client_cache(client_id, ['calculated_dates'])
                         
                         st.success("Fechas eliminadas exitosamente")
                         st.session_state[f'confirm_clear_{client_id}'] = False
@@ -1478,8 +1487,7 @@ def show_monthly_readonly_calendar(client_id, selected_month, year=None):
     # Si se especifica un año, filtrar por ese año
     if year:
         try:
-            dates_df['date_obj'] = pd.to_datetime(dates_df['date'])
-            dates_df = dates_df[dates_df['date_obj'].dt.year == year]
+            dates_df = dates_df[dates_df['date'].dt.year == year]
             if dates_df.empty:
                 st.info(f"No hay fechas calculadas para {selected_month} {year}.")
                 return
@@ -1499,7 +1507,7 @@ def show_monthly_readonly_calendar(client_id, selected_month, year=None):
     month_dates = []
     for _, row in dates_df.iterrows():
         try:
-            date_obj = datetime.strptime(row['date'], '%Y-%m-%d')
+            date_obj = row['date']
             if date_obj.month == month_num:
                 # Mapear días de la semana al español
                 days_spanish = {
@@ -1666,10 +1674,8 @@ def show_monthly_calendar_component(client_id, selected_month, year=None):
 
     # Filtrar por año/mes
     try:
-        df = dates_df.copy()
-        df['date_obj'] = pd.to_datetime(df['date'], errors='coerce')
-        df = df.dropna(subset=['date_obj'])
-        df = df[(df['date_obj'].dt.year == year) & (df['date_obj'].dt.month == month_num)]
+        df = dates_df.dropna(subset=['date'])
+        df = df[(df['date'].dt.year == year) & (df['date'].dt.month == month_num)]
     except Exception:
         st.error("No se pudieron procesar las fechas del calendario.")
         return
@@ -1681,7 +1687,7 @@ def show_monthly_calendar_component(client_id, selected_month, year=None):
     # Mapa día -> {actividad: conteo}
     day_events: dict[int, dict[str, int]] = {}
     for _, row in df.iterrows():
-        day = int(row['date_obj'].day)
+        day = int(row['date'].day)
         activity = str(row.get('activity_name', '')).strip() or "(Sin nombre)"
         day_events.setdefault(day, {})
         day_events[day][activity] = day_events[day].get(activity, 0) + 1
@@ -1902,9 +1908,12 @@ def show_inline_editable_calendar(client_id):
                         key=f"save_inline_{client_id}",
                         type="primary",
                         use_container_width=True):
-                save_inline_changes(client_id, edit_df, edited_df)
-                st.success("Cambios guardados exitosamente")
-                st.rerun()
+                try:
+                    save_inline_changes(client_id, edit_df, edited_df)
+                    st.success("Cambios guardados exitosamente")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error guardando cambios: {e}")
         
         with col2:
             if st.button("Descartar Cambios",
@@ -1963,13 +1972,13 @@ def show_monthly_editable_calendar(client_id):
     month_dates = []
     for _, row in dates_df.iterrows():
         try:
-            date_obj = datetime.strptime(row['date'], '%Y-%m-%d')
+            date_obj = row['date']
             if date_obj.month == month_num:
                 month_dates.append({
                     'activity_name': row['activity_name'],
                     'date': date_obj.date(),
                     'date_position': row['date_position'],
-                    'original_date_str': row['date']
+                    'original_date_str': row['date'].strftime('%Y-%m-%d')
                 })
         except:
             continue
@@ -1978,24 +1987,28 @@ def show_monthly_editable_calendar(client_id):
         st.info(f"No hay actividades programadas para {selected_month}")
         return
     
-    # Crear DataFrame para el editor
+    # Crear DataFrame para el editor: las fechas del mes de cada actividad, en orden de posición
     activities = {}
     for date_info in month_dates:
-        activity = date_info['activity_name']
-        if activity not in activities:
-            activities[activity] = {}
-        activities[activity][date_info['date_position']] = date_info['date']
+        activities.setdefault(date_info['activity_name'], []).append((date_info['date_position'], date_info['date']))
     
     # Determinar el número máximo de fechas para este mes
     max_dates = max(len(dates) for dates in activities.values()) if activities else 0
     max_dates = max(max_dates, 6)  # Mínimo 6 columnas
     
-    # Preparar datos para el editor
+    # Preparar datos para el editor; cell_positions guarda la posición real de cada celda
     edit_data = []
+    cell_positions = {}
     for activity, dates in activities.items():
+        dates.sort(key=lambda item: item[0])
         row_data = {'Actividad': activity}
         for i in range(1, max_dates + 1):
-            row_data[f'Fecha {i}'] = dates.get(i, None)
+            if i <= len(dates):
+                position, date_value = dates[i - 1]
+                row_data[f'Fecha {i}'] = date_value
+                cell_positions[(activity, f'Fecha {i}')] = position
+            else:
+                row_data[f'Fecha {i}'] = None
         edit_data.append(row_data)
     
     if not edit_data:
@@ -2044,9 +2057,12 @@ def show_monthly_editable_calendar(client_id):
                         key=f"save_monthly_{client_id}_{month_num}",
                         type="primary",
                         use_container_width=True):
-                save_monthly_changes(client_id, edit_df, edited_df, month_num)
-                st.success(f"Cambios guardados para {selected_month}")
-                st.rerun()
+                try:
+                    save_monthly_changes(client_id, edit_df, edited_df, month_num, cell_positions)
+                    st.success(f"Cambios guardados para {selected_month}")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error guardando cambios: {e}")
         
         with col2:
             if st.button("Descartar Cambios",
@@ -2088,9 +2104,7 @@ def show_editable_full_year_calendar(client_id, year=None):
     # Filtrar por año si se especifica
     if year:
         try:
-            dates_df['date_obj_temp'] = pd.to_datetime(dates_df['date'])
-            dates_df = dates_df[dates_df['date_obj_temp'].dt.year == year]
-            dates_df = dates_df.drop('date_obj_temp', axis=1)
+            dates_df = dates_df[dates_df['date'].dt.year == year]
             
             if dates_df.empty:
                 st.info(f"No hay fechas calculadas para el año {year}.")
@@ -2134,7 +2148,7 @@ def show_editable_month_view(client_id, month_num, month_name, dates_df, year=No
     month_dates = []
     for _, row in dates_df.iterrows():
         try:
-            date_obj = datetime.strptime(row['date'], '%Y-%m-%d')
+            date_obj = row['date']
             if date_obj.month == month_num:
                 # Si year está especificado, verificar que coincida
                 if year is None or date_obj.year == year:
@@ -2142,7 +2156,7 @@ def show_editable_month_view(client_id, month_num, month_name, dates_df, year=No
                         'activity': row['activity_name'],
                         'date': date_obj,
                         'position': row['date_position'],
-                        'original_date_str': row['date']
+                        'original_date_str': row['date'].strftime('%Y-%m-%d')
                     })
         except:
             continue
@@ -2283,7 +2297,7 @@ def prepare_calendar_for_editing(dates_df):
             
             if not date_row.empty:
                 try:
-                    date_obj = datetime.strptime(date_row.iloc[0]['date'], '%Y-%m-%d').date()
+                    date_obj = date_row.iloc[0]['date'].date()
                     row_data[f'Fecha {i}'] = date_obj
                 except:
                     row_data[f'Fecha {i}'] = None
@@ -2295,103 +2309,63 @@ def prepare_calendar_for_editing(dates_df):
     return pd.DataFrame(result_data)
 
 
-def save_inline_changes(client_id, original_df, edited_df):
-    """Guarda los cambios realizados en el editor inline - Maneja todas las fechas disponibles"""
-    
-    for idx, row in edited_df.iterrows():
-        activity = row['Actividad']
-        
-        # Recopilar fechas editadas (buscar todas las columnas de fechas)
-        dates_list = []
-        i = 1
-        while f'Fecha {i}' in row:
-            col_name = f'Fecha {i}'
-            date_value = row[col_name]
-            
-            if pd.notna(date_value) and date_value is not None:
-                # Manejo más robusto de diferentes tipos de fecha
-                try:
-                    if hasattr(date_value, 'strftime'):
-                        # Es un objeto datetime o date
-                        dates_list.append(date_value.strftime('%Y-%m-%d'))
-                    elif isinstance(date_value, str):
-                        # Es una string, verificar si es una fecha válida
-                        if date_value.strip():
-                            # Intentar parsear como fecha
-                            try:
-                                parsed_date = pd.to_datetime(date_value)
-                                dates_list.append(parsed_date.strftime('%Y-%m-%d'))
-                            except:
-                                dates_list.append(date_value)
-                        else:
-                            dates_list.append(None)
-                    else:
-                        # Intentar convertir a string y luego a fecha
-                        try:
-                            date_str = str(date_value)
-                            if date_str and date_str != 'nan':
-                                parsed_date = pd.to_datetime(date_str)
-                                dates_list.append(parsed_date.strftime('%Y-%m-%d'))
-                            else:
-                                dates_list.append(None)
-                        except:
-                            dates_list.append(None)
-                except Exception as e:
-                    print(f"Error procesando fecha en posición {i}: {e}")
-                    dates_list.append(None)
-            else:
-                dates_list.append(None)
-            i += 1
-        
-        # Guardar en la base de datos
-        save_calculated_dates(client_id, activity, dates_list)
+def _editor_date_str(date_value):
+    """Normaliza el valor de una celda del editor a 'YYYY-MM-DD' (None si está vacía)"""
+    if date_value is None or (not isinstance(date_value, str) and pd.isna(date_value)):
+        return None
+    try:
+        if hasattr(date_value, 'strftime'):
+            return date_value.strftime('%Y-%m-%d')
+        date_str = str(date_value).strip()
+        if not date_str or date_str == 'nan':
+            return None
+        return pd.to_datetime(date_str).strftime('%Y-%m-%d')
+    except Exception as e:
+        print(f"Error procesando fecha {date_value!r}: {e}")
+        return None
 
-def save_monthly_changes(client_id, original_df, edited_df, month_num):
-    """Guarda los cambios realizados en el editor mensual"""
-    
-    for idx, row in edited_df.iterrows():
-        activity = row['Actividad']
-        
-        # Recopilar fechas editadas del mes
-        dates_list = []
-        i = 1
-        while f'Fecha {i}' in row:
-            col_name = f'Fecha {i}'
-            date_value = row[col_name]
-            
-            if pd.notna(date_value) and date_value is not None:
-                # Manejo más robusto de diferentes tipos de fecha
-                try:
-                    if hasattr(date_value, 'strftime'):
-                        dates_list.append(date_value.strftime('%Y-%m-%d'))
-                    elif isinstance(date_value, str):
-                        if date_value.strip():
-                            try:
-                                parsed_date = pd.to_datetime(date_value)
-                                dates_list.append(parsed_date.strftime('%Y-%m-%d'))
-                            except:
-                                dates_list.append(date_value)
-                        else:
-                            dates_list.append(None)
-                    else:
-                        try:
-                            date_str = str(date_value)
-                            if date_str and date_str != 'nan':
-                                parsed_date = pd.to_datetime(date_str)
-                                dates_list.append(parsed_date.strftime('%Y-%m-%d'))
-                            else:
-                                dates_list.append(None)
-                        except:
-                            dates_list.append(None)
-                except Exception as e:
-                    print(f"Error procesando fecha en posición {i}: {e}")
-                    dates_list.append(None)
+def diff_calendar_edits(original_df, edited_df, cell_positions=None):
+    """Compara el editor antes y después y devuelve solo las celdas cambiadas.
+
+    Cada cambio es (acción, actividad, posición, fecha_anterior, fecha_nueva),
+    listo para apply_calculated_date_changes. Por defecto la columna 'Fecha i'
+    corresponde a date_position i; `cell_positions` ({(actividad, columna): posición})
+    permite otra correspondencia, y una celda vacía sin posición se inserta al final.
+    """
+    changes = []
+    date_columns = [col for col in edited_df.columns if col.startswith('Fecha ')]
+    for (_, orig_row), (_, edit_row) in zip(original_df.iterrows(), edited_df.iterrows()):
+        activity = edit_row['Actividad']
+        for col in date_columns:
+            old_date = _editor_date_str(orig_row.get(col))
+            new_date = _editor_date_str(edit_row[col])
+            if old_date == new_date:
+                continue
+            if cell_positions is None:
+                position = int(col.split(' ')[1])
             else:
-                dates_list.append(None)
-            i += 1
-        
-        # Guardar en la base de datos
-        save_calculated_dates(client_id, activity, dates_list)
+                position = cell_positions.get((activity, col))
+            if old_date is None:
+                changes.append(('insert', activity, position, None, new_date))
+            elif new_date is None:
+                changes.append(('delete', activity, position, old_date, None))
+            else:
+                changes.append(('update', activity, position, old_date, new_date))
+    return changes
+
+def save_inline_changes(client_id, original_df, edited_df):
+    """Guarda solo las celdas modificadas en el editor inline - Maneja todas las fechas disponibles"""
+    changes = diff_calendar_edits(original_df, edited_df)
+    counts = apply_calculated_date_changes(client_id, changes)
+    print(f"Cambios guardados para cliente {client_id}: {counts}")
+    return counts
+
+def save_monthly_changes(client_id, original_df, edited_df, month_num, cell_positions=None):
+    """Guarda solo las celdas modificadas en el editor mensual"""
+    changes = diff_calendar_edits(original_df, edited_df, cell_positions or {})
+    counts = apply_calculated_date_changes(client_id, changes)
+    print(f"Cambios guardados para cliente {client_id} (mes {month_num}): {counts}")
+    return counts
 
 def show_monthly_changes_preview(original_df, edited_df, month_name):
     """Muestra un preview de los cambios realizados en el mes específico"""
@@ -2584,7 +2558,7 @@ def show_client_activities_section(client_id):
                                         activity['frequency_config'],
                                         selected_year,
                                     )
-                                    clear_cache_pattern(f"dates_{client_id}")
+                                    invalidate_client_cache(client_id, ['calculated_dates'])
 
                                 if success:
                                     st.success(
@@ -3209,7 +3183,7 @@ def show_dates_editing_tab(client):
     dates_df = get_calculated_dates(client['id'])
     
     if not dates_df.empty and 'activity_name' in dates_df.columns:
-        activities_list = dates_df['activity_name'].unique()
+        activities_list = dates_df['activity_name'].unique().tolist()
         
         # Selector de actividad
         selected_activity = st.selectbox(
@@ -3235,7 +3209,7 @@ def show_dates_editing_tab(client):
                             
                             if not matching_row.empty:
                                 try:
-                                    current_date = datetime.strptime(matching_row.iloc[0]['date'], '%Y-%m-%d').date()
+                                    current_date = matching_row.iloc[0]['date'].date()
                                 except:
                                     current_date = datetime.now().date()
                             else:
@@ -3858,7 +3832,7 @@ def show_date_editing_section(client_id):
     dates_df = get_calculated_dates(client_id)
     
     if not dates_df.empty and 'activity_name' in dates_df.columns:
-        activities = dates_df['activity_name'].unique()
+        activities = dates_df['activity_name'].unique().tolist()
         
         selected_activity = st.selectbox("Selecciona actividad para editar:", activities)
         
@@ -3882,7 +3856,7 @@ def show_date_editing_section(client_id):
                                 
                                 if not matching_row.empty:
                                     try:
-                                        original_date = datetime.strptime(matching_row.iloc[0]['date'], '%Y-%m-%d').date()
+                                        original_date = matching_row.iloc[0]['date'].date()
                                     except:
                                         original_date = datetime.now().date()
                                 else:
@@ -4039,6 +4013,12 @@ def validate_frequency_data(name, frequency_type, frequency_config, description=
 def export_client_calendar(client_id, format_type="csv"):
     """Exporta el calendario de un cliente (funcionalidad futura)"""
     # Esta función se puede implementar más adelante
+    if format_type == "csv":
+        output = io.StringIO()
+        if export_calendars_csv(output, client_ids=[client_id], include_client=False) == 0:
+            return None
+        return output.getvalue()
+    
     dates_df = get_calculated_dates(client_id)
     
     if dates_df.empty:
@@ -4047,14 +4027,36 @@ def export_client_calendar(client_id, format_type="csv"):
     # Preparar datos para exportación
     export_data = prepare_calendar_for_export(dates_df)
     
-    if format_type == "csv":
-        return export_data.to_csv(index=False)
-    elif format_type == "excel":
+    if format_type == "excel":
         # Requiere openpyxl o xlsxwriter
         return export_data.to_excel(index=False)
     else:
         return None
 
+def export_calendars_csv(output, client_ids=None, year=None, include_client=True):
+    """Escribe en `output` (archivo o buffer de texto) el CSV de fechas calculadas.
+
+    Lee por bloques con iter_calculated_dates y escribe cada uno antes de pedir el
+    siguiente, de modo que exportar todos los clientes o varios años no carga la
+    tabla completa en memoria. Devuelve el número de filas escritas.
+    """
+    start_date = f"{int(year)}-01-01" if year else None
+    end_date = f"{int(year) + 1}-01-01" if year else None
+    
+    written = 0
+    for chunk in iter_calculated_dates(client_ids=client_ids, start_date=start_date, end_date=end_date):
+        export_chunk = pd.DataFrame({
+            'Actividad': chunk['activity_name'],
+            'Posición': chunk['date_position'],
+            'Fecha': chunk['date'],
+            'Personalizada': chunk['is_custom'].fillna(0).astype(bool).map({True: 'Sí', False: 'No'})
+        })
+        if include_client:
+            export_chunk.insert(0, 'Cliente', chunk['client_name'])
+        export_chunk.to_csv(output, index=False, header=written == 0)
+        written += len(export_chunk)
+    return written
+
 def prepare_calendar_for_export(dates_df):
     """Prepara los datos del calendario para exportación"""
     # Convertir a formato más legible para exportar
@@ -4069,7 +4071,7 @@ def prepare_calendar_for_export(dates_df):
             export_data.append({
                 'Actividad': activity,
                 'Posición': row['date_position'],
-                'Fecha': row['date'],
+                'Fecha': row['date'].strftime('%Y-%m-%d') if pd.notna(row['date']) else '',
                 'Personalizada': 'Sí' if row.get('is_custom', False) else 'No'
             })
     
@@ -4124,7 +4126,7 @@ def get_calendar_statistics(client_id):
     
     for _, row in dates_df.iterrows():
         try:
-            date_obj = datetime.strptime(row['date'], '%Y-%m-%d')
+            date_obj = row['date']
             
             if date_obj.year == current_year and date_obj.month == current_month:
                 dates_this_month += 1
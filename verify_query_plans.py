@@ -0,0 +1,356 @@
+"""
+Verificación de planes de consulta sobre calculated_dates.
+
+1. check_date_query_plans: sobre una BD en memoria con el esquema anterior de
+   calculated_dates migrado con los pasos reales (create_plan_check_database),
+   comprueba la migración de claves de fecha (fechas normalizadas, claves coherentes,
+   triggers) y que cada consulta por fecha del dashboard y de anomalías llega a un
+   índice con su filtro de fecha, a diferencia de la forma anterior con date(...).
+2. verify_query_plans: extrae de los módulos de la aplicación cada sentencia SQL
+   (SELECT/WITH/UPDATE/DELETE) que lee calculated_dates, la pasa por EXPLAIN QUERY
+   PLAN sobre esa misma BD y falla si alguna recorre la tabla completa. Las sentencias
+   que por diseño leen toda la tabla (migraciones, benchmarks, conteos globales) están
+   en WHOLE_TABLE_ALLOWED con su motivo.
+
+Uso:
+    python verify_query_plans.py [-v]
+"""
+import ast
+import os
+import re
+import sqlite3
+import sys
+from datetime import date, datetime, timedelta
+
+from database import (_create_schema, _migrate_date_keys, _DATABASE_INDEXES, date_day_number,
+                      _DATE_DAY_SQL, _DATE_YEAR_SQL, _DATE_MONTH_SQL)
+
+TABLE = 'calculated_dates'
+
+# Sentencias que leen toda la tabla a propósito, por `modulo.funcion` donde están
+WHOLE_TABLE_ALLOWED = {
+    'database._create_schema': 'migración: respaldo y backfill del catálogo de actividades',
+    'database._migrate_date_keys': 'migración: backfill de claves de fecha',
+    'benchmark_arrow_transport.benchmark_arrow_transport': 'benchmark de lectura completa',
+    'dashboard_components.get_activity_counts': 'conteo por actividad sobre todas las fechas',
+}
+
+_SQL_START_RE = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE)\b', re.IGNORECASE)
+_IN_TEMPLATE_RE = re.compile(r'IN\s*\(\s*\{[^{}]*\}\s*\)', re.IGNORECASE)
+_TEMPLATE_RE = re.compile(r'\{[^{}]*\}')
+
+
+# Filtros por fecha del dashboard y de anomalías: forma anterior (date(...) sobre la
+# columna) y forma actual sobre las claves enteras, con parámetros de ejemplo
+_DATE_PREDICATE_PLANS = [
+    (
+        'clientes_por_dia',
+        "SELECT c.name, cd.date FROM clients c JOIN calculated_dates cd ON c.id = cd.client_id "
+        "WHERE cd.activity_id = 1 AND date(cd.date) = ? ORDER BY c.name",
+        ('2025-03-03',),
+        "SELECT c.name, cd.date FROM clients c JOIN calculated_dates cd ON c.id = cd.client_id "
+        "WHERE cd.activity_id = 1 AND cd.date_day = ? ORDER BY c.name",
+        (date_day_number(date(2025, 3, 3)),)
+    ),
+    (
+        'actividad_mensual',
+        "SELECT cd.date, COUNT(*) FROM calculated_dates cd JOIN clients c ON c.id = cd.client_id "
+        "WHERE cd.activity_id = ? AND date(cd.date) >= ? AND date(cd.date) <= ? "
+        "GROUP BY date(cd.date) ORDER BY date(cd.date)",
+        (3, '2025-03-01', '2025-03-31'),
+        "SELECT cd.date, COUNT(*) FROM calculated_dates cd JOIN clients c ON c.id = cd.client_id "
+        "WHERE cd.activity_id = ? AND cd.date_day BETWEEN ? AND ? "
+        "GROUP BY cd.date_day ORDER BY cd.date_day",
+        (3, date_day_number(date(2025, 3, 1)), date_day_number(date(2025, 3, 31)))
+    ),
+    (
+        'anomalias_entrega',
+        "SELECT c.name, alb.date, ent.date FROM clients c "
+        "JOIN calculated_dates alb ON c.id = alb.client_id AND alb.activity_id = 2 "
+        "JOIN calculated_dates ent ON c.id = ent.client_id AND ent.activity_id = 3 "
+        "AND alb.date_position = ent.date_position "
+        "WHERE date(alb.date) > date(ent.date) AND ("
+        "(date(alb.date) >= ? AND date(alb.date) <= ?) OR (date(ent.date) >= ? AND date(ent.date) <= ?))",
+        ('2025-03-01', '2025-03-31', '2025-03-01', '2025-03-31'),
+        "SELECT c.name, alb.date, ent.date FROM clients c "
+        "JOIN calculated_dates alb ON c.id = alb.client_id AND alb.activity_id = 2 "
+        "JOIN calculated_dates ent ON c.id = ent.client_id AND ent.activity_id = 3 "
+        "AND alb.date_position = ent.date_position "
+        "WHERE alb.date_day > ent.date_day AND alb.date_day >= ? AND ent.date_day <= ? "
+        "AND (alb.date_day <= ? OR ent.date_day >= ?)",
+        (date_day_number(date(2025, 3, 1)), date_day_number(date(2025, 3, 31)),
+         date_day_number(date(2025, 3, 31)), date_day_number(date(2025, 3, 1)))
+    ),
+    (
+        'festivos',
+        "SELECT c.name, cd.date FROM clients c JOIN calculated_dates cd "
+        "ON c.id = cd.client_id AND cd.activity_id = 2 WHERE date(cd.date) IN (?, ?)",
+        ('2025-03-17', '2025-03-18'),
+        "SELECT c.name, cd.date FROM clients c JOIN calculated_dates cd "
+        "ON c.id = cd.client_id AND cd.activity_id = 2 WHERE cd.date_day IN (?, ?)",
+        (date_day_number(date(2025, 3, 17)), date_day_number(date(2025, 3, 18)))
+    ),
+]
+
+
+def _plan_steps(conn, query, params, table='calculated_dates'):
+    """Pasos de EXPLAIN QUERY PLAN que leen `table` (por nombre o por alias)"""
+    aliases = {table}
+    for match in re.finditer(rf'\b{table}\s+(?:AS\s+)?(\w+)', query, re.IGNORECASE):
+        aliases.add(match.group(1))
+    steps = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall():
+        detail = row[-1]
+        tokens = detail.replace(' TABLE ', ' ').split()
+        if len(tokens) > 1 and tokens[0] in ('SCAN', 'SEARCH') and tokens[1] in aliases:
+            steps.append(detail)
+    return steps
+
+
+def _uses_date_key(steps):
+    """Algún paso busca en un índice con una condición sobre la fecha (date, date_day, ...)"""
+    return any(
+        re.search(r'\((?:[^)]*\b)?(?:date|date_day|date_year|date_month)[=<>]', detail)
+        for detail in steps if detail.startswith('SEARCH')
+    )
+
+
+def create_plan_check_database(clients=300, dates_per_activity=24):
+    """BD SQLite en memoria con el esquema y los índices reales y datos sintéticos.
+
+    calculated_dates se crea primero con el esquema anterior (fechas mezcladas
+    'YYYY-MM-DD' y 'YYYY-MM-DD HH:MM:SS', sin date_day) y luego se aplican
+    los pasos de esquema, claves de fecha e índices de _MIGRATIONS, más ANALYZE. Sirve
+    para revisar planes (EXPLAIN QUERY PLAN) sin tocar la BD real. Devuelve la
+    conexión y el número de fechas insertadas.
+    """
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE calculated_dates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER,
+            activity_id INTEGER,
+            activity_name TEXT NOT NULL,
+            date_position INTEGER NOT NULL DEFAULT 1,
+            date DATE NOT NULL,
+            is_custom BOOLEAN DEFAULT 0,
+            UNIQUE(client_id, activity_name, date_position)
+        )
+    ''')
+    activities = [(1, 'Fecha Envío OC'), (2, 'Albaranado'), (3, 'Fecha Entrega')]
+    start = datetime(2025, 1, 1)
+    rows = []
+    for client_id in range(1, clients + 1):
+        for activity_id, activity_name in activities:
+            for position in range(1, dates_per_activity + 1):
+                offset = client_id + position * 14 + activity_id
+                if activity_id == 2 and client_id % 10 == 0:
+                    offset += 3  # albaranado después de la entrega: anomalía
+                value = start + timedelta(days=offset % 365)
+                text = value.strftime('%Y-%m-%d %H:%M:%S' if position % 2 else '%Y-%m-%d')
+                rows.append((client_id, activity_id, activity_name, position, text))
+    cursor.executemany(
+        "INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date) "
+        "VALUES (?, ?, ?, ?, ?)", rows
+    )
+
+    _create_schema(cursor)
+    _migrate_date_keys(cursor)
+    cursor.executemany(
+        "INSERT INTO clients (id, name, pais) VALUES (?, ?, ?)",
+        ((i, f"Cliente {i:04d}", 'México' if i % 3 == 0 else 'Colombia') for i in range(1, clients + 1))
+    )
+    for index_sql in _DATABASE_INDEXES:
+        try:
+            cursor.execute(index_sql)
+        except sqlite3.Error:
+            pass  # tablas de otros módulos que no existen en esta BD de prueba
+    cursor.execute("ANALYZE")
+    conn.commit()
+    return conn, len(rows)
+
+
+def check_date_query_plans(clients=300, dates_per_activity=24):
+    """Verifica la migración de claves de fecha y los planes de las consultas por fecha.
+
+    Sobre create_plan_check_database comprueba: fechas normalizadas, claves
+    coherentes, triggers en INSERT/UPDATE y, por cada consulta de
+    _DATE_PREDICATE_PLANS, que con los mismos índices el filtro de fecha anterior no
+    llega a ningún índice, el actual sí (SEARCH ... date_day=? / date_day>?) y ambas
+    formas devuelven las mismas filas. Devuelve un dict con los planes y 'ok'.
+    """
+    conn, row_count = create_plan_check_database(clients, dates_per_activity)
+    cursor = conn.cursor()
+    results = {'rows': row_count, 'plans': {}}
+
+    ok = True
+    cursor.execute("SELECT COUNT(*) FROM calculated_dates WHERE date <> date(date) OR date_day IS NULL")
+    results['non_normalized_rows'] = cursor.fetchone()[0]
+    cursor.execute(f'''
+        SELECT COUNT(*) FROM calculated_dates
+        WHERE date_day IS NOT {_DATE_DAY_SQL.format('date')}
+           OR date_year IS NOT {_DATE_YEAR_SQL.format('date')}
+           OR date_month IS NOT {_DATE_MONTH_SQL.format('date')}
+    ''')
+    results['inconsistent_rows'] = cursor.fetchone()[0]
+    ok = ok and results['non_normalized_rows'] == 0 and results['inconsistent_rows'] == 0
+
+    # Triggers: una fecha con hora se normaliza al insertar y las claves siguen a los UPDATE
+    cursor.execute(
+        "INSERT INTO calculated_dates (client_id, activity_id, activity_name, date_position, date) "
+        "VALUES (1, 1, 'Fecha Envío OC', 999, '2025-06-15 08:30:00')"
+    )
+    row_id = cursor.lastrowid
+    inserted = cursor.execute(
+        "SELECT date, date_day, date_year, date_month FROM calculated_dates WHERE id = ?", (row_id,)
+    ).fetchone()
+    cursor.execute("UPDATE calculated_dates SET date = '2026-01-02' WHERE id = ?", (row_id,))
+    updated = cursor.execute(
+        "SELECT date, date_day, date_year, date_month FROM calculated_dates WHERE id = ?", (row_id,)
+    ).fetchone()
+    results['trigger_insert'] = inserted
+    results['trigger_update'] = updated
+    ok = ok and inserted == ('2025-06-15', date_day_number(date(2025, 6, 15)), 2025, 6)
+    ok = ok and updated == ('2026-01-02', date_day_number(date(2026, 1, 2)), 2026, 1)
+
+    # Mismos índices para ambas formas: solo cambia el predicado
+    for name, old_query, old_params, new_query, new_params in _DATE_PREDICATE_PLANS:
+        old_rows = sorted(conn.execute(old_query, old_params).fetchall())
+        new_rows = sorted(conn.execute(new_query, new_params).fetchall())
+        before = _plan_steps(conn, old_query, old_params)
+        after = _plan_steps(conn, new_query, new_params)
+        plan = {
+            'before': before,
+            'after': after,
+            'date_index_before': _uses_date_key(before),
+            'date_index_after': _uses_date_key(after),
+            'same_rows': old_rows == new_rows,
+            'rows': len(new_rows)
+        }
+        results['plans'][name] = plan
+        ok = ok and not plan['date_index_before'] and plan['date_index_after'] and plan['same_rows']
+    conn.close()
+    results['ok'] = ok
+
+    print(f"=== PLANES DE CONSULTAS POR FECHA ({results['rows']} filas) ===")
+    print(f"   Filas sin normalizar: {results['non_normalized_rows']}, claves incoherentes: {results['inconsistent_rows']}")
+    print(f"   Trigger INSERT: {inserted} / UPDATE: {updated}")
+    for name, plan in results['plans'].items():
+        print(f"   {name} ({plan['rows']} filas, mismas filas: {plan['same_rows']})")
+        print(f"      antes:   {'; '.join(plan['before'])}")
+        print(f"      después: {'; '.join(plan['after'])}")
+    print(f"   Resultado: {'OK' if ok else 'FALLÓ'}")
+    return results
+
+
+
+def _render(node):
+    """Texto de una constante o f-string; los valores interpolados quedan como {…}"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        parts = []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(str(value.value))
+            else:
+                parts.append('{}')
+        return ''.join(parts)
+    return None
+
+
+def _to_sql(text):
+    """Sentencia ejecutable: listas IN ({...}) -> IN (?), el resto de plantillas se quitan"""
+    text = _IN_TEMPLATE_RE.sub('IN (?)', text)
+    return _TEMPLATE_RE.sub('', text)
+
+
+def _owner_names(tree):
+    """Mapa nodo -> nombre de la función (o asignación de módulo) que lo contiene"""
+    owners = {}
+    for top in tree.body:
+        if isinstance(top, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            name = top.name
+        elif isinstance(top, ast.Assign) and isinstance(top.targets[0], ast.Name):
+            name = top.targets[0].id
+        else:
+            name = '<module>'
+        stack = [(top, name)]
+        while stack:
+            node, owner = stack.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node is not top:
+                # Métodos: Clase.metodo; funciones anidadas se reportan con la exterior
+                owner = f"{name}.{node.name}" if isinstance(top, ast.ClassDef) else owner
+            owners[node] = owner
+            for child in ast.iter_child_nodes(node):
+                stack.append((child, owner))
+    return owners
+
+
+def collect_statements(root='.'):
+    """Sentencias SQL sobre calculated_dates en los módulos de `root`: (origen, línea, sql)"""
+    statements = []
+    this_file = os.path.abspath(__file__)
+    for filename in sorted(os.listdir(root)):
+        path = os.path.abspath(os.path.join(root, filename))
+        if not filename.endswith('.py') or path == this_file:
+            continue
+        module = filename[:-3]
+        with open(path, encoding='utf-8') as source:
+            tree = ast.parse(source.read(), filename=filename)
+        owners = _owner_names(tree)
+        # Las partes literales de un f-string también son Constant: solo cuenta el f-string
+        fstring_parts = {id(value) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr)
+                         for value in node.values}
+        for node in ast.walk(tree):
+            if id(node) in fstring_parts:
+                continue
+            text = _render(node)
+            if not text or not _SQL_START_RE.match(text) or not re.search(rf'\b{TABLE}\b', text):
+                continue
+            statements.append((f"{module}.{owners.get(node, '<module>')}", node.lineno, _to_sql(text)))
+    return statements
+
+
+def verify_query_plans(root='.', verbose=False):
+    """EXPLAIN de cada sentencia; devuelve (fallos, permitidas, errores)"""
+    conn, _ = create_plan_check_database()
+    failures, allowed, errors = [], [], []
+    statements = collect_statements(root)
+    for origin, line, sql in statements:
+        params = (None,) * sql.count('?')
+        try:
+            steps = _plan_steps(conn, sql, params, TABLE)
+        except Exception as e:
+            # Sentencias armadas con expresiones interpoladas: solo cuentan fuera de la lista permitida
+            if origin not in WHOLE_TABLE_ALLOWED:
+                errors.append((origin, line, sql, str(e)))
+            continue
+        scans = [step for step in steps if step.startswith('SCAN')]
+        if verbose:
+            print(f"{origin}:{line}: {'; '.join(steps)}")
+        if not scans:
+            continue
+        if origin in WHOLE_TABLE_ALLOWED:
+            allowed.append((origin, line, scans))
+        else:
+            failures.append((origin, line, sql, scans))
+    conn.close()
+
+    print(f"=== PLANES DE CONSULTA SOBRE {TABLE} ({len(statements)} sentencias) ===")
+    for origin, line, scans in allowed:
+        print(f"   [PERMITIDO] {origin}:{line}: {'; '.join(scans)} ({WHOLE_TABLE_ALLOWED[origin]})")
+    for origin, line, sql, message in errors:
+        print(f"   [ERROR] {origin}:{line}: {message}\n      {' '.join(sql.split())[:200]}")
+    for origin, line, sql, scans in failures:
+        print(f"   [SCAN] {origin}:{line}: {'; '.join(scans)}\n      {' '.join(sql.split())[:200]}")
+    print(f"   Resultado: {'OK' if not failures and not errors else 'FALLÓ'}")
+    return failures, allowed, errors
+
+
+if __name__ == '__main__':
+    date_plans = check_date_query_plans()
+    failures, _, errors = verify_query_plans(os.path.dirname(os.path.abspath(__file__)),
+                                             verbose='-v' in sys.argv)
+    sys.exit(1 if failures or errors or not date_plans['ok'] else 0)